@@ -0,0 +1,84 @@
+import asyncio
+
+import tornado.web
+
+from rangerequestsproxy.httprange import RangeNotSatisfiableException, parse_range_set, resolve_ranges
+
+PATTERN = bytes(bytearray(range(251)))
+LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+def object_content(index, size):
+    """Deterministic synthetic body of object index, a byte pattern rotated differently for every object."""
+    offset = index % len(PATTERN)
+    rotated = PATTERN[offset:] + PATTERN[:offset]
+    return (rotated * (size // len(rotated) + 1))[:size]
+
+
+class Origin(object):
+    """
+        Stand-in upstream serving objects /objects/0 ... /objects/<objects - 1> of object_size bytes each,
+        with single range support, ETag and Last-Modified. Every request is answered after latency seconds
+        and counted, which tells how many requests the proxy actually sent upstream.
+    """
+
+    def __init__(self, objects=16, object_size=1024 * 1024, latency=0):
+        self.latency = latency
+        self.contents = [object_content(index, object_size) for index in range(objects)]
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def application(self):
+        return tornado.web.Application([(r'/objects/(\d+)', OriginHandler, dict(origin=self))])
+
+    def reset(self):
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+class OriginHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ('GET', 'HEAD')
+
+    def initialize(self, origin):
+        self.origin = origin
+
+    async def get(self, index):
+        self.origin.requests += 1
+        if self.origin.latency:
+            await asyncio.sleep(self.origin.latency)
+
+        index = int(index)
+        if index >= len(self.origin.contents):
+            raise tornado.web.HTTPError(404)
+        content = self.origin.contents[index]
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('ETag', '"{}"'.format(index))
+        self.set_header('Last-Modified', LAST_MODIFIED)
+        self.set_header('Accept-Ranges', 'bytes')
+
+        body = content
+        if 'Range' in self.request.headers:
+            try:
+                ranges = resolve_ranges(parse_range_set(self.request.headers['Range']), len(content))
+            except RangeNotSatisfiableException:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */{}'.format(len(content)))
+                return
+            # Like many servers, multiple ranges are answered with the whole object
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.set_status(206)
+                self.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(content)))
+                body = content[start:end + 1]
+
+        if self.request.method == 'GET':
+            self.origin.bytes_sent += len(body)
+        self.write(body)
+
+    head = get
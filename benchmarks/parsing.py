@@ -0,0 +1,66 @@
+"""
+    Micro-benchmark of Range header parsing, the cost every proxied request pays before anything else:
+
+        python -m benchmarks.parsing --number 20000 --output parsing.json
+
+    Reports nanoseconds per parse_range_set call for common header values, answered from the memo of
+    recently seen values and parsed from scratch, as the best of several repeats.
+"""
+import argparse
+import json
+import sys
+import timeit
+
+from rangerequestsproxy import httprange
+
+HEADERS = (
+    'bytes=0-',
+    'bytes=0-1023',
+    'bytes=1048576-2097151',
+    'bytes=1048576-',
+    'bytes=-500',
+    'bytes=0-99,200-299,-50',
+    'bytes=0-99, 100-199, 4096-8191',
+)
+
+
+def measure(header, number, repeat):
+    def parse():
+        return httprange.parse_range_set(header).header
+
+    parse()
+    memoized = min(timeit.repeat(parse, number=number, repeat=repeat)) / number
+
+    max_length = httprange.MEMO_MAX_LENGTH
+    httprange._memo.pop(header, None)
+    # Values longer than MEMO_MAX_LENGTH are never remembered, so every call parses the header again
+    httprange.MEMO_MAX_LENGTH = -1
+    try:
+        uncached = min(timeit.repeat(parse, number=number, repeat=repeat)) / number
+    finally:
+        httprange.MEMO_MAX_LENGTH = max_length
+    return {
+        "memoized_ns": round(memoized * 1e9, 1),
+        "uncached_ns": round(uncached * 1e9, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmark of Range header parsing')
+    parser.add_argument('--number', type=int, default=20000, help='calls per repeat')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats, the fastest one is reported')
+    parser.add_argument('--header', action='append', help='header value to measure instead of the common ones')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    results = dict((header, measure(header, args.number, args.repeat)) for header in args.header or HEADERS)
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
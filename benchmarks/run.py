@@ -0,0 +1,349 @@
+"""
+    Load test of the proxy against an in-process stand-in origin, reporting throughput, latency percentiles,
+    peak memory and upstream request count as JSON so configurations can be compared:
+
+        python -m benchmarks.run --workload random --concurrency 32 --requests 5000 \\
+            --proxy-env RANGE_REQUESTS_PROXY_CACHE_SIZE=0 --output random-nocache.json
+
+    The origin and the load generator share this process, the proxy runs in a child process started with
+    run_proxy and configured through the same environment variables as in production.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+import tornado.httpserver
+import tornado.netutil
+
+from benchmarks.origin import Origin
+
+WORKLOADS = ('random', 'full', 'sequential', 'hotkey')
+PROXY_START_TIMEOUT = 10
+
+
+def plan(workload, rng, objects, object_size, range_size, seek_every):
+    """
+        Endless sequence of (object index, start, end) a client requests, start and end None mean the whole
+        object. Sequential readers read range_size chunks one after another and seek elsewhere every
+        seek_every chunks, hot key clients get identical plans from identically seeded generators.
+    """
+    range_size = min(range_size, object_size)
+    while True:
+        index = rng.randrange(objects)
+        if workload == 'full':
+            yield index, None, None
+        elif workload == 'sequential':
+            offset = rng.randrange(0, object_size, range_size)
+            for _ in range(seek_every):
+                if offset >= object_size:
+                    break
+                yield index, offset, min(offset + range_size, object_size) - 1
+                offset += range_size
+        else:
+            start = rng.randrange(object_size - range_size + 1)
+            yield index, start, start + range_size - 1
+
+
+def percentile(sorted_values, percent):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(len(sorted_values) * percent / 100.0))
+    return sorted_values[min(max(rank - 1, 0), len(sorted_values) - 1)]
+
+
+def peak_rss(pid):
+    """Peak resident set size in bytes of pid and its worker processes, None without /proc."""
+    total = 0
+    for process in [pid] + _children(pid):
+        try:
+            with open('/proc/{}/status'.format(process)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            if process == pid:
+                return None
+    return total
+
+
+def _children(pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except (IOError, OSError):
+        return []
+
+
+class Connection(object):
+    """Keep-alive HTTP/1.1 client connection, lean enough not to become the bottleneck it should measure."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def get(self, path, range_header=None):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}:{}'.format(self.host, self.port)]
+        if range_header:
+            lines.append('Range: ' + range_header)
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+
+        head = await self._reader.readuntil(b'\r\n\r\n')
+        status_line, _, header_block = head.decode('latin1').partition('\r\n')
+        code = int(status_line.split(' ', 2)[1])
+        headers = {}
+        for line in header_block.split('\r\n'):
+            name, separator, value = line.partition(':')
+            if separator:
+                headers[name.strip().lower()] = value.strip()
+
+        if 'content-length' in headers:
+            body = await self._reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._read_chunked()
+        else:
+            body = await self._reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return code, headers, body
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self._reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                await self._reader.readuntil(b'\r\n')
+                return b''.join(chunks)
+            chunks.append(await self._reader.readexactly(size))
+            await self._reader.readexactly(2)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class LoadTest(object):
+    """Drives one workload through the proxy and collects latencies, transferred bytes and errors."""
+
+    def __init__(self, origin, port, workload, concurrency, objects, object_size, range_size, seek_every, seed):
+        self.origin = origin
+        self.port = port
+        self.workload = workload
+        self.concurrency = concurrency
+        self.objects = objects
+        self.object_size = object_size
+        self.range_size = range_size
+        self.seek_every = seek_every
+        self.seed = seed
+        self.latencies = []
+        self.bytes_received = 0
+        self.errors = 0
+
+    def plans(self):
+        # Hot key clients share one seed, so in every burst they all ask for the same range at once
+        return [plan(self.workload, random.Random(self.seed if self.workload == 'hotkey' else self.seed + client),
+                     self.objects, self.object_size, self.range_size, self.seek_every)
+                for client in range(self.concurrency)]
+
+    async def run(self, requests):
+        connections = [Connection('127.0.0.1', self.port) for _ in range(self.concurrency)]
+        plans = self.plans()
+        try:
+            if self.workload == 'hotkey':
+                for _ in range(requests // self.concurrency):
+                    await asyncio.gather(*[self.request(connection, next(requests_plan))
+                                           for connection, requests_plan in zip(connections, plans)])
+            else:
+                share, remainder = divmod(requests, self.concurrency)
+                await asyncio.gather(*[self.run_client(connection, requests_plan, share + (client < remainder))
+                                       for client, (connection, requests_plan)
+                                       in enumerate(zip(connections, plans))])
+        finally:
+            for connection in connections:
+                connection.close()
+
+    async def run_client(self, connection, requests_plan, requests):
+        for _ in range(requests):
+            await self.request(connection, next(requests_plan))
+
+    async def request(self, connection, planned):
+        index, start, end = planned
+        started = time.time()
+        try:
+            code, _, body = await connection.get('/objects/{}'.format(index),
+                                                 None if start is None else 'bytes={}-{}'.format(start, end))
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            connection.close()
+            self.errors += 1
+            return
+        self.latencies.append(time.time() - started)
+        self.bytes_received += len(body)
+
+        content = self.origin.contents[index]
+        expected = content if start is None else content[start:end + 1]
+        # Whole objects come back as 206 too, the proxy always asks the upstream for a range
+        if code not in (200, 206) or body != expected:
+            self.errors += 1
+
+
+def _serve_proxy(port, workers, env):
+    # Runs in a fresh interpreter, the proxy reads its configuration from the environment when imported
+    os.environ.update(env)
+    from rangerequestsproxy.proxy import run_proxy
+
+    run_proxy(port, workers)
+
+
+def _stop_proxy(process):
+    # Pre-forked workers outlive their parent, they are collected before it goes away
+    workers = _children(process.pid)
+    process.terminate()
+    process.join()
+    for worker in workers:
+        try:
+            os.kill(worker, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+async def _wait_for_port(port, process):
+    deadline = time.time() + PROXY_START_TIMEOUT
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if not process.is_alive() or time.time() > deadline:
+                raise RuntimeError('The proxy did not start listening on port {}'.format(port))
+            await asyncio.sleep(0.1)
+
+
+async def benchmark(args):
+    origin = Origin(args.objects, args.object_size, args.origin_latency)
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(origin.application())
+    server.add_sockets(sockets)
+    origin_address = 'http://127.0.0.1:{}'.format(sockets[0].getsockname()[1])
+
+    env = dict(args.proxy_env)
+    env.setdefault('RANGE_REQUESTS_PROXY_ADDRESS', origin_address)
+    port = args.proxy_port or _free_port()
+    process = multiprocessing.get_context('spawn').Process(target=_serve_proxy, args=(port, args.workers, env))
+    process.start()
+    try:
+        await _wait_for_port(port, process)
+
+        def make_load_test(seed):
+            return LoadTest(origin, port, args.workload, args.concurrency, args.objects, args.object_size,
+                            args.range_size, args.seek_every, seed)
+
+        if args.warmup:
+            # Different ranges than the measured ones, so warming up does not fill caches with the answers
+            await make_load_test(args.seed + 1).run(args.warmup)
+            origin.reset()
+
+        load_test = make_load_test(args.seed)
+        started = time.time()
+        await load_test.run(args.requests)
+        duration = time.time() - started
+
+        stats_connection = Connection('127.0.0.1', port)
+        _, _, stats = await stats_connection.get('/stats')
+        stats_connection.close()
+        rss = peak_rss(process.pid)
+    finally:
+        _stop_proxy(process)
+        server.stop()
+
+    latencies = sorted(load_test.latencies)
+    return {
+        "workload": args.workload,
+        "config": {
+            "concurrency": args.concurrency,
+            "objects": args.objects,
+            "object_size": args.object_size,
+            "range_size": args.range_size,
+            "seek_every": args.seek_every,
+            "workers": args.workers,
+            "origin_latency": args.origin_latency,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "proxy_env": dict(args.proxy_env),
+        },
+        "requests": len(latencies),
+        "errors": load_test.errors,
+        "duration_seconds": round(duration, 3),
+        "requests_per_second": round(len(latencies) / duration, 1) if duration else None,
+        "bytes_per_second": round(load_test.bytes_received / duration) if duration else None,
+        "latency_ms": dict((name, round(value * 1000, 3) if value is not None else None) for name, value in (
+            ("p50", percentile(latencies, 50)),
+            ("p99", percentile(latencies, 99)),
+            ("max", latencies[-1] if latencies else None))),
+        "peak_rss_bytes": rss,
+        "upstream_requests": origin.requests,
+        "upstream_bytes": origin.bytes_sent,
+        "proxy_stats": json.loads(stats.decode('utf-8')),
+    }
+
+
+def _proxy_env(value):
+    name, separator, setting = value.partition('=')
+    if not separator or not name.startswith('RANGE_REQUESTS_PROXY_'):
+        raise argparse.ArgumentTypeError('expected RANGE_REQUESTS_PROXY_<NAME>=<value>')
+    return name, setting
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the range requests proxy with a local origin')
+    parser.add_argument('--workload', choices=WORKLOADS, default='random',
+                        help='random: small random ranges, full: whole objects, sequential: chunked reads with '
+                             'occasional seeks, hotkey: bursts of identical concurrent requests')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent keep-alive client connections')
+    parser.add_argument('--requests', type=int, default=2000, help='measured requests')
+    parser.add_argument('--warmup', type=int, default=0, help='requests sent before measuring')
+    parser.add_argument('--objects', type=int, default=16, help='number of objects the origin serves')
+    parser.add_argument('--object-size', type=int, default=1024 * 1024, help='size of every object in bytes')
+    parser.add_argument('--range-size', type=int, default=4096, help='bytes per ranged request')
+    parser.add_argument('--seek-every', type=int, default=8, help='sequential chunks read between seeks')
+    parser.add_argument('--origin-latency', type=float, default=0, help='seconds the origin waits per request')
+    parser.add_argument('--workers', type=int, default=1, help='proxy worker processes')
+    parser.add_argument('--proxy-port', type=int, default=0, help='proxy port, a free one by default')
+    parser.add_argument('--proxy-env', type=_proxy_env, action='append', default=[],
+                        help='proxy setting RANGE_REQUESTS_PROXY_<NAME>=<value>, repeatable')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = json.dumps(asyncio.run(benchmark(args)), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
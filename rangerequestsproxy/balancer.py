@@ -0,0 +1,228 @@
+import asyncio
+import bisect
+import hashlib
+import random
+import time
+
+import tornado.httpclient
+import tornado.ioloop
+from tornado.log import app_log
+
+from rangerequestsproxy.upstream import CONNECTION_ERROR, reset_progress
+
+POLICIES = ('random', 'least-outstanding', 'ewma', 'consistent-hash')
+DEFAULT_MAX_ERRORS = 5
+DEFAULT_EJECTION_TIME = 5
+DEFAULT_MAX_EJECTION_TIME = 300
+# Weight of the newest sample in the latency moving average
+EWMA_ALPHA = 0.3
+HASH_REPLICAS = 100
+
+
+def parse_upstreams(addresses):
+    """Parses ``http://a:9000;weight=3,http://b:9000`` into a list of (address, weight) tuples."""
+    upstreams = []
+    for entry in addresses.split(','):
+        address, _, params = entry.strip().partition(';')
+        if not address:
+            continue
+        weight = 1
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'weight' and value.strip().isdigit():
+                weight = max(int(value), 1)
+        upstreams.append((address, weight))
+    return upstreams
+
+
+class UpstreamState(object):
+    def __init__(self, address, weight=1):
+        self.address = address
+        self.weight = weight
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejections = 0
+        self.ejected_until = 0
+
+    def is_healthy(self, now):
+        return self.ejected_until <= now
+
+    def stats(self, now):
+        return {
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma * 1000, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_errors": self.consecutive_errors,
+            "healthy": self.is_healthy(now),
+        }
+
+
+class Balancer(object):
+    """
+        Picks an upstream for each request.
+
+        Policies: ``random`` (weighted), ``least-outstanding`` (fewest in-flight requests per weight), ``ewma``
+        (lowest moving average latency, scaled by in-flight requests) and ``consistent-hash`` (same path goes to
+        the same upstream, so its page cache stays warm). An upstream failing max_errors times in a row is ejected,
+        for twice as long after each re-admission that fails again. Active health checks are optional.
+    """
+
+    def __init__(self, policy='random', max_errors=DEFAULT_MAX_ERRORS, ejection_time=DEFAULT_EJECTION_TIME,
+                 max_ejection_time=DEFAULT_MAX_EJECTION_TIME):
+        if policy not in POLICIES:
+            raise ValueError('Unknown balancing policy {}, expected one of {}'.format(policy, ', '.join(POLICIES)))
+        self.policy = policy
+        self.max_errors = max_errors
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        self._states = {}
+        self._ring_addresses = None
+        self._ring = []
+        self._health_check = None
+
+    def select(self, addresses, key=None, exclude=()):
+        states = [self._state(address, weight) for address, weight in parse_upstreams(addresses)]
+        states = [state for state in states if state.address not in exclude]
+        if not states:
+            return None
+
+        now = time.time()
+        candidates = [state for state in states if state.is_healthy(now)]
+        if not candidates:
+            # Every upstream is ejected: fail open to the one closest to re-admission rather than refuse traffic
+            return min(states, key=lambda state: state.ejected_until).address
+
+        if self.policy == 'least-outstanding':
+            return self._pick_lowest(candidates, lambda state: state.outstanding / state.weight)
+        elif self.policy == 'ewma':
+            return self._pick_lowest(candidates, lambda state: state.ewma * (state.outstanding + 1) / state.weight)
+        elif self.policy == 'consistent-hash' and key is not None:
+            return self._pick_hashed(states, candidates, key)
+        return self._pick_random(candidates)
+
+    def on_start(self, address):
+        state = self._state(address)
+        state.outstanding += 1
+        state.requests += 1
+        return time.time()
+
+    def on_first_byte(self, address, started):
+        state = self._states.get(address)
+        if state is None:
+            # The upstream left the configuration while the request ran
+            return
+        latency = time.time() - started
+        state.ewma = latency if not state.ewma else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * state.ewma
+
+    def on_complete(self, address, failed):
+        """Ends a request started with on_start, failed is None for requests abandoned before they had a result."""
+        state = self._states.get(address)
+        if state is None:
+            # Forgotten while the request ran, its completion must not bring the upstream back
+            return
+        state.outstanding = max(state.outstanding - 1, 0)
+        if failed:
+            self.mark_failure(address)
+        elif failed is not None:
+            self.mark_success(address)
+
+    def mark_success(self, address):
+        state = self._state(address)
+        state.consecutive_errors = 0
+        state.ejections = 0
+
+    def mark_failure(self, address):
+        state = self._state(address)
+        state.errors += 1
+        state.consecutive_errors += 1
+        if state.consecutive_errors >= self.max_errors and state.is_healthy(time.time()):
+            ejection_time = min(self.ejection_time * 2 ** state.ejections, self.max_ejection_time)
+            state.ejected_until = time.time() + ejection_time
+            state.ejections += 1
+            state.consecutive_errors = 0
+            app_log.warning('Upstream %s ejected for %d seconds', address, ejection_time)
+
+    def forget(self, address):
+        """Drops the state of an upstream that left the configuration."""
+        self._states.pop(address, None)
+
+    def start_health_checks(self, get_addresses, path, interval):
+        """Probes every upstream with ``GET path`` each interval seconds, re-admitting or ejecting it."""
+        async def probe():
+            addresses = [address for address, _ in parse_upstreams(get_addresses())]
+            await asyncio.gather(*[self._probe(address, address + path, interval) for address in addresses])
+
+        self._health_check = tornado.ioloop.PeriodicCallback(probe, interval * 1000)
+        self._health_check.start()
+
+    def stats(self):
+        now = time.time()
+        return {
+            "policy": self.policy,
+            "upstreams": dict((address, state.stats(now)) for address, state in self._states.items()),
+        }
+
+    async def _probe(self, address, url, timeout):
+        # Probes share the curl handles of proxied requests, whose progress function aborts cancelled attempts
+        request = tornado.httpclient.HTTPRequest(url, request_timeout=timeout, prepare_curl_callback=reset_progress)
+        try:
+            response = await tornado.httpclient.AsyncHTTPClient().fetch(request, raise_error=False)
+            code = response.code
+        except Exception:
+            # Refused connections and timeouts have no response
+            code = CONNECTION_ERROR
+        self._handle_probe(address, code)
+
+    def _handle_probe(self, address, code):
+        state = self._state(address)
+        if code < 500:
+            state.ejected_until = 0
+            self.mark_success(address)
+        else:
+            state.consecutive_errors = max(state.consecutive_errors, self.max_errors - 1)
+            self.mark_failure(address)
+
+    def _state(self, address, weight=None):
+        state = self._states.get(address)
+        if state is None:
+            state = self._states[address] = UpstreamState(address, weight or 1)
+        elif weight is not None:
+            state.weight = weight
+        return state
+
+    def _pick_random(self, candidates):
+        point = random.uniform(0, sum(state.weight for state in candidates))
+        for state in candidates:
+            point -= state.weight
+            if point <= 0:
+                return state.address
+        return candidates[-1].address
+
+    def _pick_lowest(self, candidates, cost):
+        lowest = min(cost(state) for state in candidates)
+        return random.choice([state for state in candidates if cost(state) == lowest]).address
+
+    def _pick_hashed(self, states, candidates, key):
+        addresses = tuple((state.address, state.weight) for state in states)
+        if addresses != self._ring_addresses:
+            self._ring = sorted((self._hash('{}#{}'.format(address, i)), address)
+                                for address, weight in addresses for i in range(HASH_REPLICAS * weight))
+            self._ring_addresses = addresses
+
+        healthy = set(state.address for state in candidates)
+        position = bisect.bisect(self._ring, (self._hash(key), ''))
+        # Walk the ring clockwise to the first healthy upstream, keys of ejected upstreams spread over the rest
+        for offset in range(len(self._ring)):
+            address = self._ring[(position + offset) % len(self._ring)][1]
+            if address in healthy:
+                return address
+        return candidates[0].address
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
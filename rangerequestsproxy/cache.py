@@ -0,0 +1,161 @@
+import collections
+import hashlib
+import os
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+BLOCK_FILE_SUFFIX = '.block'
+MAX_OBJECTS = 10000
+
+ObjectInfo = collections.namedtuple('ObjectInfo', ['validator', 'size', 'content_type', 'etag', 'last_modified'])
+
+
+class BlockCache(object):
+    """
+        LRU cache of fixed size, aligned blocks of upstream objects.
+
+        Blocks are kept in memory up to ``memory_size`` bytes. When ``disk_path`` is given, blocks evicted from
+        memory are spilled to disk up to ``disk_size`` bytes and promoted back to memory on the next hit.
+        Blocks are keyed by (url, validator) so a changed object never mixes with stale blocks.
+    """
+
+    def __init__(self, memory_size, block_size=DEFAULT_BLOCK_SIZE, disk_path=None, disk_size=0):
+        self.block_size = block_size
+        self.memory_size = memory_size
+        self.disk_path = disk_path
+        self.disk_size = disk_size if disk_path else 0
+        self._objects = collections.OrderedDict()
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        self.evictions = 0
+
+        if self.disk_path:
+            self._clear_disk()
+
+    def resize(self, memory_size, disk_size):
+        """Changes the size limits, least recently used blocks are evicted until the cache fits again."""
+        self.memory_size = memory_size
+        self.disk_size = disk_size if self.disk_path else 0
+        while self._disk_bytes > self.disk_size and self._disk:
+            _, evicted_path = self._disk.popitem(last=False)
+            self._remove_disk_file(evicted_path)
+            self.evictions += 1
+        while self._memory_bytes > self.memory_size:
+            evicted_id, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._spill_to_disk(evicted_id, evicted)
+
+    def get_object(self, url):
+        info = self._objects.get(url)
+        if info is not None:
+            self._objects.move_to_end(url)
+        return info
+
+    def set_object(self, url, info):
+        self._objects[url] = info
+        self._objects.move_to_end(url)
+        while len(self._objects) > MAX_OBJECTS:
+            self._objects.popitem(last=False)
+
+    def forget_object(self, url):
+        self._objects.pop(url, None)
+
+    def get_block(self, key, index):
+        block_id = (key, index)
+        data = self._memory.get(block_id)
+        if data is not None:
+            self._memory.move_to_end(block_id)
+            return data
+
+        path = self._disk.pop(block_id, None)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        finally:
+            self._remove_disk_file(path)
+        self._store_in_memory(block_id, data)
+        return data
+
+    def put_block(self, key, index, data):
+        block_id = (key, index)
+        if block_id in self._memory or block_id in self._disk:
+            return
+        self._store_in_memory(block_id, data)
+
+    def record_hit(self, nbytes):
+        self.hits += 1
+        self.hit_bytes += nbytes
+
+    def record_miss(self, nbytes):
+        self.misses += 1
+        self.miss_bytes += nbytes
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_bytes": self.hit_bytes,
+            "miss_bytes": self.miss_bytes,
+            "evictions": self.evictions,
+            "memory_bytes": self._memory_bytes,
+            "memory_blocks": len(self._memory),
+            "disk_bytes": self._disk_bytes,
+            "disk_blocks": len(self._disk),
+        }
+
+    def _store_in_memory(self, block_id, data):
+        if len(data) > self.memory_size:
+            return
+        self._memory[block_id] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_size:
+            evicted_id, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._spill_to_disk(evicted_id, evicted)
+
+    def _spill_to_disk(self, block_id, data):
+        if not self.disk_size or len(data) > self.disk_size:
+            self.evictions += 1
+            return
+
+        path = self._block_path(block_id)
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+        except IOError:
+            self.evictions += 1
+            return
+        self._disk[block_id] = path
+        self._disk_bytes += len(data)
+        while self._disk_bytes > self.disk_size:
+            _, evicted_path = self._disk.popitem(last=False)
+            self._remove_disk_file(evicted_path)
+            self.evictions += 1
+
+    def _remove_disk_file(self, path):
+        try:
+            self._disk_bytes -= os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _block_path(self, block_id):
+        (url, validator), index = block_id
+        digest = hashlib.sha1('{}\n{}'.format(url, validator).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_path, '{}-{}{}'.format(digest, index, BLOCK_FILE_SUFFIX))
+
+    def _clear_disk(self):
+        if not os.path.isdir(self.disk_path):
+            os.makedirs(self.disk_path)
+        for name in os.listdir(self.disk_path):
+            if name.endswith(BLOCK_FILE_SUFFIX):
+                os.remove(os.path.join(self.disk_path, name))
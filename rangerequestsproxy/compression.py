@@ -0,0 +1,197 @@
+import collections
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional, gzip is always available
+    brotli = None
+
+DEFAULT_LEVEL = 6
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_TYPES = ('text/*', 'application/json', 'application/javascript', 'application/xml', 'application/x-ndjson',
+                 'image/svg+xml')
+
+
+def available_encodings():
+    """Encodings the proxy can produce, in order of preference."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding, encodings):
+    """
+        Picks the encoding from encodings (ordered by preference) the Accept-Encoding value rates highest, None
+        when the client only takes identity. A ``*`` rates every encoding it does not name explicitly.
+    """
+    if not accept_encoding:
+        return None
+    ratings = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            ratings[coding] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = ratings.get(encoding, ratings.get('*', 0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def variant_etag(etag, encoding):
+    """Entity tag of the encoded variant, the identity one must not validate it."""
+    if not etag or not etag.endswith('"'):
+        return etag
+    return '{}-{}"'.format(etag[:-1], encoding)
+
+
+class Encoder(object):
+    """
+        Compresses one response body chunk by chunk. When the response has a cache key, the compressed output is
+        collected and stored as the cached variant once the body turns out to be complete.
+    """
+
+    def __init__(self, policy, encoding, key=None, expected_length=None):
+        self.policy = policy
+        self.encoding = encoding
+        self._key = key
+        self._expected_length = expected_length
+        self._parts = [] if key is not None else None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=policy.level)
+        else:
+            self._compressor = zlib.compressobj(policy.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        self.bytes_in += len(data)
+        if self.encoding == 'br':
+            return self._output(self._compressor.process(bytes(data)))
+        return self._output(self._compressor.compress(data))
+
+    def finish(self, complete=True):
+        """Returns the last compressed bytes, complete=False keeps a truncated body out of the cache."""
+        data = self._output(self._compressor.finish() if self.encoding == 'br' else self._compressor.flush())
+        self.policy.record(self.bytes_in, self.bytes_out)
+        if (complete and self._parts is not None and
+                (self._expected_length is None or self._expected_length == self.bytes_in)):
+            self.policy.store(self._key, b''.join(self._parts))
+        self._parts = None
+        return data
+
+    def _output(self, data):
+        self.bytes_out += len(data)
+        if self._parts is not None and data:
+            self._parts.append(data)
+            if self.bytes_out > self.policy.cache_size:
+                # Larger than the whole cache, it would never be stored
+                self._parts = None
+        return data
+
+
+class CachedEncoder(object):
+    """Stands in for an Encoder when the variant is cached: sends it right away and drops the identity body."""
+
+    def __init__(self, policy, encoding, body):
+        self.policy = policy
+        self.encoding = encoding
+        self._body = body
+
+    def compress(self, data):
+        body, self._body = self._body, b''
+        return body
+
+    def finish(self, complete=True):
+        return self.compress(b'')
+
+
+class CompressionPolicy(object):
+    """
+        Decides which responses are compressed and keeps an LRU cache of compressed variants of up to
+        cache_size bytes, keyed by (url, validator, encoding) so a changed object never gets a stale variant.
+
+        Only media types matching types are compressed, ``text/*`` matches every text type. Bodies known to be
+        smaller than min_size are not worth the extra header bytes and CPU.
+    """
+
+    def __init__(self, level=DEFAULT_LEVEL, types=DEFAULT_TYPES, min_size=DEFAULT_MIN_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.level = level
+        self.types = frozenset(media_type.strip().lower() for media_type in types if media_type.strip())
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self.encodings = available_encodings()
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def compressible(self, content_type):
+        media_type = (content_type or '').partition(';')[0].strip().lower()
+        return media_type in self.types or media_type.partition('/')[0] + '/*' in self.types
+
+    def negotiate(self, accept_encoding):
+        return negotiate(accept_encoding, self.encodings)
+
+    def cached(self, encoding, url, validator, length=None):
+        """Cached variant of the object at url with validator, None when there is none."""
+        key = (url, validator, encoding)
+        body = self._cache.get(key) if validator else None
+        if body is not None:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            self.record(length or 0, len(body))
+        return body
+
+    def encoder(self, encoding, url=None, validator=None, expected_length=None):
+        """Encoder for one response, answered from the cache when url and validator identify a cached variant."""
+        key = (url, validator, encoding) if url is not None and validator and self.cache_size else None
+        if key is not None:
+            body = self.cached(encoding, url, validator, expected_length)
+            if body is not None:
+                return CachedEncoder(self, encoding, body)
+            self.cache_misses += 1
+        return Encoder(self, encoding, key, expected_length)
+
+    def store(self, key, body):
+        if len(body) > self.cache_size or key in self._cache:
+            return
+        self._cache[key] = body
+        self._cache_bytes += len(body)
+        while self._cache_bytes > self.cache_size:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+
+    def record(self, bytes_in, bytes_out):
+        self.responses += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def stats(self):
+        return {
+            "level": self.level,
+            "encodings": list(self.encodings),
+            "responses": self.responses,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_bytes": self._cache_bytes,
+            "cache_variants": len(self._cache),
+        }
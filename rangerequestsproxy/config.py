@@ -0,0 +1,233 @@
+import json
+import os
+import time
+
+import tornado.ioloop
+from tornado.log import app_log
+
+from rangerequestsproxy.balancer import POLICIES, parse_upstreams
+
+DEFAULT_INTERVAL = 5
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _non_negative(convert):
+    def parse(value):
+        if isinstance(value, bool):
+            raise ValueError('expected a number')
+        value = convert(value)
+        if value < 0:
+            raise ValueError('must not be negative')
+        return value
+    return parse
+
+
+def _positive_int(value):
+    value = _non_negative(int)(value)
+    if not value:
+        raise ValueError('must be positive')
+    return value
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('1', 'true'):
+        return True
+    if str(value).strip().lower() in ('0', 'false', ''):
+        return False
+    raise ValueError('expected true or false')
+
+
+def _comma_separated(value):
+    items = value.split(',') if isinstance(value, str) else list(value)
+    if not all(isinstance(item, str) for item in items):
+        raise ValueError('expected a string or a list of strings')
+    return ','.join(item.strip() for item in items if item.strip())
+
+
+def _addresses(value):
+    value = _comma_separated(value)
+    for address, _ in parse_upstreams(value):
+        if not address.startswith(('http://', 'https://')):
+            raise ValueError('{} is not an http:// or https:// address'.format(address))
+    return value
+
+
+def _balancing_policy(value):
+    if value not in POLICIES:
+        raise ValueError('expected one of {}'.format(', '.join(POLICIES)))
+    return value
+
+
+def _compression_level(value):
+    value = _non_negative(int)(value)
+    if value > 9:
+        raise ValueError('must be at most 9')
+    return value
+
+
+# Settings that can change while the proxy runs, named like their RANGE_REQUESTS_PROXY_* variables in lower case.
+# Port, workers, event loop, cache block size and directory, file root and health checks need a restart.
+SETTINGS = {
+    'address': _addresses,
+    'balancing_policy': _balancing_policy,
+    'upstream_max_errors': _positive_int,
+    'upstream_ejection_time': _non_negative(int),
+    'upstream_max_ejection_time': _non_negative(int),
+    'max_connections_per_upstream': _positive_int,
+    'upstream_idle_timeout': _non_negative(int),
+    'dns_cache_timeout': _non_negative(int),
+    'connect_timeout': _non_negative(float),
+    'first_byte_timeout': _non_negative(float),
+    'stall_timeout': _non_negative(int),
+    'request_timeout': _non_negative(float),
+    'hedge': _boolean,
+    'hedge_percentile': _non_negative(float),
+    'min_hedge_delay': _non_negative(float),
+    'max_retries': _non_negative(int),
+    'retry_budget_ratio': _non_negative(float),
+    'max_ranges': _positive_int,
+    'multipart_max_gap': _non_negative(int),
+    'split_size': _non_negative(int),
+    'split_parallelism': _positive_int,
+    'split_retries': _non_negative(int),
+    'streaming': _boolean,
+    'stream_high_water_mark': _positive_int,
+    'readahead_size': _non_negative(int),
+    'readahead_max_window': _non_negative(int),
+    'readahead_time': _non_negative(float),
+    'cache_size': _non_negative(int),
+    'cache_disk_size': _non_negative(int),
+    'cache_max_span': _non_negative(int),
+    'metadata_ttl': _non_negative(int),
+    'metadata_size': _positive_int,
+    'rate_limit': _non_negative(int),
+    'client_rate_limit': _non_negative(int),
+    'upstream_rate_limit': _non_negative(int),
+    'rate_burst': _non_negative(int),
+    'max_inflight_bytes': _non_negative(int),
+    'shaping_chunk_size': _positive_int,
+    'compression': _boolean,
+    'compression_level': _compression_level,
+    'compression_types': _comma_separated,
+    'compression_min_size': _non_negative(int),
+    'compression_cache_size': _non_negative(int),
+}
+
+
+def parse_settings(values):
+    """Validates a mapping of setting names to values and returns it with typed values, all or nothing."""
+    if not isinstance(values, dict):
+        raise ConfigError('Expected an object of settings')
+    settings = {}
+    for name, value in values.items():
+        parse = SETTINGS.get(name)
+        if parse is None:
+            raise ConfigError('Unknown or not reloadable setting {}'.format(name))
+        try:
+            settings[name] = parse(value)
+        except (TypeError, ValueError) as e:
+            raise ConfigError('Invalid value {!r} for {}: {}'.format(value, name, e))
+    return settings
+
+
+def read_file(path):
+    """Settings of the JSON config file at path, as they are written there."""
+    try:
+        with open(path) as f:
+            values = json.load(f)
+    except (IOError, OSError) as e:
+        raise ConfigError('Cannot read {}: {}'.format(path, e))
+    except ValueError as e:
+        raise ConfigError('Cannot parse {}: {}'.format(path, e))
+    if not isinstance(values, dict):
+        raise ConfigError('{} must hold an object of settings'.format(path))
+    return values
+
+
+def write_file(path, values):
+    # Readers never see a half written file, the new one replaces the old in one rename
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(values, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(temporary, path)
+
+
+class ConfigFile(object):
+    """
+        JSON config file of reloadable settings, polled every interval seconds. When its modification time or size
+        changed, it is read and validated as a whole and handed to apply on top of the defaults, so a setting
+        removed from the file goes back to its default; a file that fails to read, parse or apply is reported and
+        leaves the running configuration as it is.
+    """
+
+    def __init__(self, path, apply, interval=DEFAULT_INTERVAL, defaults=None):
+        self.path = path
+        self.apply = apply
+        self.interval = interval
+        self.defaults = dict(defaults or {})
+        self.version = 0
+        self.loaded_at = None
+        self.error = None
+        self._signature = None
+        self._watch = None
+
+    def load(self):
+        """Reads and applies the file, raises ConfigError and keeps the running configuration when that fails."""
+        try:
+            self._signature = self._stat()
+            settings = dict(self.defaults, **parse_settings(read_file(self.path)))
+            self.apply(settings)
+        except ConfigError as e:
+            self.error = str(e)
+            raise
+        self.version += 1
+        self.loaded_at = int(round(time.time()))
+        self.error = None
+        return settings
+
+    def update(self, settings):
+        """Writes settings into the file, next to the ones it already holds, so every worker picks them up."""
+        values = read_file(self.path) if os.path.exists(self.path) else {}
+        values.update(settings)
+        write_file(self.path, values)
+
+    def check(self):
+        """Loads the file again when it changed since it was last loaded, True when it did."""
+        if self._stat() == self._signature:
+            return False
+        try:
+            self.load()
+        except ConfigError as e:
+            app_log.error('Keeping the running configuration: %s', e)
+        return True
+
+    def start(self):
+        if self.interval:
+            self._watch = tornado.ioloop.PeriodicCallback(self.check, self.interval * 1000)
+            self._watch.start()
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.stop()
+            self._watch = None
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "error": self.error,
+        }
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,308 @@
+import collections
+import time
+
+import tornado.httpclient
+import tornado.ioloop
+
+try:
+    import pycurl
+except ImportError:  # pragma: no cover - pycurl is only needed to abort losing attempts early
+    pycurl = None
+
+from rangerequestsproxy.upstream import CONNECTION_ERROR, reset_progress
+
+DEFAULT_FIRST_BYTE_TIMEOUT = 10
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_MIN_HEDGE_DELAY = 0.05
+DEFAULT_MAX_RETRIES = 1
+DEFAULT_BUDGET_RATIO = 0.1
+# Hedge delay falls back to the minimum until this many first byte latencies were observed
+MIN_LATENCY_SAMPLES = 20
+LATENCY_SAMPLES = 1000
+
+
+class HedgingPolicy(object):
+    """
+        Settings and shared state for hedged and retried upstream fetches.
+
+        Hedges and retries are paid from a budget: every request deposits budget_ratio tokens (up to
+        budget_max) and every hedge or retry withdraws one, so extra load stays below budget_ratio of the
+        traffic no matter how badly the upstreams behave.
+    """
+
+    def __init__(self, hedge=False, hedge_percentile=DEFAULT_HEDGE_PERCENTILE, min_hedge_delay=DEFAULT_MIN_HEDGE_DELAY,
+                 max_retries=DEFAULT_MAX_RETRIES, first_byte_timeout=DEFAULT_FIRST_BYTE_TIMEOUT,
+                 budget_ratio=DEFAULT_BUDGET_RATIO, budget_max=10):
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_retries = max_retries
+        self.first_byte_timeout = first_byte_timeout
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self._tokens = budget_max
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.retries = 0
+        self.budget_exhausted = 0
+        self.first_byte_timeouts = 0
+
+    def on_request(self):
+        self._tokens = min(self._tokens + self.budget_ratio, self.budget_max)
+
+    def withdraw(self):
+        if self._tokens < 1:
+            self.budget_exhausted += 1
+            return False
+        self._tokens -= 1
+        return True
+
+    def record_first_byte(self, latency):
+        self._latencies.append(latency)
+
+    def hedge_delay(self):
+        if len(self._latencies) < MIN_LATENCY_SAMPLES:
+            return self.min_hedge_delay
+        latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.hedge_percentile / 100.0), len(latencies) - 1)
+        return max(latencies[index], self.min_hedge_delay)
+
+    def stats(self):
+        return {
+            "hedges_fired": self.hedges_fired,
+            "hedges_won": self.hedges_won,
+            "retries": self.retries,
+            "budget_exhausted": self.budget_exhausted,
+            "first_byte_timeouts": self.first_byte_timeouts,
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 3),
+        }
+
+
+class Attempt(object):
+    """One upstream request of a HedgedFetch, its callbacks go into the tornado HTTPRequest."""
+
+    def __init__(self, fetch, is_hedge=False):
+        self.fetch = fetch
+        self.is_hedge = is_hedge
+        self.upstream = None
+        self.started = None
+        self.curl = None
+        self.first_byte = False
+        self.cancelled = False
+        self.completed = False
+        self.timeout = None
+
+    def on_header(self, header_line):
+        self.fetch._handle_header(self, header_line)
+
+    def on_chunk(self, chunk):
+        self.fetch._handle_chunk(self, chunk)
+
+    def on_response(self, response):
+        self._release_curl()
+        self.fetch._handle_response(self, response)
+
+    def prepare_curl(self, curl):
+        self.curl = curl
+        curl.range_proxy_attempt = self
+        if pycurl is not None:
+            # A non-zero return value from the progress function aborts the transfer
+            curl.setopt(pycurl.NOPROGRESS, 0)
+            curl.setopt(pycurl.XFERINFOFUNCTION, self._progress)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _progress(self, *args):
+        # Once the handle went on to another request, that one must not be aborted
+        handed_on = self.curl is not None and getattr(self.curl, 'range_proxy_attempt', None) is not self
+        return 1 if self.cancelled and not handed_on else 0
+
+    def _release_curl(self):
+        # The handle is back in the client's pool, unless another attempt took it over already the progress
+        # function must not abort whatever request uses it next
+        curl = self.curl
+        if curl is not None and getattr(curl, 'range_proxy_attempt', None) is self:
+            curl.range_proxy_attempt = None
+            if pycurl is not None:
+                reset_progress(curl)
+
+
+class HedgedFetch(object):
+    """
+        Upstream fetch with a first byte deadline, bounded retries of connection failures and an optional
+        hedge: when no byte arrived after the policy's hedge delay, a duplicate request goes to another
+        upstream, whichever answers first wins and the other one is cancelled.
+
+        select_upstream(exclude) returns an upstream not in exclude or None, send(attempt) sends the request to
+        attempt.upstream with the attempt's callbacks. Only idempotent requests are hedged or retried.
+    """
+
+    def __init__(self, policy, balancer, select_upstream, send, callback, header_callback=None, streaming_callback=None,
+                 prepare_curl_callback=None, idempotent=True, first_byte_callback=None):
+        self.policy = policy
+        self.balancer = balancer
+        self.select_upstream = select_upstream
+        self.send = send
+        self.callback = callback
+        self.header_callback = header_callback
+        self.streaming_callback = streaming_callback
+        self.prepare_curl_callback = prepare_curl_callback
+        self.idempotent = idempotent
+        self.first_byte_callback = first_byte_callback
+        self.attempts = []
+        self.winner = None
+        self.done = False
+        self._retries = 0
+        self._hedge_timer = None
+
+    def start(self):
+        self.policy.on_request()
+        upstream = self._select()
+        if upstream is None:
+            return False
+        self._launch(upstream)
+        if self.policy.hedge and self.idempotent:
+            self._hedge_timer = tornado.ioloop.IOLoop.current().call_later(self.policy.hedge_delay(), self._hedge)
+        return True
+
+    def _select(self, is_hedge=False):
+        upstream = self.select_upstream(tuple(a.upstream for a in self.attempts))
+        if upstream is None and not is_hedge:
+            # Retries prefer another upstream but may go back to a tried one, hedges only make sense elsewhere
+            upstream = self.select_upstream(())
+        return upstream
+
+    def _launch(self, upstream, is_hedge=False):
+        attempt = Attempt(self, is_hedge)
+        attempt.upstream = upstream
+        attempt.started = self.balancer.on_start(upstream)
+        self.attempts.append(attempt)
+        if self.policy.first_byte_timeout:
+            attempt.timeout = tornado.ioloop.IOLoop.current().call_later(
+                self.policy.first_byte_timeout, self._first_byte_timeout, attempt)
+        self.send(attempt)
+
+    def cancel(self):
+        """Stops every attempt, the callbacks are not called anymore. For clients that went away."""
+        if self.done:
+            return
+        self.done = True
+        for attempt in self.attempts:
+            attempt.cancel()
+            self._clear_timeout(attempt)
+        if self._hedge_timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._hedge_timer)
+            self._hedge_timer = None
+
+    def _hedge(self):
+        self._hedge_timer = None
+        if self.done or self.winner is not None or any(a.first_byte for a in self.attempts):
+            return
+        # The target is picked first, budget tokens only pay for hedges that are actually sent
+        upstream = self._select(is_hedge=True)
+        if upstream is not None and self.policy.withdraw():
+            self.policy.hedges_fired += 1
+            self._launch(upstream, is_hedge=True)
+
+    def _first_byte_timeout(self, attempt):
+        attempt.timeout = None
+        if self.done or attempt.first_byte or attempt.cancelled:
+            return
+        self.policy.first_byte_timeouts += 1
+        attempt.cancel()
+        self._complete(attempt, failed=True)
+        error = tornado.httpclient.HTTPError(CONNECTION_ERROR, 'Timeout waiting for the first byte')
+        self._handle_failure(attempt, tornado.httpclient.HTTPResponse(
+            tornado.httpclient.HTTPRequest(attempt.upstream or ''), CONNECTION_ERROR, error=error))
+
+    def _on_first_byte(self, attempt):
+        if attempt.first_byte:
+            return
+        attempt.first_byte = True
+        self._clear_timeout(attempt)
+        latency = time.time() - attempt.started
+        self.policy.record_first_byte(latency)
+        if self.first_byte_callback is not None:
+            self.first_byte_callback(latency)
+        self.balancer.on_first_byte(attempt.upstream, attempt.started)
+
+    def _choose(self, attempt):
+        if self.winner is None:
+            self.winner = attempt
+            if attempt.is_hedge:
+                self.policy.hedges_won += 1
+            for other in self.attempts:
+                if other is not attempt and not other.cancelled:
+                    other.cancel()
+            if self._hedge_timer is not None:
+                tornado.ioloop.IOLoop.current().remove_timeout(self._hedge_timer)
+                self._hedge_timer = None
+            if self.prepare_curl_callback is not None and attempt.curl is not None:
+                self.prepare_curl_callback(attempt.curl)
+        return self.winner is attempt
+
+    def _handle_header(self, attempt, header_line):
+        if attempt.cancelled or self.done:
+            return
+        self._on_first_byte(attempt)
+        if self.header_callback is not None and self._choose(attempt):
+            self.header_callback(header_line)
+
+    def _handle_chunk(self, attempt, chunk):
+        if attempt.cancelled or self.done:
+            return
+        self._on_first_byte(attempt)
+        if self._choose(attempt) and self.streaming_callback is not None:
+            self.streaming_callback(chunk)
+
+    def _handle_response(self, attempt, response):
+        self._clear_timeout(attempt)
+        if attempt.cancelled:
+            # Cancelled losers neither count as failures nor as successes of their upstream
+            self._complete(attempt, failed=None)
+            return
+
+        self._complete(attempt, failed=response.code >= 500)
+        if self.done:
+            return
+        if response.code == CONNECTION_ERROR and self.winner is None:
+            self._handle_failure(attempt, response)
+            return
+        self._on_first_byte(attempt)
+        if self._choose(attempt):
+            self._finish(response)
+
+    def _handle_failure(self, attempt, response):
+        attempt.cancel()
+        if any(not a.cancelled for a in self.attempts):
+            # another attempt is still running and may answer
+            return
+        if self.idempotent and self._retries < self.policy.max_retries:
+            upstream = self._select()
+            if upstream is not None and self.policy.withdraw():
+                self._retries += 1
+                self.policy.retries += 1
+                self._launch(upstream)
+                return
+        self._finish(response)
+
+    def _finish(self, response):
+        self.done = True
+        for attempt in self.attempts:
+            self._clear_timeout(attempt)
+        if self._hedge_timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._hedge_timer)
+            self._hedge_timer = None
+        self.callback(response)
+
+    def _complete(self, attempt, failed):
+        if not attempt.completed:
+            attempt.completed = True
+            self.balancer.on_complete(attempt.upstream, failed)
+
+    def _clear_timeout(self, attempt):
+        if attempt.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(attempt.timeout)
+            attempt.timeout = None
@@ -1,6 +1,13 @@
 import re
 
-RANGE_REGEX = re.compile('bytes=(.*)-(.*)')
+CONTENT_RANGE_REGEX = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)$')
+MAX_RANGES = 30
+# re.ASCII keeps \d to 0-9, int() would accept other Unicode digits or fail on them
+SINGLE_RANGE_REGEX = re.compile(r'bytes=(\d*)-(\d*)', re.ASCII)
+# Parsed header values, clients reading the same object ask for the same ranges over and over
+MEMO_SIZE = 4096
+MEMO_MAX_LENGTH = 256
+_memo = {}
 
 
 class RangeNotSatisfiableException(Exception):
@@ -11,28 +18,187 @@ class RangeNotSatisfiableException(Exception):
         self.message += message
 
 
-def parse_range(range_str):
-    range_dict = {}
-    range_match = RANGE_REGEX.search(range_str)
-    if not range_match:
+class ByteRangeSet(object):
+    """
+        Immutable, validated byte range set as returned by parse_range_set. It behaves like a sequence of
+        (start, end) tuples, compares equal to any list or tuple of the same ranges, and header holds its
+        canonical Range header value.
+    """
+
+    __slots__ = ('ranges', 'header')
+
+    def __init__(self, ranges):
+        object.__setattr__(self, 'ranges', tuple(ranges))
+        object.__setattr__(self, 'header', format_range_set(self.ranges))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ByteRangeSet is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('ByteRangeSet is immutable')
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __getitem__(self, index):
+        return self.ranges[index]
+
+    def __eq__(self, other):
+        if isinstance(other, ByteRangeSet):
+            return self.ranges == other.ranges
+        if isinstance(other, (list, tuple)):
+            return self.ranges == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.ranges)
+
+    def __repr__(self):
+        return 'ByteRangeSet({!r})'.format(self.header)
+
+
+def parse_content_range(content_range_str):
+    """
+        Parses ``Content-Range: bytes start-end/total`` into a (start, end, total) tuple.
+        Total is None when the upstream does not know the complete length ("*").
+    """
+    content_range_match = CONTENT_RANGE_REGEX.match(content_range_str or '')
+    if not content_range_match:
+        return None
+
+    start, end, total = content_range_match.groups()
+    return int(start), int(end), int(total) if total != '*' else None
+
+
+def parse_range_set(range_str, max_ranges=MAX_RANGES):
+    """
+        Parses a RFC 7233 byte range set (``bytes=0-99,200-299,-500``) into a ByteRangeSet of (start, end) tuples.
+
+        End is None for open ranges (``500-``) and start is None for suffix ranges (``-500``), in which case
+        end holds the suffix length. Overlapping and adjacent ranges are merged, see merge_ranges. Results for
+        header values up to MEMO_MAX_LENGTH characters are remembered, the MEMO_SIZE oldest are dropped first.
+    """
+    ranges = _memo.get(range_str)
+    if ranges is None:
+        ranges = _parse_range_set(range_str)
+        if len(range_str) <= MEMO_MAX_LENGTH:
+            if len(_memo) >= MEMO_SIZE:
+                del _memo[next(iter(_memo))]
+            _memo[range_str] = ranges
+    if len(ranges) > max_ranges:
+        raise RangeNotSatisfiableException('At most {} ranges are allowed.'.format(max_ranges))
+    return ranges
+
+
+def _parse_range_set(range_str):
+    # Fast path for the single range nearly every client sends, one match of a pattern that cannot backtrack
+    match = SINGLE_RANGE_REGEX.fullmatch(range_str)
+    if match is not None:
+        return ByteRangeSet([_range_spec(*match.groups())])
+
+    unit, separator, range_set = range_str.partition('=')
+    if unit.lower() != 'bytes' or not separator:
         raise RangeNotSatisfiableException('Range must be in format: bytes=start-end')
+    # isdigit() alone also accepts other Unicode digits
+    ascii_only = range_set.isascii()
 
-    start_range = range_match.group(1)
-    end_range = range_match.group(2)
+    ranges = []
+    for range_spec in range_set.split(','):
+        # RFC 7230 list rule: optional whitespace around elements, empty elements are allowed
+        range_spec = range_spec.strip(' \t')
+        if not range_spec:
+            continue
+        first, dash, last = range_spec.partition('-')
+        if not dash or not ascii_only or (first and not first.isdigit()) or (last and not last.isdigit()):
+            raise RangeNotSatisfiableException('Invalid start or end interval.')
+        ranges.append(_range_spec(first, last))
 
-    try:
-        start_range = int(start_range) if start_range else 0
-        end_range = int(end_range) if end_range else None
-    except ValueError:
-        raise RangeNotSatisfiableException('Invalid start or end interval.')
+    if not ranges:
+        raise RangeNotSatisfiableException('Range must be in format: bytes=start-end')
+    return ByteRangeSet(merge_ranges(ranges))
 
-    if start_range < 0:
-        raise RangeNotSatisfiableException('Start of the interval cannot be less than zero.')
 
-    if end_range is not None and start_range >= end_range:
+def _range_spec(first, last):
+    if not first:
+        if not last:
+            raise RangeNotSatisfiableException('Invalid start or end interval.')
+        if int(last) == 0:
+            raise RangeNotSatisfiableException('Suffix length must be larger than zero.')
+        return None, int(last)
+    start = int(first)
+    if not last:
+        return start, None
+    end = int(last)
+    if start > end:
         raise RangeNotSatisfiableException('End interval must be larger that start interval.')
+    return start, end
+
+
+def merge_ranges(ranges):
+    """
+        Sorts ranges by start and merges overlapping or adjacent ones. Suffix ranges cannot be compared with
+        the others before the object size is known, they are merged into the longest one and put last.
+    """
+    merged = []
+    # Sorted by start only, an open end (None) cannot be compared with a number
+    for start, end in sorted((r for r in ranges if r[0] is not None), key=lambda r: r[0]):
+        if merged:
+            last_start, last_end = merged[-1]
+            if last_end is None or start <= last_end + 1:
+                merged[-1] = (last_start, None if last_end is None or end is None else max(last_end, end))
+                continue
+        merged.append((start, end))
+
+    suffixes = [length for start, length in ranges if start is None]
+    if suffixes:
+        merged.append((None, max(suffixes)))
+    return merged
+
+
+def resolve_ranges(ranges, size):
+    """Turns ranges into absolute, merged (start, end) tuples for an object of the given size."""
+    resolved = []
+    for start, end in ranges:
+        if start is None:
+            start, end = max(size - end, 0), size - 1
+        elif end is None or end >= size:
+            end = size - 1
+        if start <= end:
+            resolved.append((start, end))
+
+    if not resolved:
+        raise RangeNotSatisfiableException('None of the ranges overlap the object of {} bytes.'.format(size))
+    return merge_ranges(resolved)
+
+
+def coalesce_ranges(ranges, max_gap):
+    """Groups sorted ranges so ranges separated by at most max_gap bytes can be fetched together."""
+    groups = []
+    for start, end in ranges:
+        if groups and start is not None:
+            last_end = groups[-1][-1][1]
+            if groups[-1][-1][0] is not None and last_end is not None and start - last_end - 1 <= max_gap:
+                groups[-1].append((start, end))
+                continue
+        groups.append([(start, end)])
+    return groups
+
+
+def format_range(start, end):
+    if start is None:
+        return '-%d' % end
+    return '%d-' % start if end is None else '%d-%d' % (start, end)
+
+
+def format_range_set(ranges):
+    return 'bytes=' + ','.join([format_range(start, end) for start, end in ranges])
 
-    range_dict['start_range'] = start_range if start_range else 0
-    range_dict['end_range'] = end_range if end_range else None
 
-    return range_dict
+WHOLE_OBJECT = ByteRangeSet([(0, None)])
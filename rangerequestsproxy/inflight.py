@@ -0,0 +1,201 @@
+import io
+import json
+
+import tornado.httpclient
+import tornado.httputil
+from tornado.log import app_log
+
+from rangerequestsproxy.httprange import RangeNotSatisfiableException, parse_content_range
+from rangerequestsproxy.upstream import claim_transfer, pause_transfer
+
+
+class InflightFetch(object):
+    """Buffered upstream fetch of bytes start-end (inclusive, end None means open) shared by several requests."""
+
+    def __init__(self, key, start, end):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.waiters = []
+        # Set by whoever starts the upstream request, cancelled once the last waiter left
+        self.upstream = None
+
+    def covers(self, start, end):
+        if start < self.start:
+            return False
+        return self.end is None or (end is not None and end <= self.end)
+
+
+class InflightStream(object):
+    """
+        Streaming upstream fetch whose header lines and body chunks are fanned out to every subscriber.
+
+        The transfer is paused while any subscriber has more bytes buffered than it can take and resumed once
+        none has, so a slow client holds back the shared stream instead of piling it up in memory.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.subscribers = []
+        self.header_lines = []
+        self.joinable = True
+        self.upstream = None
+        self.curl = None
+        self.paused = False
+        self._lagging = set()
+
+    def on_header(self, header_line):
+        self.header_lines.append(header_line)
+        for header_callback, _, _ in list(self.subscribers):
+            header_callback(header_line)
+
+    def on_chunk(self, chunk):
+        # Late subscribers would miss the bytes already sent, so only join before the body starts
+        self.joinable = False
+        for _, streaming_callback, _ in list(self.subscribers):
+            streaming_callback(chunk)
+
+    def prepare_curl(self, curl):
+        claim_transfer(curl, self)
+        self.curl = curl
+
+    def pause(self, subscriber):
+        self._lagging.add(subscriber)
+        self._update_pause()
+
+    def resume(self, subscriber):
+        self._lagging.discard(subscriber)
+        self._update_pause()
+
+    def _update_pause(self):
+        paused = bool(self._lagging)
+        if paused != self.paused and pause_transfer(self.curl, self, paused):
+            self.paused = paused
+
+
+class InflightRegistry(object):
+    """
+        Collapses concurrent upstream fetches.
+
+        Buffered requests attach to an in-flight fetch for the same url whose range covers theirs and get the
+        response sliced down to the range they asked for. Streaming requests share a fetch when url and Range
+        header are identical and no body bytes have been forwarded yet.
+
+        Requests whose client went away leave their fetch, the upstream request is cancelled when nobody is
+        waiting for it anymore.
+    """
+
+    def __init__(self):
+        self._fetches = {}
+        self._streams = {}
+        self.upstream_fetches = 0
+        self.coalesced_requests = 0
+
+    def join(self, key, start, end, callback):
+        for fetch in self._fetches.get(key, ()):
+            if fetch.covers(start, end):
+                fetch.waiters.append((start, end, callback))
+                self.coalesced_requests += 1
+                return fetch
+        return None
+
+    def start(self, key, start, end, callback):
+        fetch = InflightFetch(key, start, end)
+        fetch.waiters.append((start, end, callback))
+        self._fetches.setdefault(key, []).append(fetch)
+        self.upstream_fetches += 1
+        return fetch
+
+    def complete(self, fetch, response):
+        self.discard(fetch)
+        for start, end, callback in fetch.waiters:
+            try:
+                if (start, end) == (fetch.start, fetch.end):
+                    callback(response)
+                else:
+                    callback(slice_response(response, start, end))
+            except Exception:
+                app_log.exception('Error while handling coalesced response for %s', fetch.key)
+
+    def leave(self, fetch, callback):
+        fetch.waiters = [waiter for waiter in fetch.waiters if waiter[2] is not callback]
+        if not fetch.waiters:
+            self.discard(fetch)
+            if fetch.upstream is not None:
+                fetch.upstream.cancel()
+
+    def discard(self, fetch):
+        fetches = self._fetches.get(fetch.key, [])
+        if fetch in fetches:
+            fetches.remove(fetch)
+        if not fetches:
+            self._fetches.pop(fetch.key, None)
+
+    def join_stream(self, key, header_callback, streaming_callback, callback):
+        stream = self._streams.get(key)
+        if stream is None or not stream.joinable:
+            return None
+        for header_line in stream.header_lines:
+            header_callback(header_line)
+        stream.subscribers.append((header_callback, streaming_callback, callback))
+        self.coalesced_requests += 1
+        return stream
+
+    def start_stream(self, key, header_callback, streaming_callback, callback):
+        stream = InflightStream(key)
+        stream.subscribers.append((header_callback, streaming_callback, callback))
+        self._streams[key] = stream
+        self.upstream_fetches += 1
+        return stream
+
+    def complete_stream(self, stream, response):
+        self.discard_stream(stream)
+        stream.curl = None
+        for _, _, callback in stream.subscribers:
+            try:
+                callback(response)
+            except Exception:
+                app_log.exception('Error while handling coalesced response for %s', stream.key)
+
+    def leave_stream(self, stream, callback):
+        stream.subscribers = [subscriber for subscriber in stream.subscribers if subscriber[2] is not callback]
+        if not stream.subscribers:
+            self.discard_stream(stream)
+            if stream.upstream is not None:
+                stream.upstream.cancel()
+
+    def discard_stream(self, stream):
+        if self._streams.get(stream.key) is stream:
+            del self._streams[stream.key]
+
+
+def slice_response(response, start, end):
+    """Cuts bytes start-end out of a successful upstream response, as if they were requested on their own."""
+    if response.error or response.code not in (200, 206):
+        return response
+
+    body = response.body or b''
+    if response.code == 206:
+        content_range = parse_content_range(response.headers.get('Content-Range'))
+        if content_range is None:
+            return response
+        fetched_start, fetched_end, size = content_range
+    else:
+        fetched_start, fetched_end, size = 0, len(body) - 1, len(body)
+
+    headers = tornado.httputil.HTTPHeaders()
+    for header, val in response.headers.get_all():
+        if header not in ('Content-Range', 'Content-Length'):
+            headers.add(header, val)
+
+    end = fetched_end if end is None else min(end, fetched_end)
+    if start > end:
+        headers['Content-Range'] = 'bytes */{}'.format(size if size is not None else '*')
+        headers['Content-Type'] = 'application/json'
+        error = json.JSONEncoder().encode({"error": RangeNotSatisfiableException.message}).encode('utf-8')
+        return tornado.httpclient.HTTPResponse(response.request, 416, headers=headers, buffer=io.BytesIO(error))
+
+    chunk = body[start - fetched_start:end - fetched_start + 1]
+    headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size if size is not None else '*')
+    headers['Content-Length'] = str(len(chunk))
+    return tornado.httpclient.HTTPResponse(response.request, 206, headers=headers, buffer=io.BytesIO(chunk))
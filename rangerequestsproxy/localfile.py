@@ -0,0 +1,147 @@
+import collections
+import mimetypes
+import os
+import posixpath
+import stat
+
+import tornado.httputil
+from urllib.parse import unquote
+
+from rangerequestsproxy.cache import ObjectInfo
+
+DEFAULT_MAX_OPEN_FILES = 1000
+READ_SIZE = 256 * 1024
+
+
+class TruncatedFileError(IOError):
+    pass
+
+
+class LocalFile(object):
+    """
+        Read-only descriptor of a file plus the metadata for its response headers, both taken from the open
+        descriptor so they always describe the same file.
+
+        Ranges are read in chunks of up to READ_SIZE bytes with pread, which leaves the file position alone,
+        so any number of responses read from one descriptor at once. A file truncated while it is read ends
+        the read with TruncatedFileError, where a memory map would kill the process with SIGBUS.
+        The chunks go through the handler like any other body rather than sendfile, which would bypass
+        Tornado's stream (TLS, Content-Length accounting) as well as rate limits and compression.
+    """
+
+    __slots__ = ('path', 'identity', 'size', 'etag', 'last_modified', 'content_type', 'info', '_fd', '_readers',
+                 '_closed')
+
+    def __init__(self, path):
+        self.path = path
+        # A symlink swapped in for the resolved file fails to open instead of being followed out of the root
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            file_stat = os.fstat(self._fd)
+            if not stat.S_ISREG(file_stat.st_mode):
+                raise IOError('{} is not a regular file'.format(path))
+        except Exception:
+            os.close(self._fd)
+            raise
+        self.identity = _identity(file_stat)
+        self.size = file_stat.st_size
+        self.etag = '"{:x}-{:x}"'.format(file_stat.st_mtime_ns, file_stat.st_size)
+        self.last_modified = tornado.httputil.format_timestamp(file_stat.st_mtime)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.info = ObjectInfo(validator=self.etag, size=self.size, content_type=self.content_type,
+                               etag=self.etag, last_modified=self.last_modified)
+        self._readers = 0
+        self._closed = False
+
+    def read(self, start, end):
+        """Yields bytes start-end (inclusive) in chunks, raises TruncatedFileError when the file got shorter."""
+        self._readers += 1
+        try:
+            while start <= end:
+                data = os.pread(self._fd, min(READ_SIZE, end - start + 1), start)
+                if not data:
+                    raise TruncatedFileError('{} was truncated while it was read'.format(self.path))
+                start += len(data)
+                yield data
+        finally:
+            self._readers -= 1
+            self._release()
+
+    def close(self):
+        self._closed = True
+        self._release()
+
+    def _release(self):
+        # Responses still reading keep the descriptor open, the last of them closes it
+        if self._closed and not self._readers and self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class LocalFiles(object):
+    """
+        Maps request paths to files below root and keeps at most max_open of them open, least recently used
+        first out. Every lookup stats the file, a file that was replaced or changed is opened again.
+    """
+
+    def __init__(self, root, max_open=DEFAULT_MAX_OPEN_FILES):
+        self.root = os.path.realpath(root)
+        self.max_open = max_open
+        self._files = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, uri_path):
+        path = unquote(uri_path.partition('?')[0])
+        if '\0' in path:
+            return None
+        # Normalizing below a leading slash removes every '..' that would climb out of the root
+        relative = posixpath.normpath('/' + path).lstrip('/')
+        if not relative or relative == '.':
+            return None
+        # Symlinks below the root may point anywhere, what they resolve to has to be below the root as well
+        path = os.path.realpath(os.path.join(self.root, *relative.split('/')))
+        if os.path.commonpath([self.root, path]) != self.root:
+            return None
+        return path
+
+    def open(self, uri_path):
+        """Returns the LocalFile for a request path, or None when it does not name a regular file."""
+        path = self.resolve(uri_path)
+        if path is None:
+            return None
+        try:
+            file_stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+
+        local_file = self._files.get(path)
+        if local_file is not None and local_file.identity == _identity(file_stat):
+            self._files.move_to_end(path)
+            self.hits += 1
+            return local_file
+        if local_file is not None:
+            self._files.pop(path).close()
+
+        self.misses += 1
+        try:
+            local_file = LocalFile(path)
+        except (OSError, ValueError):
+            return None
+        self._files[path] = local_file
+        while len(self._files) > self.max_open:
+            self._files.popitem(last=False)[1].close()
+        return local_file
+
+    def stats(self):
+        return {
+            "open_files": len(self._files),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _identity(file_stat):
+    return file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
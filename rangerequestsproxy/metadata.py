@@ -0,0 +1,134 @@
+import calendar
+import collections
+import email.utils
+import time
+
+from rangerequestsproxy.cache import ObjectInfo
+from rangerequestsproxy.httprange import parse_content_range
+
+DEFAULT_TTL = 30
+DEFAULT_MAX_OBJECTS = 10000
+
+
+def object_info(code, headers, body_length=None):
+    """Builds the ObjectInfo described by an upstream response, None if it does not reveal the object size."""
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        # Lengths of encoded responses are not the object size
+        return None
+    size = None
+    if code == 200:
+        content_length = headers.get('Content-Length')
+        size = int(content_length) if content_length and content_length.isdigit() else body_length
+    elif code in (206, 416):
+        content_range = parse_content_range(headers.get('Content-Range'))
+        if content_range is not None:
+            size = content_range[2]
+        elif code == 416:
+            # 'bytes */size' carries no interval
+            unsatisfied = (headers.get('Content-Range') or '').partition('*/')[2]
+            size = int(unsatisfied) if unsatisfied.isdigit() else None
+    if size is None:
+        return None
+
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+    return ObjectInfo(validator=etag or last_modified or '',
+                      size=size,
+                      content_type=headers.get('Content-Type', 'application/octet-stream'),
+                      etag=etag,
+                      last_modified=last_modified)
+
+
+def parse_http_date(value):
+    parsed = email.utils.parsedate(value or '')
+    return calendar.timegm(parsed) if parsed else None
+
+
+def _entity_tags(header):
+    return [tag.strip() for tag in header.split(',') if tag.strip()]
+
+
+def _opaque_tag(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(headers, info):
+    """Evaluates If-None-Match, or If-Modified-Since without it, against the object; True means 304."""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        if not info.etag:
+            return False
+        tags = _entity_tags(if_none_match)
+        # Weak comparison, W/"x" and "x" match
+        return '*' in tags or _opaque_tag(info.etag) in [_opaque_tag(tag) for tag in tags]
+
+    since = parse_http_date(headers.get('If-Modified-Since'))
+    last_modified = parse_http_date(info.last_modified)
+    return since is not None and last_modified is not None and last_modified <= since
+
+
+def if_range_matches(if_range, info):
+    """True when the client's partial copy named by If-Range is still the current object, so Range applies."""
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Strong comparison, weak tags never match
+        return bool(info.etag) and not if_range.startswith('W/') and not info.etag.startswith('W/') \
+            and if_range == info.etag
+    date = parse_http_date(if_range)
+    return date is not None and date == parse_http_date(info.last_modified)
+
+
+class MetadataCache(object):
+    """
+        Size, validators and content type of upstream objects, learned from their responses and trusted for
+        ttl seconds. Enough to answer HEAD requests, conditional requests and unsatisfiable ranges locally.
+    """
+
+    def __init__(self, max_objects=DEFAULT_MAX_OBJECTS, ttl=DEFAULT_TTL):
+        self.max_objects = max_objects
+        self.ttl = ttl
+        self._objects = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        entry = self._objects.get(url)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            del self._objects[url]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._objects.move_to_end(url)
+        return entry[0]
+
+    def update(self, url, code, headers, body_length=None):
+        if code == 304:
+            entry = self._objects.get(url)
+            if entry is not None and (headers.get('ETag') or entry[0].etag) == entry[0].etag:
+                # Upstream confirmed the object did not change
+                self._objects[url] = (entry[0], time.time())
+            return
+
+        info = object_info(code, headers, body_length)
+        if info is None:
+            return
+        current = self._objects.get(url)
+        if code == 416 and not info.validator and current is not None and current[0].size == info.size:
+            # 416 responses rarely carry validators, keep the ones already known
+            info = current[0]
+        self._objects[url] = (info, time.time())
+        self._objects.move_to_end(url)
+        while len(self._objects) > self.max_objects:
+            self._objects.popitem(last=False)
+
+    def forget(self, url):
+        self._objects.pop(url, None)
+
+    def stats(self):
+        return {
+            "objects": len(self._objects),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
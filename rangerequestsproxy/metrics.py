@@ -0,0 +1,128 @@
+import bisect
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 1 KiB to 1 GiB in steps of 4
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Counter(object):
+    """Monotonic counter, optionally split by the value of one label (e.g. the status code)."""
+
+    type = 'counter'
+    __slots__ = ('name', 'documentation', 'label_name', '_values')
+
+    def __init__(self, name, documentation, label_name=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self._values = {}
+
+    def inc(self, label_value=None, amount=1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        return self._values.get(label_value, 0)
+
+    def samples(self):
+        for label_value, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+            labels = ((self.label_name, label_value),) if self.label_name else ()
+            yield self.name, labels, value
+
+
+class Histogram(object):
+    """
+        Histogram with fixed upper bounds. observe() only bumps preallocated slots, the cumulative bucket
+        counts of the text format are computed when the metric is rendered.
+    """
+
+    type = 'histogram'
+    __slots__ = ('name', 'documentation', 'buckets', '_counts', '_sum', '_count')
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # one slot per bucket plus one for values above the largest bound
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self._counts):
+            cumulative += count
+            yield self.name + '_bucket', (('le', _format_value(float(bound))),), cumulative
+        yield self.name + '_sum', (), self._sum
+        yield self.name + '_count', (), self._count
+
+
+class CallbackMetric(object):
+    """
+        Counter or gauge whose value is read from existing state when rendered, so it costs nothing on the
+        request path. collect() returns a number or, with a label_name, a dict of label value to number.
+    """
+
+    def __init__(self, name, documentation, collect, type='gauge', label_name=None):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.type = type
+        self.label_name = label_name
+
+    def samples(self):
+        values = self.collect()
+        if self.label_name is None:
+            yield self.name, (), values
+            return
+        for label_value, value in sorted(values.items()):
+            yield self.name, ((self.label_name, label_value),), value
+
+
+class Registry(object):
+    """Ordered set of metrics rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
@@ -1,29 +1,279 @@
 #!/usr/bin/env python
 
+import argparse
+import asyncio
+import collections
+import functools
+import hmac
 import json
 import os
-import random
-import re
-import sys
 import time
+import uuid
 
+import tornado.gen
 import tornado.httpclient
 import tornado.httpserver
 import tornado.httputil
 import tornado.ioloop
 import tornado.iostream
+import tornado.netutil
+import tornado.process
 import tornado.web
+from tornado.concurrent import Future, future_set_result_unless_cancelled
+from tornado.log import app_log
 
-from rangerequestsproxy.httprange import RangeNotSatisfiableException, parse_range
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - uvloop is an optional, faster event loop
+    uvloop = None
+
+from rangerequestsproxy.balancer import (DEFAULT_EJECTION_TIME, DEFAULT_MAX_EJECTION_TIME, DEFAULT_MAX_ERRORS,
+                                         Balancer, parse_upstreams)
+from rangerequestsproxy.cache import DEFAULT_BLOCK_SIZE, BlockCache, ObjectInfo
+from rangerequestsproxy.config import (DEFAULT_INTERVAL as DEFAULT_CONFIG_INTERVAL, ConfigError, ConfigFile,
+                                       parse_settings, read_file)
+from rangerequestsproxy.compression import (DEFAULT_CACHE_SIZE as DEFAULT_COMPRESSION_CACHE_SIZE,
+                                            DEFAULT_LEVEL as DEFAULT_COMPRESSION_LEVEL,
+                                            DEFAULT_MIN_SIZE as DEFAULT_COMPRESSION_MIN_SIZE,
+                                            DEFAULT_TYPES as DEFAULT_COMPRESSION_TYPES, CompressionPolicy,
+                                            variant_etag)
+from rangerequestsproxy.hedging import (DEFAULT_BUDGET_RATIO, DEFAULT_FIRST_BYTE_TIMEOUT, DEFAULT_HEDGE_PERCENTILE,
+                                        DEFAULT_MAX_RETRIES, DEFAULT_MIN_HEDGE_DELAY, HedgedFetch, HedgingPolicy)
+from rangerequestsproxy.httprange import (MAX_RANGES, WHOLE_OBJECT, RangeNotSatisfiableException, coalesce_ranges,
+                                          format_range, parse_content_range, parse_range_set, resolve_ranges)
+from rangerequestsproxy.inflight import InflightRegistry, slice_response
+from rangerequestsproxy.localfile import DEFAULT_MAX_OPEN_FILES, LocalFiles
+from rangerequestsproxy.metadata import (DEFAULT_MAX_OBJECTS, DEFAULT_TTL, MetadataCache, if_range_matches,
+                                         is_not_modified)
+from rangerequestsproxy.metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, LATENCY_BUCKETS, SIZE_BUCKETS,
+                                        CallbackMetric, Counter, Histogram, Registry)
+from rangerequestsproxy.readahead import DEFAULT_LOOKAHEAD_TIME, DEFAULT_MAX_WINDOW, Readahead
+from rangerequestsproxy.shaping import DEFAULT_BURST, DEFAULT_CHUNK_SIZE, Shaper
+from rangerequestsproxy.sharedstats import SharedCounters
+from rangerequestsproxy.split import DEFAULT_PARALLELISM, DEFAULT_PART_RETRIES, SplitFetch, SplitPolicy
+from rangerequestsproxy.upstream import (CONNECTION_ERROR, DEFAULT_DNS_CACHE_TIMEOUT, DEFAULT_IDLE_TIMEOUT,
+                                         DEFAULT_MAX_CLIENTS, DEFAULT_MAX_PER_UPSTREAM, DEFAULT_STALL_TIMEOUT,
+                                         UpstreamPool, claim_transfer, pause_transfer)
 
 
 __all__ = ['ProxyHandler', 'run_proxy']
-MAX_RANGE = 30
+CACHE_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_CACHE_SIZE', 0))
+CACHE_BLOCK_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_CACHE_BLOCK_SIZE', DEFAULT_BLOCK_SIZE))
+CACHE_DIR = os.environ.get('RANGE_REQUESTS_PROXY_CACHE_DIR', '')
+CACHE_DISK_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_CACHE_DISK_SIZE', 0))
+# Larger ranges bypass the cache so a single request cannot pull a whole object into memory
+CACHE_MAX_SPAN = int(os.environ.get('RANGE_REQUESTS_PROXY_CACHE_MAX_SPAN', 16 * 1024 * 1024))
+BLOCK_CACHE = BlockCache(CACHE_SIZE, CACHE_BLOCK_SIZE, CACHE_DIR, CACHE_DISK_SIZE) if CACHE_SIZE else None
+# Share one upstream fetch between concurrent requests for the same or overlapping ranges
+COALESCE = os.environ.get('RANGE_REQUESTS_PROXY_COALESCE', '1') == '1'
+# Seconds object sizes and validators learned from upstream responses are trusted to answer HEAD requests,
+# conditional requests and unsatisfiable ranges without asking the upstream, 0 disables the metadata cache
+METADATA_TTL = int(os.environ.get('RANGE_REQUESTS_PROXY_METADATA_TTL', DEFAULT_TTL))
+METADATA_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_METADATA_SIZE', DEFAULT_MAX_OBJECTS))
+METADATA = MetadataCache(METADATA_SIZE, METADATA_TTL) if METADATA_TTL else None
+# Memory for prefetched windows of sequential readers, 0 disables readahead. Requests for a window that is still
+# being fetched join that fetch, so readahead needs coalescing.
+READAHEAD_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_READAHEAD_SIZE', 0))
+READAHEAD_MAX_WINDOW = int(os.environ.get('RANGE_REQUESTS_PROXY_READAHEAD_MAX_WINDOW', DEFAULT_MAX_WINDOW))
+READAHEAD_TIME = float(os.environ.get('RANGE_REQUESTS_PROXY_READAHEAD_TIME', DEFAULT_LOOKAHEAD_TIME))
+READAHEAD = Readahead(READAHEAD_SIZE, READAHEAD_MAX_WINDOW, READAHEAD_TIME) if READAHEAD_SIZE and COALESCE else None
+UPSTREAM_MAX_CLIENTS = int(os.environ.get('RANGE_REQUESTS_PROXY_MAX_CLIENTS', DEFAULT_MAX_CLIENTS))
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('RANGE_REQUESTS_PROXY_MAX_CONNECTIONS_PER_UPSTREAM',
+                                              DEFAULT_MAX_PER_UPSTREAM))
+UPSTREAM_IDLE_TIMEOUT = int(os.environ.get('RANGE_REQUESTS_PROXY_UPSTREAM_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT))
+DNS_CACHE_TIMEOUT = int(os.environ.get('RANGE_REQUESTS_PROXY_DNS_CACHE_TIMEOUT', DEFAULT_DNS_CACHE_TIMEOUT))
+# random, least-outstanding, ewma or consistent-hash
+BALANCING_POLICY = os.environ.get('RANGE_REQUESTS_PROXY_BALANCING_POLICY', 'random')
+UPSTREAM_MAX_ERRORS = int(os.environ.get('RANGE_REQUESTS_PROXY_UPSTREAM_MAX_ERRORS', DEFAULT_MAX_ERRORS))
+UPSTREAM_EJECTION_TIME = int(os.environ.get('RANGE_REQUESTS_PROXY_UPSTREAM_EJECTION_TIME', DEFAULT_EJECTION_TIME))
+UPSTREAM_MAX_EJECTION_TIME = int(os.environ.get('RANGE_REQUESTS_PROXY_UPSTREAM_MAX_EJECTION_TIME',
+                                                DEFAULT_MAX_EJECTION_TIME))
+HEALTH_CHECK_PATH = os.environ.get('RANGE_REQUESTS_PROXY_HEALTH_CHECK_PATH', '')
+HEALTH_CHECK_INTERVAL = int(os.environ.get('RANGE_REQUESTS_PROXY_HEALTH_CHECK_INTERVAL', 10))
+# Upstream deadlines in seconds: connection setup, first response byte, receiving nothing (pauses for slow clients
+# excluded) and the whole request, which is off by default as it would also cut off long bodies that keep flowing
+CONNECT_TIMEOUT = float(os.environ.get('RANGE_REQUESTS_PROXY_CONNECT_TIMEOUT', 5))
+FIRST_BYTE_TIMEOUT = float(os.environ.get('RANGE_REQUESTS_PROXY_FIRST_BYTE_TIMEOUT', DEFAULT_FIRST_BYTE_TIMEOUT))
+STALL_TIMEOUT = int(os.environ.get('RANGE_REQUESTS_PROXY_STALL_TIMEOUT', DEFAULT_STALL_TIMEOUT))
+REQUEST_TIMEOUT = float(os.environ.get('RANGE_REQUESTS_PROXY_REQUEST_TIMEOUT', 0))
+# Send a second request to another upstream when the first one is slower than this percentile of first byte times
+HEDGE = os.environ.get('RANGE_REQUESTS_PROXY_HEDGE', '') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('RANGE_REQUESTS_PROXY_HEDGE_PERCENTILE', DEFAULT_HEDGE_PERCENTILE))
+MIN_HEDGE_DELAY = float(os.environ.get('RANGE_REQUESTS_PROXY_MIN_HEDGE_DELAY', DEFAULT_MIN_HEDGE_DELAY))
+MAX_RETRIES = int(os.environ.get('RANGE_REQUESTS_PROXY_MAX_RETRIES', DEFAULT_MAX_RETRIES))
+# Hedges and retries together may add at most this fraction of extra upstream requests
+RETRY_BUDGET_RATIO = float(os.environ.get('RANGE_REQUESTS_PROXY_RETRY_BUDGET_RATIO', DEFAULT_BUDGET_RATIO))
+# Request headers whose answer depends on the requesting client, forwarded as they are
+CONDITIONAL_HEADERS = ('If-Range', 'If-None-Match', 'If-Modified-Since')
+# Response headers that describe the upstream connection and must not be copied to the client one
+HOP_BY_HOP_HEADERS = frozenset(['Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization',
+                                'Te', 'Trailer', 'Transfer-Encoding', 'Upgrade'])
+MAX_RANGE = int(os.environ.get('RANGE_REQUESTS_PROXY_MAX_RANGES', MAX_RANGES))
+# Ranges of a multi-range request separated by at most this many bytes are fetched with a single upstream request
+MULTIPART_MAX_GAP = int(os.environ.get('RANGE_REQUESTS_PROXY_MULTIPART_MAX_GAP', 64 * 1024))
+# Ranges larger than this many bytes are fetched as parts of this size, spread over the upstreams and this many at
+# a time, then written to the client in order. 0 disables splitting.
+SPLIT_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_SPLIT_SIZE', 0))
+SPLIT_PARALLELISM = int(os.environ.get('RANGE_REQUESTS_PROXY_SPLIT_PARALLELISM', DEFAULT_PARALLELISM))
+SPLIT_RETRIES = int(os.environ.get('RANGE_REQUESTS_PROXY_SPLIT_RETRIES', DEFAULT_PART_RETRIES))
+SPLIT = SplitPolicy(SPLIT_SIZE, SPLIT_PARALLELISM, SPLIT_RETRIES) if SPLIT_SIZE else None
 PROXY_ADDRESS = os.environ.get('RANGE_REQUESTS_PROXY_ADDRESS', '')
-RANGE_REGEX = re.compile('bytes=(.*)-(.*)')
+# Serve files below this directory directly, paths that are no file there go upstream if an address is configured
+FILE_ROOT = os.environ.get('RANGE_REQUESTS_PROXY_FILE_ROOT', '')
+MAX_OPEN_FILES = int(os.environ.get('RANGE_REQUESTS_PROXY_MAX_OPEN_FILES', DEFAULT_MAX_OPEN_FILES))
+LOCAL_FILES = LocalFiles(FILE_ROOT, MAX_OPEN_FILES) if FILE_ROOT else None
+RATE_LIMIT = int(os.environ.get('RANGE_REQUESTS_PROXY_RATE_LIMIT', 0))
+CLIENT_RATE_LIMIT = int(os.environ.get('RANGE_REQUESTS_PROXY_CLIENT_RATE_LIMIT', 0))
+UPSTREAM_RATE_LIMIT = int(os.environ.get('RANGE_REQUESTS_PROXY_UPSTREAM_RATE_LIMIT', 0))
+RATE_BURST = int(os.environ.get('RANGE_REQUESTS_PROXY_RATE_BURST', DEFAULT_BURST))
+MAX_INFLIGHT_BYTES = int(os.environ.get('RANGE_REQUESTS_PROXY_MAX_INFLIGHT_BYTES', 0))
+SHAPING_CHUNK_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_SHAPING_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+SHAPER = (Shaper(RATE_LIMIT, CLIENT_RATE_LIMIT, UPSTREAM_RATE_LIMIT, RATE_BURST, MAX_INFLIGHT_BYTES, SHAPING_CHUNK_SIZE)
+          if RATE_LIMIT or CLIENT_RATE_LIMIT or UPSTREAM_RATE_LIMIT or MAX_INFLIGHT_BYTES else None)
+COMPRESS = os.environ.get('RANGE_REQUESTS_PROXY_COMPRESSION', '') == '1'
+COMPRESSION_LEVEL = int(os.environ.get('RANGE_REQUESTS_PROXY_COMPRESSION_LEVEL', DEFAULT_COMPRESSION_LEVEL))
+COMPRESSION_TYPES = os.environ.get('RANGE_REQUESTS_PROXY_COMPRESSION_TYPES', ','.join(DEFAULT_COMPRESSION_TYPES))
+COMPRESSION_MIN_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_COMPRESSION_MIN_SIZE', DEFAULT_COMPRESSION_MIN_SIZE))
+COMPRESSION_CACHE_SIZE = int(os.environ.get('RANGE_REQUESTS_PROXY_COMPRESSION_CACHE_SIZE',
+                                            DEFAULT_COMPRESSION_CACHE_SIZE))
+COMPRESSION = (CompressionPolicy(COMPRESSION_LEVEL, COMPRESSION_TYPES.split(','), COMPRESSION_MIN_SIZE,
+                                 COMPRESSION_CACHE_SIZE) if COMPRESS else None)
+# JSON file of reloadable settings, polled for changes every interval seconds and changed through /config
+CONFIG_FILE = os.environ.get('RANGE_REQUESTS_PROXY_CONFIG_FILE', '')
+CONFIG_INTERVAL = int(os.environ.get('RANGE_REQUESTS_PROXY_CONFIG_INTERVAL', DEFAULT_CONFIG_INTERVAL))
+# Bearer token /config wants for changes, without one only loopback clients may change settings
+ADMIN_TOKEN = os.environ.get('RANGE_REQUESTS_PROXY_ADMIN_TOKEN', '')
+# Module globals behind the settings in config.SETTINGS
+SETTING_GLOBALS = {
+    'address': 'PROXY_ADDRESS',
+    'balancing_policy': 'BALANCING_POLICY',
+    'upstream_max_errors': 'UPSTREAM_MAX_ERRORS',
+    'upstream_ejection_time': 'UPSTREAM_EJECTION_TIME',
+    'upstream_max_ejection_time': 'UPSTREAM_MAX_EJECTION_TIME',
+    'max_connections_per_upstream': 'UPSTREAM_MAX_CONNECTIONS',
+    'upstream_idle_timeout': 'UPSTREAM_IDLE_TIMEOUT',
+    'dns_cache_timeout': 'DNS_CACHE_TIMEOUT',
+    'connect_timeout': 'CONNECT_TIMEOUT',
+    'first_byte_timeout': 'FIRST_BYTE_TIMEOUT',
+    'stall_timeout': 'STALL_TIMEOUT',
+    'request_timeout': 'REQUEST_TIMEOUT',
+    'hedge': 'HEDGE',
+    'hedge_percentile': 'HEDGE_PERCENTILE',
+    'min_hedge_delay': 'MIN_HEDGE_DELAY',
+    'max_retries': 'MAX_RETRIES',
+    'retry_budget_ratio': 'RETRY_BUDGET_RATIO',
+    'max_ranges': 'MAX_RANGE',
+    'multipart_max_gap': 'MULTIPART_MAX_GAP',
+    'split_size': 'SPLIT_SIZE',
+    'split_parallelism': 'SPLIT_PARALLELISM',
+    'split_retries': 'SPLIT_RETRIES',
+    'streaming': 'STREAMING',
+    'stream_high_water_mark': 'STREAM_HIGH_WATER_MARK',
+    'readahead_size': 'READAHEAD_SIZE',
+    'readahead_max_window': 'READAHEAD_MAX_WINDOW',
+    'readahead_time': 'READAHEAD_TIME',
+    'cache_size': 'CACHE_SIZE',
+    'cache_disk_size': 'CACHE_DISK_SIZE',
+    'cache_max_span': 'CACHE_MAX_SPAN',
+    'metadata_ttl': 'METADATA_TTL',
+    'metadata_size': 'METADATA_SIZE',
+    'rate_limit': 'RATE_LIMIT',
+    'client_rate_limit': 'CLIENT_RATE_LIMIT',
+    'upstream_rate_limit': 'UPSTREAM_RATE_LIMIT',
+    'rate_burst': 'RATE_BURST',
+    'max_inflight_bytes': 'MAX_INFLIGHT_BYTES',
+    'shaping_chunk_size': 'SHAPING_CHUNK_SIZE',
+    'compression': 'COMPRESS',
+    'compression_level': 'COMPRESSION_LEVEL',
+    'compression_types': 'COMPRESSION_TYPES',
+    'compression_min_size': 'COMPRESSION_MIN_SIZE',
+    'compression_cache_size': 'COMPRESSION_CACHE_SIZE',
+}
 SERVICE_TEMPORARY_UNAVAILABLE = 'Service temporary unavailable: Please try again later.'
 START_TIME = int(round(time.time()))
+# Run on uvloop instead of the default asyncio event loop when it is installed
+UVLOOP = os.environ.get('RANGE_REQUESTS_PROXY_UVLOOP', '') == '1'
+STREAMING = os.environ.get('RANGE_REQUESTS_PROXY_STREAMING', '') == '1'
+STREAM_HIGH_WATER_MARK = int(os.environ.get('RANGE_REQUESTS_PROXY_STREAM_HIGH_WATER_MARK', 1024 * 1024))
 TOTAL_BYTES_TRANSFERRED = 0
+# Counters summed over all workers in multi-process mode, see run_proxy
+SHARED_COUNTER_NAMES = ('total_bytes_transferred', 'cache_hits', 'cache_misses', 'cache_hit_bytes', 'cache_miss_bytes',
+                        'cache_evictions', 'upstream_fetches', 'coalesced_requests')
+SHARED_COUNTERS = None
+BALANCER = Balancer(BALANCING_POLICY, UPSTREAM_MAX_ERRORS, UPSTREAM_EJECTION_TIME, UPSTREAM_MAX_EJECTION_TIME)
+HEDGING = HedgingPolicy(HEDGE, HEDGE_PERCENTILE, MIN_HEDGE_DELAY, MAX_RETRIES, FIRST_BYTE_TIMEOUT, RETRY_BUDGET_RATIO)
+INFLIGHT = InflightRegistry()
+UPSTREAM_POOL = UpstreamPool(UPSTREAM_MAX_CLIENTS, UPSTREAM_MAX_CONNECTIONS, UPSTREAM_IDLE_TIMEOUT, DNS_CACHE_TIMEOUT,
+                             STALL_TIMEOUT)
+# Metrics exposed on /metrics, in multi-process mode only bytes transferred are totals, the rest is per worker
+METRICS = Registry()
+RESPONSES = METRICS.register(Counter(
+    'range_requests_proxy_responses_total', 'Responses sent to clients by status code.', 'code'))
+REQUEST_DURATION = METRICS.register(Histogram(
+    'range_requests_proxy_request_duration_seconds', 'Time from receiving a request to finishing its response.',
+    LATENCY_BUCKETS))
+RESPONSE_SIZE = METRICS.register(Histogram(
+    'range_requests_proxy_response_size_bytes', 'Bytes sent to clients per response.', SIZE_BUCKETS))
+UPSTREAM_FIRST_BYTE = METRICS.register(Histogram(
+    'range_requests_proxy_upstream_first_byte_seconds', 'Time from sending an upstream request to its first byte.',
+    LATENCY_BUCKETS))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_upstream_in_flight', 'Upstream requests in flight.',
+    lambda: dict((address, state["outstanding"]) for address, state in BALANCER.stats()["upstreams"].items()),
+    label_name='upstream'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_bytes_transferred_total', 'Response body bytes sent to clients.',
+    lambda: _total_bytes_transferred(), type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_upstream_fetches_total', 'Upstream fetches started for coalescable requests.',
+    lambda: INFLIGHT.upstream_fetches, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_coalesced_requests_total', 'Requests answered from another request\'s upstream fetch.',
+    lambda: INFLIGHT.coalesced_requests, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_cache_hits_total', 'Cache blocks served from memory or disk.',
+    lambda: BLOCK_CACHE.hits if BLOCK_CACHE is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_cache_misses_total', 'Cache blocks fetched from upstream.',
+    lambda: BLOCK_CACHE.misses if BLOCK_CACHE is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_readahead_hits_total', 'Requests of sequential readers answered from prefetched windows.',
+    lambda: READAHEAD.hits if READAHEAD is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_readahead_misses_total', 'Requests of sequential readers that were not prefetched.',
+    lambda: READAHEAD.misses if READAHEAD is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_readahead_prefetched_bytes_total', 'Bytes prefetched for sequential readers.',
+    lambda: READAHEAD.prefetched_bytes if READAHEAD is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_readahead_wasted_bytes_total', 'Prefetched bytes dropped before they were read.',
+    lambda: READAHEAD.wasted_bytes if READAHEAD is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_hedges_total', 'Hedged upstream requests sent.',
+    lambda: HEDGING.hedges_fired, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_hedges_won_total', 'Hedged upstream requests that answered first.',
+    lambda: HEDGING.hedges_won, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_upstream_retries_total', 'Upstream requests retried after a connection failure or timeout.',
+    lambda: HEDGING.retries, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_split_parts_total', 'Upstream requests for parts of split ranges, retries included.',
+    lambda: SPLIT.parts if SPLIT is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_split_part_retries_total', 'Parts of split ranges fetched again after a failure.',
+    lambda: SPLIT.part_retries if SPLIT is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_compressed_responses_total', 'Whole-object responses sent compressed.',
+    lambda: COMPRESSION.responses if COMPRESSION is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_compression_cache_hits_total', 'Compressed responses answered from cached variants.',
+    lambda: COMPRESSION.cache_hits if COMPRESSION is not None else 0, type='counter'))
+METRICS.register(CallbackMetric(
+    'range_requests_proxy_uptime_seconds', 'Seconds since the proxy started.',
+    lambda: int(round(time.time())) - START_TIME))
 
 
 class RangeRequestProxyError(Exception):
@@ -35,26 +285,348 @@ class RangeRequestProxyError(Exception):
         self.code = code
 
 
+def _count_bytes_transferred(nbytes):
+    global TOTAL_BYTES_TRANSFERRED
+    TOTAL_BYTES_TRANSFERRED += nbytes
+    if SHARED_COUNTERS is not None:
+        SHARED_COUNTERS.publish('total_bytes_transferred', TOTAL_BYTES_TRANSFERRED)
+
+
+def _total_bytes_transferred():
+    if SHARED_COUNTERS is not None:
+        return SHARED_COUNTERS.total('total_bytes_transferred')
+    return TOTAL_BYTES_TRANSFERRED
+
+
+def current_settings():
+    """Reloadable settings in effect, see config.SETTINGS."""
+    module = globals()
+    return dict((name, module[global_name]) for name, global_name in SETTING_GLOBALS.items())
+
+
+# The environment's settings are the defaults, a setting removed from the config file goes back to its default
+CONFIG = (ConfigFile(CONFIG_FILE, lambda settings: apply_settings(settings), CONFIG_INTERVAL, current_settings())
+          if CONFIG_FILE else None)
+
+
+def apply_settings(settings):
+    """
+        Swaps in reloadable settings and returns the ones that changed. Nothing in here yields to the event loop,
+        so every request sees either the old or the new configuration, and a setting that fails validation
+        leaves all of them as they are.
+
+        The shaper, split and compression policies are replaced rather than changed, requests already running
+        finish with the ones they started with. Upstreams that are no longer listed get no new requests and are
+        forgotten once the requests already sent to them finished.
+    """
+    current = current_settings()
+    changed = dict((name, value) for name, value in parse_settings(settings).items() if current[name] != value)
+    if not changed:
+        return changed
+    new = dict(current, **changed)
+
+    # Everything that can fail happens before the first global changes
+    shaper, split, compression, block_cache = SHAPER, SPLIT, COMPRESSION, BLOCK_CACHE
+    if changed.keys() & {'rate_limit', 'client_rate_limit', 'upstream_rate_limit', 'rate_burst', 'max_inflight_bytes',
+                         'shaping_chunk_size'}:
+        shaper = (Shaper(new['rate_limit'], new['client_rate_limit'], new['upstream_rate_limit'], new['rate_burst'],
+                         new['max_inflight_bytes'], new['shaping_chunk_size'])
+                  if new['rate_limit'] or new['client_rate_limit'] or new['upstream_rate_limit'] or
+                  new['max_inflight_bytes'] else None)
+    if changed.keys() & {'split_size', 'split_parallelism', 'split_retries'}:
+        split = (SplitPolicy(new['split_size'], new['split_parallelism'], new['split_retries'])
+                 if new['split_size'] else None)
+    if changed.keys() & {'compression', 'compression_level', 'compression_types', 'compression_min_size',
+                         'compression_cache_size'}:
+        compression = (CompressionPolicy(new['compression_level'], new['compression_types'].split(','),
+                                         new['compression_min_size'], new['compression_cache_size'])
+                       if new['compression'] else None)
+    if not new['cache_size']:
+        block_cache = None
+    elif block_cache is None:
+        try:
+            block_cache = BlockCache(new['cache_size'], CACHE_BLOCK_SIZE, CACHE_DIR, new['cache_disk_size'])
+        except OSError as e:
+            raise ConfigError('Cannot create the cache: {}'.format(e))
+    else:
+        block_cache.resize(new['cache_size'], new['cache_disk_size'])
+
+    globals().update((SETTING_GLOBALS[name], value) for name, value in changed.items())
+    globals().update(SHAPER=shaper, SPLIT=split, COMPRESSION=compression, BLOCK_CACHE=block_cache)
+
+    global METADATA, READAHEAD
+    if not new['metadata_ttl']:
+        METADATA = None
+    elif METADATA is None:
+        METADATA = MetadataCache(new['metadata_size'], new['metadata_ttl'])
+    else:
+        METADATA.max_objects, METADATA.ttl = new['metadata_size'], new['metadata_ttl']
+    if not new['readahead_size'] or not COALESCE:
+        READAHEAD = None
+    elif READAHEAD is None:
+        READAHEAD = Readahead(new['readahead_size'], new['readahead_max_window'], new['readahead_time'])
+    else:
+        READAHEAD.max_memory = new['readahead_size']
+        READAHEAD.max_window = new['readahead_max_window']
+        READAHEAD.lookahead_time = new['readahead_time']
+
+    BALANCER.policy = new['balancing_policy']
+    BALANCER.max_errors = new['upstream_max_errors']
+    BALANCER.ejection_time = new['upstream_ejection_time']
+    BALANCER.max_ejection_time = new['upstream_max_ejection_time']
+    HEDGING.hedge = new['hedge']
+    HEDGING.hedge_percentile = new['hedge_percentile']
+    HEDGING.min_hedge_delay = new['min_hedge_delay']
+    HEDGING.max_retries = new['max_retries']
+    HEDGING.first_byte_timeout = new['first_byte_timeout']
+    HEDGING.budget_ratio = new['retry_budget_ratio']
+    UPSTREAM_POOL.reconfigure(new['max_connections_per_upstream'], new['upstream_idle_timeout'],
+                              new['dns_cache_timeout'], new['stall_timeout'])
+
+    if 'address' in changed:
+        upstreams = set(address for address, _ in parse_upstreams(new['address']))
+        for address in upstreams:
+            UPSTREAM_POOL.undrain(address)
+        for address, _ in parse_upstreams(current['address']):
+            if address not in upstreams:
+                UPSTREAM_POOL.drain(address).add_done_callback(functools.partial(_forget_upstream, address))
+    app_log.info('Configuration changed: %s', ', '.join(sorted(changed)))
+    return changed
+
+
+def _forget_upstream(address, drained):
+    if not drained.cancelled():
+        BALANCER.forget(address)
+
+
+def _publish_shared_counters():
+    if BLOCK_CACHE is not None:
+        SHARED_COUNTERS.publish('cache_hits', BLOCK_CACHE.hits)
+        SHARED_COUNTERS.publish('cache_misses', BLOCK_CACHE.misses)
+        SHARED_COUNTERS.publish('cache_hit_bytes', BLOCK_CACHE.hit_bytes)
+        SHARED_COUNTERS.publish('cache_miss_bytes', BLOCK_CACHE.miss_bytes)
+        SHARED_COUNTERS.publish('cache_evictions', BLOCK_CACHE.evictions)
+    SHARED_COUNTERS.publish('upstream_fetches', INFLIGHT.upstream_fetches)
+    SHARED_COUNTERS.publish('coalesced_requests', INFLIGHT.coalesced_requests)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    """Handlers that answer errors with a JSON object."""
+
+    def _set_error(self, code=500, message=''):
+        self.set_status(code)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.JSONEncoder().encode({
+            "error": message,
+        }))
+
+
 class StatsHandler(tornado.web.RequestHandler):
-    @tornado.web.asynchronous
     def get(self):
         self.set_status(200)
         self.set_header('Content-Type', 'application/json')
-        self.write(json.JSONEncoder().encode({
+        stats = {
             "total_bytes_transferred": TOTAL_BYTES_TRANSFERRED,
             "uptime_seconds": int(round(time.time())) - START_TIME  # TODO: format it nicely
-        }))
+        }
+        # Pool and balancer state are per process, in multi-process mode they describe the answering worker
+        stats["upstream_pool"] = UPSTREAM_POOL.stats()
+        stats["balancer"] = BALANCER.stats()
+        stats["hedging"] = HEDGING.stats()
+        if BLOCK_CACHE is not None:
+            stats["cache"] = BLOCK_CACHE.stats()
+        if READAHEAD is not None:
+            stats["readahead"] = READAHEAD.stats()
+        if LOCAL_FILES is not None:
+            stats["files"] = LOCAL_FILES.stats()
+        if METADATA is not None:
+            stats["metadata"] = METADATA.stats()
+        if SPLIT is not None:
+            stats["split"] = SPLIT.stats()
+        if SHAPER is not None:
+            stats["shaping"] = SHAPER.stats()
+        if COMPRESSION is not None:
+            stats["compression"] = COMPRESSION.stats()
+        if CONFIG is not None:
+            stats["config"] = CONFIG.stats()
+
+        if SHARED_COUNTERS is not None:
+            _publish_shared_counters()
+            totals = SHARED_COUNTERS.totals()
+            stats["total_bytes_transferred"] = totals["total_bytes_transferred"]
+            stats["workers"] = SHARED_COUNTERS.slots
+            stats["worker_id"] = SHARED_COUNTERS.slot
+            if BLOCK_CACHE is not None:
+                for name in ('hits', 'misses', 'hit_bytes', 'miss_bytes', 'evictions'):
+                    stats["cache"][name] = totals['cache_' + name]
+        self.write(json.JSONEncoder().encode(stats))
         self.finish()
 
 
-class ProxyHandler(tornado.web.RequestHandler):
-    SUPPORTED_METHODS = ['GET']
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.write(METRICS.render())
+
+
+class ConfigHandler(BaseHandler):
+    """
+        GET shows the reloadable settings in effect, PUT changes the ones in its JSON body and POST loads the
+        config file again. Changes need the admin token as bearer token, or a loopback client when there is none.
+        With a config file, PUT writes the changes into it so every worker process picks them up.
+    """
+    SUPPORTED_METHODS = ('GET', 'PUT', 'POST')
 
-    @tornado.web.asynchronous
     def get(self):
+        self._write_config()
+
+    def put(self):
+        if not self._authorized():
+            return
         try:
+            settings = parse_settings(json.loads(self.request.body.decode('utf-8')))
+            if CONFIG is not None:
+                CONFIG.update(settings)
+                CONFIG.load()
+            elif SHARED_COUNTERS is not None:
+                self._set_error(409, 'Worker processes share settings through a config file, '
+                                     'set RANGE_REQUESTS_PROXY_CONFIG_FILE')
+                return
+            else:
+                apply_settings(settings)
+        except ValueError as e:
+            # Invalid JSON and invalid settings alike, ConfigError is a ValueError
+            self._set_error(400, str(e))
+            return
+        self._write_config()
+
+    def post(self):
+        if not self._authorized():
+            return
+        if CONFIG is None:
+            self._set_error(409, 'No config file, set RANGE_REQUESTS_PROXY_CONFIG_FILE')
+            return
+        try:
+            CONFIG.load()
+        except ConfigError as e:
+            self._set_error(400, str(e))
+            return
+        self._write_config()
+
+    def _authorized(self):
+        if ADMIN_TOKEN:
+            authorized = hmac.compare_digest(self.request.headers.get('Authorization', '').encode('utf-8'),
+                                             'Bearer {}'.format(ADMIN_TOKEN).encode('utf-8'))
+        else:
+            authorized = self.request.remote_ip in ('127.0.0.1', '::1')
+        if not authorized:
+            self._set_error(403, 'Forbidden.')
+        return authorized
+
+    def _write_config(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.JSONEncoder().encode({
+            "settings": current_settings(),
+            "file": CONFIG.stats() if CONFIG is not None else None,
+        }))
+
+
+class ProxyHandler(BaseHandler):
+    SUPPORTED_METHODS = ['GET', 'HEAD']
+
+    def initialize(self):
+        self._client_gone = False
+        self._byte_ranges = None
+        self._upstream_start_line = None
+        self._upstream_headers = None
+        self._upstream_curl = None
+        self._upstream_paused = False
+        self._stream = None
+        self._task = None
+        self._stream_bytes_written = 0
+        self._stream_bytes_flushed = 0
+        self._response_bytes = 0
+        self._upstream_address = None
+        self._shaper = None
+        self._shaped_stream = None
+        self._shaped_chunks = collections.deque()
+        self._shaping_task = None
+        self._finish_requested = False
+        self._compression_decided = False
+        self._encoder = None
+
+    def flush(self, *args, **kwargs):
+        self._response_bytes += sum(len(chunk) for chunk in self._write_buffer)
+        return super(ProxyHandler, self).flush(*args, **kwargs)
+
+    def finish(self, *args, **kwargs):
+        if self.request.method == 'HEAD' and not self._headers_written:
+            # HEAD gets the headers of the GET, without a Content-Length when the body would be compressed
+            self._start_compression()
+            if 'Content-Length' not in self._headers:
+                self.flush()
+        if self._encoder is not None:
+            encoder, self._encoder = self._encoder, None
+            # A client that went away may have cut the body short, which must not end up as a cached variant
+            tail = encoder.finish(complete=not self._client_gone)
+            if tail:
+                self._write_body(tail)
+        if self._shaping_task is not None:
+            # Shaped body bytes are still queued, _send_shaped finishes the response once they are sent
+            self._finish_requested = True
+            return self._shaping_task
+        return super(ProxyHandler, self).finish(*args, **kwargs)
+
+    def on_finish(self):
+        if self._shaped_stream is not None:
+            self._shaper.close_stream(self._shaped_stream)
+        RESPONSES.inc(self.get_status())
+        REQUEST_DURATION.observe(self.request.request_time())
+        RESPONSE_SIZE.observe(self._response_bytes)
+
+    def on_connection_close(self):
+        self._client_gone = True
+        self._resume_upstream()
+        if self._task is not None:
+            # Whatever get() waits for is cancelled and stops its upstream fetch, see _wait_upstream
+            self._task.cancel()
+        if self._shaping_task is not None:
+            self._shaping_task.cancel()
+
+    async def get(self):
+        self._task = asyncio.current_task()
+        try:
+            if SHAPER is not None and not SHAPER.admit():
+                # Bodies buffered for other clients used up the memory budget, this one has to come back later
+                self.set_header('Retry-After', 1)
+                raise RangeRequestProxyError(code=503, message=SERVICE_TEMPORARY_UNAVAILABLE)
             headers = self._validate_request()
-            self._fetch_request(self.request.uri, self._handle_response_callback, body=None, headers=headers)
+            if LOCAL_FILES is not None and await self._serve_local_file():
+                return
+            if METADATA is not None and self._answer_from_metadata():
+                return
+            if (METADATA is None and BLOCK_CACHE is not None and
+                    self._answer_from_compressed_variant(BLOCK_CACHE.get_object(self._upstream_uri()))):
+                return
+            if self.request.method == 'HEAD' or any(header in self.request.headers for header in CONDITIONAL_HEADERS):
+                # The answer depends on this request's own headers, so it is neither shared nor stitched from blocks
+                await self._fetch_conditional(headers)
+                return
+            if len(self._byte_ranges) > 1:
+                await self._fetch_multipart(self._byte_ranges)
+                return
+
+            start, end = self._byte_ranges[0]
+            if READAHEAD is not None and start is not None and end is not None and self._fetch_readahead(start, end):
+                return
+            if BLOCK_CACHE is not None and start is not None and await self._fetch_cached(start, end):
+                return
+            if SPLIT is not None and await self._fetch_split(start, end):
+                return
+            if STREAMING:
+                await self._fetch_streaming(headers)
+            else:
+                self._handle_response(await self._fetch_coalesced(start, end))
         except RangeNotSatisfiableException as e:
             self._set_error(code=e.code, message=e.message)
             self.finish()
@@ -63,10 +635,17 @@ class ProxyHandler(tornado.web.RequestHandler):
             self.finish()
         except tornado.httpclient.HTTPError as e:
             if hasattr(e, 'response') and e.response:
-                self.handle_response(e.response)
+                self._handle_response(e.response)
             else:
                 self._set_error(code=500, message='Internal server error: ' + str(e))
                 self.finish()
+        except asyncio.CancelledError:
+            # The client went away, nobody is left to answer
+            pass
+        finally:
+            self._task = None
+
+    head = get
 
     def _validate_request(self):
         headers = {}
@@ -74,37 +653,304 @@ class ProxyHandler(tornado.web.RequestHandler):
         range_from_query = self.get_argument("range", None)
 
         if not range_from_header and not range_from_query:
-            headers['Range'] = 'bytes=0-'
+            self._byte_ranges = WHOLE_OBJECT
         elif range_from_header and not range_from_query:
-            _ = parse_range(range_from_header)
-            headers['Range'] = range_from_header
+            self._byte_ranges = parse_range_set(range_from_header, MAX_RANGE)
         elif not range_from_header and range_from_query:
-            _ = parse_range(range_from_query)
-            headers['Range'] = range_from_query
+            self._byte_ranges = parse_range_set(range_from_query, MAX_RANGE)
         else:
-            if parse_range(range_from_header) != parse_range(range_from_query):
+            self._byte_ranges = parse_range_set(range_from_header, MAX_RANGE)
+            if range_from_query != range_from_header and self._byte_ranges != parse_range_set(range_from_query,
+                                                                                              MAX_RANGE):
                 raise RangeNotSatisfiableException
-            headers['Range'] = range_from_header
+        headers['Range'] = self._byte_ranges.header
         return headers
 
-    def _fetch_request(self, url, callback, body=None, headers=None):
-        upstream_host = ProxyHandler._get_upstream_server_address(PROXY_ADDRESS)
-        if upstream_host:
-            tornado.httpclient.AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+    async def _serve_local_file(self):
+        local_file = LOCAL_FILES.open(self.request.path)
+        if local_file is None:
+            if PROXY_ADDRESS:
+                return False
+            self._set_error(code=404, message='Not found.')
+            self.finish()
+            return True
+
+        if self._answer_from_object_info(local_file.info):
+            return True
+        # A failed If-Range means the client's partial copy is outdated, it gets the whole file instead
+        ranged = self._range_requested() and self._if_range_applies(local_file.info)
+        ranges = (resolve_ranges(self._byte_ranges if ranged else [(0, None)], local_file.size)
+                  if local_file.size else [])
+
+        self._set_validator_headers(local_file.info)
+        self.set_header('Accept-Ranges', 'bytes')
+        # Byte strings go out as they are, (start, end) pairs are read from the file
+        parts = []
+        if not ranged:
+            self.set_status(200)
+            self.set_header('Content-Type', local_file.content_type)
+            parts.extend(ranges[:1])
+        elif len(ranges) == 1:
+            self.set_status(206)
+            self.set_header('Content-Type', local_file.content_type)
+            self.set_header('Content-Range', 'bytes {}-{}/{}'.format(ranges[0][0], ranges[0][1], local_file.size))
+            parts.append(ranges[0])
         else:
+            boundary = uuid.uuid4().hex
+            self.set_status(206)
+            self.set_header('Content-Type', 'multipart/byteranges; boundary={}'.format(boundary))
+            for start, end in ranges:
+                parts.append('--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                    boundary, local_file.content_type, start, end, local_file.size).encode('latin1'))
+                parts.append((start, end))
+                parts.append(b'\r\n')
+            parts.append('--{}--\r\n'.format(boundary).encode('latin1'))
+
+        length = sum(len(part) if isinstance(part, bytes) else part[1] - part[0] + 1 for part in parts)
+        self.set_header('Content-Length', length)
+        self._start_compression()
+        self.flush()
+        try:
+            for part in parts:
+                for chunk in (part,) if isinstance(part, bytes) else local_file.read(*part):
+                    # Only one chunk per response is in memory, the next is read once this one was sent
+                    future = self._write_body(chunk)
+                    await (future if future is not None else self.flush())
+                    _count_bytes_transferred(len(chunk))
+        except tornado.iostream.StreamClosedError:
+            return True
+        except (IOError, OSError) as e:
+            # Content-Length is on the wire already, dropping the connection is the only way to signal truncation
+            app_log.warning('Cannot send %s: %s', local_file.path, e)
+            self.request.connection.close()
+            return True
+        self.finish()
+        return True
+
+    def _answer_from_metadata(self):
+        info = METADATA.get(self._upstream_uri())
+        return info is not None and (self._answer_from_object_info(info) or self._answer_from_compressed_variant(info))
+
+    def _answer_from_compressed_variant(self, info):
+        # A variant cached for the object's current validator is sent without fetching the identity body again
+        if (info is None or not info.validator or self.request.method != 'GET' or
+                any(header in self.request.headers for header in CONDITIONAL_HEADERS)):
+            return False
+        encoding = self._variant_encoding(info)
+        body = COMPRESSION.cached(encoding, self._upstream_uri(), info.validator, info.size) if encoding else None
+        if body is None:
+            return False
+        self._compression_decided = True
+        self.set_status(200)
+        self.set_header('Content-Type', info.content_type)
+        self.set_header('Content-Encoding', encoding)
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('Accept-Ranges', 'bytes')
+        self._set_validator_headers(info)
+        if info.etag:
+            self.set_header('ETag', variant_etag(info.etag, encoding))
+        _count_bytes_transferred(len(body))
+        self._write_body(body)
+        self.finish()
+        return True
+
+    def _answer_from_object_info(self, info):
+        # Answers 304s, HEAD requests and unsatisfiable ranges from what is known about the object
+        encoding = self._variant_encoding(info)
+        if encoding and info.etag:
+            # Clients holding the compressed variant revalidate it with the variant's own entity tag
+            variant = info._replace(etag=variant_etag(info.etag, encoding))
+            if is_not_modified(self.request.headers, variant):
+                self.set_status(304)
+                self.set_header('Vary', 'Accept-Encoding')
+                self._set_validator_headers(variant)
+                self.finish()
+                return True
+        if is_not_modified(self.request.headers, info):
+            self.set_status(304)
+            self._set_validator_headers(info)
+            self.finish()
+            return True
+
+        if self.request.method == 'HEAD':
+            self.set_status(200)
+            self.set_header('Content-Type', info.content_type)
+            self.set_header('Content-Length', info.size)
+            self.set_header('Accept-Ranges', 'bytes')
+            self._set_validator_headers(info)
+            self.finish()
+            return True
+
+        if self._range_requested() and self._if_range_applies(info):
+            try:
+                resolve_ranges(self._byte_ranges, info.size)
+            except RangeNotSatisfiableException as e:
+                self.set_header('Content-Range', 'bytes */{}'.format(info.size))
+                self._set_error(code=e.code, message=e.message)
+                self.finish()
+                return True
+        return False
+
+    def _variant_encoding(self, info):
+        # Encoding of the compressed variant a whole GET or HEAD of the object would be answered with, if any
+        if (COMPRESSION is None or self.request.method not in ('GET', 'HEAD') or self._range_requested() or
+                not COMPRESSION.compressible(info.content_type) or info.size < COMPRESSION.min_size):
+            return None
+        return COMPRESSION.negotiate(self.request.headers.get('Accept-Encoding'))
+
+    async def _fetch_conditional(self, headers):
+        for header in CONDITIONAL_HEADERS:
+            if header in self.request.headers:
+                headers[header] = self.request.headers[header]
+        if not self._range_requested():
+            del headers['Range']
+
+        url = self._upstream_uri()
+        if STREAMING:
+            self._handle_streaming_response(await self._fetch_request(
+                url, body=None, headers=headers, header_callback=self._handle_upstream_header,
+                streaming_callback=self._handle_upstream_chunk))
+        else:
+            self._handle_response(await self._fetch_request(url, body=None, headers=headers))
+
+    def _range_requested(self):
+        return bool(self.request.headers.get('Range') or self.get_argument('range', None))
+
+    def _if_range_applies(self, info):
+        if_range = self.request.headers.get('If-Range')
+        return if_range is None or if_range_matches(if_range, info)
+
+    def _set_validator_headers(self, info):
+        if info.etag:
+            self.set_header('ETag', info.etag)
+        if info.last_modified:
+            self.set_header('Last-Modified', info.last_modified)
+
+    def _remember_object(self, code, headers, body_length=None):
+        if METADATA is not None:
+            METADATA.update(self._upstream_uri(), code, headers,
+                            body_length if self.request.method != 'HEAD' else None)
+
+    async def _fetch_coalesced(self, start, end, balance_key=None):
+        future = Future()
+        leave = self._start_coalesced(start, end, functools.partial(future_set_result_unless_cancelled, future),
+                                      balance_key)
+        return await self._wait_upstream(future, leave)
+
+    def _start_coalesced(self, start, end, callback, balance_key=None):
+        # Starts or joins the upstream fetch of start-end, the returned function withdraws callback from it again
+        url = self._upstream_uri()
+        headers = {'Range': 'bytes=' + format_range(start, end)}
+        if not COALESCE or start is None:
+            # Suffix ranges cannot be compared to other ranges before the object size is known
+            return self._start_request(url, callback, body=None, headers=headers, balance_key=balance_key).cancel
+
+        key = (self.request.method, url)
+        fetch = INFLIGHT.join(key, start, end, callback)
+        if fetch is None:
+            fetch = INFLIGHT.start(key, start, end, callback)
+            try:
+                fetch.upstream = self._start_request(url, functools.partial(INFLIGHT.complete, fetch), body=None,
+                                                     headers=headers, balance_key=balance_key)
+            except Exception:
+                INFLIGHT.discard(fetch)
+                raise
+        return functools.partial(INFLIGHT.leave, fetch, callback)
+
+    async def _fetch_streaming(self, headers):
+        url = self._upstream_uri()
+        future = Future()
+        callback = functools.partial(future_set_result_unless_cancelled, future)
+        if not COALESCE:
+            leave = self._start_request(url, callback, body=None, headers=headers,
+                                        header_callback=self._handle_upstream_header,
+                                        streaming_callback=self._handle_upstream_chunk).cancel
+        else:
+            key = (self.request.method, url, headers['Range'])
+            stream = INFLIGHT.join_stream(key, self._handle_upstream_header, self._handle_upstream_chunk, callback)
+            if stream is None:
+                stream = INFLIGHT.start_stream(key, self._handle_upstream_header, self._handle_upstream_chunk,
+                                               callback)
+                try:
+                    stream.upstream = self._start_request(url, functools.partial(INFLIGHT.complete_stream, stream),
+                                                          body=None, headers=headers, header_callback=stream.on_header,
+                                                          streaming_callback=stream.on_chunk,
+                                                          prepare_curl_callback=stream.prepare_curl)
+                except Exception:
+                    INFLIGHT.discard_stream(stream)
+                    raise
+            self._stream = stream
+            leave = functools.partial(INFLIGHT.leave_stream, stream, callback)
+        self._handle_streaming_response(await self._wait_upstream(future, leave))
+
+    async def _fetch_request(self, url, body=None, headers=None, header_callback=None, streaming_callback=None):
+        future = Future()
+        fetch = self._start_request(url, functools.partial(future_set_result_unless_cancelled, future), body=body,
+                                    headers=headers, header_callback=header_callback,
+                                    streaming_callback=streaming_callback)
+        return await self._wait_upstream(future, fetch.cancel)
+
+    async def _wait_upstream(self, future, cancel):
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # The client disconnected, this request stops waiting for the upstream and no longer wants it
+            cancel()
+            raise
+
+    def _start_request(self, url, callback, body=None, headers=None, header_callback=None, streaming_callback=None,
+                       balance_key=None, prepare_curl_callback=None):
+        def select_upstream(exclude):
+            return self._get_upstream_server_address(PROXY_ADDRESS, balance_key or url, exclude) or None
+
+        def send(attempt):
+            streaming_kwargs = {}
+            if streaming_callback is not None:
+                streaming_kwargs = dict(streaming_callback=attempt.on_chunk)
+
+            full_url = "{}{}".format(attempt.upstream, url)
+            self._upstream_address = attempt.upstream
+            # The header callback also runs in buffered mode, it marks the first byte for deadlines and hedging
+            req = tornado.httpclient.HTTPRequest(full_url,
+                                                 body=body,
+                                                 headers=headers,
+                                                 method=self.request.method,
+                                                 allow_nonstandard_methods=True,
+                                                 follow_redirects=False,
+                                                 # Encoded upstream bodies are passed through as they are
+                                                 decompress_response=False,
+                                                 connect_timeout=CONNECT_TIMEOUT,
+                                                 request_timeout=REQUEST_TIMEOUT,
+                                                 header_callback=attempt.on_header,
+                                                 prepare_curl_callback=attempt.prepare_curl,
+                                                 **streaming_kwargs)
+            tornado.ioloop.IOLoop.current().add_future(
+                tornado.gen.convert_yielded(UPSTREAM_POOL.fetch(attempt.upstream, req)),
+                lambda future: attempt.on_response(future.result()))
+
+        fetch = HedgedFetch(HEDGING, BALANCER, select_upstream, send, callback,
+                            header_callback=header_callback,
+                            streaming_callback=streaming_callback,
+                            prepare_curl_callback=prepare_curl_callback or (
+                                self._prepare_upstream_curl if streaming_callback else None),
+                            idempotent=self.request.method == 'GET',
+                            first_byte_callback=UPSTREAM_FIRST_BYTE.observe)
+        if not fetch.start():
             raise RangeRequestProxyError(code=500, message=SERVICE_TEMPORARY_UNAVAILABLE)
+        return fetch
 
-        full_url = "{}{}".format(upstream_host, url)
-        req = tornado.httpclient.HTTPRequest(full_url,
-                                             body=body,
-                                             headers=headers,
-                                             method=self.request.method,
-                                             allow_nonstandard_methods=True,
-                                             follow_redirects=False)
-        client = tornado.httpclient.AsyncHTTPClient()
-        client.fetch(req, callback, raise_error=False)
-
-    def _handle_response_callback(self, response):
+    def _handle_response(self, response):
+        self._remember_object(response.code, response.headers, len(response.body or b''))
+        self._remember_upstream(response)
+        if response.code in (304, 416) and not response.body:
+            self.set_status(response.code)
+            for header in ('Content-Range', 'ETag', 'Last-Modified', 'Cache-Control', 'Expires', 'Vary'):
+                if header in response.headers:
+                    self.set_header(header, response.headers[header])
+            if response.code == 416:
+                self._set_error(code=416, message=RangeNotSatisfiableException.message)
+            self.finish()
+            return
         if response.error and isinstance(response.error, tornado.httpclient.HTTPError):
             if response.body:
                 self.set_status(response.code)
@@ -123,43 +969,539 @@ class ProxyHandler(tornado.web.RequestHandler):
                     self.set_header(header, val)
 
                 if response.body:
-                    global TOTAL_BYTES_TRANSFERRED
                     total_bytes = len(response.body)
-                    TOTAL_BYTES_TRANSFERRED += total_bytes
+                    _count_bytes_transferred(total_bytes)
                     self.set_header('Content-Length', total_bytes)
                     self.set_header('Accept-Ranges', 'bytes')
-                    self.write(response.body)
+                    self._write_body(response.body)
             except Exception:
                 self._set_error(code=500, message=SERVICE_TEMPORARY_UNAVAILABLE)
         self.finish()
 
+    def _fetch_readahead(self, start, end):
+        key = (self.request.remote_ip, self._upstream_uri())
+        response = READAHEAD.lookup(key, start, end)
+        window = READAHEAD.next_window(key)
+        if window is not None:
+            window_start, window_end = window
+            try:
+                # The prefetch is shared through the readahead store and outlives this request
+                self._start_coalesced(window_start, window_end,
+                                      functools.partial(READAHEAD.store, key, window_start, window_end))
+            except RangeRequestProxyError:
+                READAHEAD.store(key, window_start, window_end, None)
+
+        if response is None:
+            return False
+        self._handle_response(response)
+        return True
+
+    async def _fetch_split(self, start, end):
+        # Returns False when the range is too small to be worth splitting
+        info = self._known_object()
+        size = info.size if info is not None else None
+        if start is None:
+            if size is None:
+                return False
+            start, end = max(size - end, 0), size - 1
+        elif size is not None:
+            if start >= size:
+                return False
+            end = size - 1 if end is None else min(end, size - 1)
+        if end is not None and end - start + 1 <= SPLIT.part_size:
+            return False
+
+        url = self._upstream_uri()
+        done = Future()
+        withdrawals = []
+
+        def fetch_part(part_start, part_end, callback):
+            # Parts of one object go to different upstreams, also under consistent hashing
+            withdrawals.append(self._start_coalesced(part_start, part_end, callback,
+                                                     balance_key='{}#{}'.format(url, part_start // SPLIT.part_size)))
+
+        split = SplitFetch(SPLIT, fetch_part, start, end, size, self._handle_split_header, self._handle_split_chunk,
+                           functools.partial(future_set_result_unless_cancelled, done))
+
+        def cancel():
+            split.cancel()
+            for leave in withdrawals:
+                leave()
+
+        split.start()
+        await self._handle_split_response(start, end, await self._wait_upstream(done, cancel))
+        return True
+
+    def _handle_split_header(self, response, start, end, size):
+        self._remember_object(response.code, response.headers)
+        self._remember_upstream(response)
+        if self._client_gone:
+            return
+        self.set_status(206)
+        for header, val in response.headers.get_all():
+            if header not in HOP_BY_HOP_HEADERS:
+                self.set_header(header, val)
+        self.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.set_header('Content-Length', end - start + 1)
+        self.set_header('Accept-Ranges', 'bytes')
+
+    def _handle_split_chunk(self, chunk):
+        if self._client_gone:
+            return None
+        _count_bytes_transferred(len(chunk))
+        future = self._write_body(chunk)
+        return future if future is not None else self.flush()
+
+    async def _handle_split_response(self, start, end, response):
+        if self._client_gone:
+            return
+        if not self._headers_written:
+            if response is None:
+                # The parts disagreed about the object before anything was sent, fetch the range as a whole
+                response = await self._fetch_coalesced(start, end)
+            self._handle_response(response)
+        elif response is not None:
+            # Status line is already on the wire, dropping the connection is the only way to signal truncation
+            self.request.connection.close()
+        else:
+            self.finish()
+
+    async def _fetch_cached(self, start, end):
+        # Returns False when the request has to bypass the cache and go straight to the upstream
+        url = self._upstream_uri()
+        info = BLOCK_CACHE.get_object(url)
+
+        if info is not None:
+            if start >= info.size:
+                return False
+            end = info.size - 1 if end is None else min(end, info.size - 1)
+        elif end is None:
+            return False
+
+        block_size = BLOCK_CACHE.block_size
+        first_block, last_block = start // block_size, end // block_size
+        if (last_block - first_block + 1) * block_size > CACHE_MAX_SPAN:
+            return False
+
+        missing = list(range(first_block, last_block + 1))
+        if info is not None:
+            missing = [index for index in missing if BLOCK_CACHE.get_block((url, info.validator), index) is None]
+            if not missing and self._write_cached_range(url, info, start, end, {}):
+                self.finish()
+                return True
+            missing = missing or list(range(first_block, last_block + 1))
+
+        response = await self._fetch_coalesced(missing[0] * block_size, (missing[-1] + 1) * block_size - 1)
+        await self._handle_block_response(url, info, start, end, response)
+        return True
+
+    async def _handle_block_response(self, url, expected_info, start, end, response):
+        self._remember_object(response.code, response.headers, len(response.body or b''))
+        if response.error or response.code not in (200, 206):
+            self._handle_response(response)
+            return
+
+        if response.code == 206:
+            content_range = parse_content_range(response.headers.get('Content-Range'))
+        else:
+            content_range = (0, len(response.body) - 1, len(response.body))
+        if content_range is None or content_range[2] is None or content_range[0] % BLOCK_CACHE.block_size:
+            self._handle_response(await self._fetch_coalesced(start, end))
+            return
+
+        span_start, _, size = content_range
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        info = ObjectInfo(validator=etag or last_modified or '',
+                          size=size,
+                          content_type=response.headers.get('Content-Type', 'application/octet-stream'),
+                          etag=etag,
+                          last_modified=last_modified)
+        end = size - 1 if end is None else min(end, size - 1)
+
+        blocks = self._split_blocks(span_start, response.body or b'', size)
+        if info.validator:
+            BLOCK_CACHE.set_object(url, info)
+            for index, data in blocks.items():
+                BLOCK_CACHE.put_block((url, info.validator), index, data)
+                BLOCK_CACHE.record_miss(len(data))
+        else:
+            BLOCK_CACHE.forget_object(url)
+
+        stale = expected_info is not None and expected_info.validator != info.validator
+        if stale or start >= size or not self._write_cached_range(url, info, start, end, blocks):
+            # Object changed underneath us or a block got evicted meanwhile, never stitch mismatched parts
+            self._handle_response(await self._fetch_coalesced(start, end))
+            return
+        self.finish()
+
+    def _split_blocks(self, span_start, body, size):
+        block_size = BLOCK_CACHE.block_size
+        blocks = {}
+        for offset in range(0, len(body), block_size):
+            data = body[offset:offset + block_size]
+            block_start = span_start + offset
+            # Trailing partial block is only complete if it ends the object
+            if len(data) == block_size or block_start + len(data) == size:
+                blocks[block_start // block_size] = data
+        return blocks
+
+    def _write_cached_range(self, url, info, start, end, fetched_blocks):
+        block_size = BLOCK_CACHE.block_size
+        parts = []
+        for index in range(start // block_size, end // block_size + 1):
+            data = fetched_blocks.get(index)
+            if data is None:
+                data = BLOCK_CACHE.get_block((url, info.validator), index) if info.validator else None
+                if data is None:
+                    return False
+                BLOCK_CACHE.record_hit(len(data))
+            parts.append(data)
+
+        offset = (start // block_size) * block_size
+        body = b''.join(parts)[start - offset:end - offset + 1]
+        if len(body) != end - start + 1:
+            return False
+
+        _count_bytes_transferred(len(body))
+        self.set_status(206)
+        self.set_header('Content-Type', info.content_type)
+        self.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, info.size))
+        self.set_header('Content-Length', len(body))
+        self.set_header('Accept-Ranges', 'bytes')
+        if info.etag:
+            self.set_header('ETag', info.etag)
+        if info.last_modified:
+            self.set_header('Last-Modified', info.last_modified)
+        self._write_body(body)
+        return True
+
+    async def _fetch_multipart(self, ranges):
+        # With a known size suffix and open-ended ranges become absolute and can be coalesced
+        info = self._known_object()
+        if info is not None:
+            ranges = resolve_ranges(ranges, info.size)
+            if len(ranges) == 1:
+                self._handle_response(await self._fetch_coalesced(ranges[0][0], ranges[0][1]))
+                return
+
+        # Sub-range fetches run in parallel, ranges close to each other share one upstream request
+        groups = coalesce_ranges(ranges, MULTIPART_MAX_GAP)
+        responses = await asyncio.gather(*[self._fetch_coalesced(group[0][0], group[-1][1]) for group in groups])
+
+        parts = []
+        for group, response in zip(groups, responses):
+            self._remember_object(response.code, response.headers, len(response.body or b''))
+            if response.code != 416 and (response.error or response.code not in (200, 206)):
+                self._handle_response(response)
+                return
+
+            for start, end in group:
+                if response.code == 416:
+                    part = response
+                else:
+                    part = response if start is None else slice_response(response, start, end)
+                # Unsatisfiable ranges are left out of the multipart response
+                if part.code == 206:
+                    parts.append(part)
+        self._write_multipart(parts)
+
+    def _write_multipart(self, parts):
+        if not parts:
+            self._set_error(code=RangeNotSatisfiableException.code, message=RangeNotSatisfiableException.message)
+            self.finish()
+            return
+        if len(parts) == 1:
+            self._handle_response(parts[0])
+            return
+
+        boundary = uuid.uuid4().hex
+        body = []
+        for part in parts:
+            body.append('--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+                boundary,
+                part.headers.get('Content-Type', 'application/octet-stream'),
+                part.headers.get('Content-Range')).encode('latin1'))
+            body.append(part.body or b'')
+            body.append(b'\r\n')
+        body.append('--{}--\r\n'.format(boundary).encode('latin1'))
+        body = b''.join(body)
+
+        _count_bytes_transferred(len(body))
+        self.set_status(206)
+        self.set_header('Content-Type', 'multipart/byteranges; boundary={}'.format(boundary))
+        self.set_header('Content-Length', len(body))
+        self.set_header('Accept-Ranges', 'bytes')
+        for header in ('ETag', 'Last-Modified'):
+            if header in parts[0].headers:
+                self.set_header(header, parts[0].headers[header])
+        self._remember_upstream(parts[0])
+        self._write_body(body)
+        self.finish()
+
+    def _known_object(self):
+        # What is known about the object without asking upstream, the metadata cache first
+        url = self._upstream_uri()
+        info = METADATA.get(url) if METADATA is not None else None
+        if info is None and BLOCK_CACHE is not None:
+            info = BLOCK_CACHE.get_object(url)
+        return info
+
+    def _upstream_uri(self):
+        # The range query argument is already folded into the Range header, keep it out of cache and inflight keys
+        path, _, query = self.request.uri.partition('?')
+        args = [(name, value) for name, value in parse_qsl(query, keep_blank_values=True) if name != 'range']
+        return '{}?{}'.format(path, urlencode(args)) if args else path
+
+    def _handle_upstream_header(self, header_line):
+        # Called once per upstream header line; the status line comes first and an empty line ends the block
+        if header_line.startswith('HTTP/'):
+            self._upstream_start_line = tornado.httputil.parse_response_start_line(header_line.strip())
+            self._upstream_headers = tornado.httputil.HTTPHeaders()
+        elif header_line.strip():
+            if self._upstream_headers is not None:
+                # Raw curl lines keep their line break, which Tornado 6 no longer strips from header values
+                self._upstream_headers.parse_line(header_line.rstrip())
+        elif self._upstream_start_line is not None and self._upstream_start_line.code != 100:
+            self._remember_object(self._upstream_start_line.code, self._upstream_headers)
+            if self._client_gone:
+                return
+            self.set_status(self._upstream_start_line.code, reason=self._upstream_start_line.reason)
+            for header, val in self._upstream_headers.get_all():
+                if header not in HOP_BY_HOP_HEADERS:
+                    self.set_header(header, val)
+            self.set_header('Accept-Ranges', 'bytes')
+            self._start_compression()
+            self._watch_flush(self.flush())
+
+    def _handle_upstream_chunk(self, chunk):
+        if self._client_gone:
+            return
+
+        _count_bytes_transferred(len(chunk))
+        self._stream_bytes_written += len(chunk)
+        future = self._write_body(chunk)
+        self._watch_flush(future if future is not None else self.flush())
+
+        if self._stream_bytes_written - self._stream_bytes_flushed >= STREAM_HIGH_WATER_MARK:
+            self._pause_upstream()
+
+    def _handle_streaming_response(self, response):
+        self._upstream_curl = None
+        if self._client_gone:
+            return
+        if not self._headers_written:
+            # Nothing was forwarded yet (connection error, no headers), so answer like the buffered mode does
+            self._handle_response(response)
+        elif self._stream_truncated(response):
+            # Status line is already on the wire, dropping the connection is the only way to signal truncation
+            self.request.connection.close()
+        else:
+            self.finish()
+
+    def _stream_truncated(self, response):
+        # Curl reports a body cut short as CurlError, an HTTPError with code 599
+        if response.code == CONNECTION_ERROR or (
+                response.error and not isinstance(response.error, tornado.httpclient.HTTPError)):
+            return True
+        if self.request.method == 'HEAD' or self._status_code in (204, 304):
+            return False
+        content_length = self._headers.get('Content-Length')
+        return bool(content_length and content_length.isdigit() and self._stream_bytes_written < int(content_length))
+
+    def _watch_flush(self, future):
+        written = self._stream_bytes_written
+
+        def on_flushed(f):
+            if f.exception() is not None:
+                return
+            self._stream_bytes_flushed = max(self._stream_bytes_flushed, written)
+            if self._stream_bytes_written - self._stream_bytes_flushed < STREAM_HIGH_WATER_MARK:
+                self._resume_upstream()
+
+        future.add_done_callback(on_flushed)
+
+    def _write_body(self, data, held=True):
+        # Without shaping data goes to the write buffer and None is returned. With shaping it is queued for
+        # _send_shaped, counted against the in-flight budget while held, and the future resolves once it is sent
+        self._start_compression()
+        if self._encoder is not None:
+            data = self._encoder.compress(data)
+            held = True
+            if not data:
+                return None
+        if SHAPER is None:
+            self.write(data)
+            return None
+        if self._shaped_stream is None:
+            self._shaper = SHAPER
+            self._shaped_stream = SHAPER.open_stream(self.request.remote_ip, self._upstream_address)
+        if held:
+            self._shaper.hold(self._shaped_stream, len(data))
+        future = Future()
+        self._shaped_chunks.append((data, held, future))
+        if self._shaping_task is None:
+            self._shaping_task = asyncio.ensure_future(self._send_shaped())
+        return future
+
+    def _start_compression(self):
+        # Decided once, right before the first body bytes, from the status and headers the response got so far.
+        # Only whole objects are compressed, ranges keep addressing the identity bytes, and bodies the upstream
+        # encoded already go out as they are
+        if self._compression_decided:
+            return
+        self._compression_decided = True
+        if COMPRESSION is None or self.request.method not in ('GET', 'HEAD') or self._range_requested():
+            return
+        if self._status_code == 206:
+            content_range = parse_content_range(self._headers.get('Content-Range'))
+            if content_range is None or content_range[2] is None or content_range[:2] != (0, content_range[2] - 1):
+                return
+            length = content_range[2]
+        elif self._status_code == 200:
+            length = self._headers.get('Content-Length')
+            length = int(length) if length and length.isdigit() else None
+        else:
+            return
+        if (self._headers.get('Content-Encoding', 'identity').lower() != 'identity' or
+                'no-transform' in self._headers.get('Cache-Control', '').lower() or
+                not COMPRESSION.compressible(self._headers.get('Content-Type')) or
+                (length is not None and length < COMPRESSION.min_size)):
+            return
+
+        vary = self._headers.get('Vary')
+        if not vary:
+            self.set_header('Vary', 'Accept-Encoding')
+        elif 'accept-encoding' not in vary.lower():
+            self.set_header('Vary', vary + ', Accept-Encoding')
+        encoding = COMPRESSION.negotiate(self.request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return
+        etag = self._headers.get('ETag')
+        if self.request.method == 'GET':
+            self._encoder = COMPRESSION.encoder(encoding, self._upstream_uri(),
+                                                etag or self._headers.get('Last-Modified'), length)
+        self.set_status(200)
+        self.set_header('Content-Encoding', encoding)
+        self.clear_header('Content-Range')
+        self.clear_header('Content-Length')
+        if etag:
+            self.set_header('ETag', variant_etag(etag, encoding))
+
+    async def _send_shaped(self):
+        shaper, stream = self._shaper, self._shaped_stream
+        try:
+            while self._shaped_chunks:
+                data, held, future = self._shaped_chunks[0]
+                view = memoryview(data)
+                for offset in range(0, len(view), shaper.chunk_size):
+                    chunk = view[offset:offset + shaper.chunk_size]
+                    await shaper.acquire(stream, len(chunk))
+                    if self._write_buffer or not self._headers_written:
+                        await self.flush()
+                    await self.request.connection.write(chunk)
+                    self._response_bytes += len(chunk)
+                    if held:
+                        shaper.release(stream, len(chunk))
+                self._shaped_chunks.popleft()
+                future_set_result_unless_cancelled(future, None)
+        except tornado.iostream.StreamClosedError:
+            # The client went away, what is still queued is released with the stream in on_finish
+            pass
+        finally:
+            self._shaping_task = None
+            if self._finish_requested and not self._finished:
+                super(ProxyHandler, self).finish()
+
+    def _remember_upstream(self, response):
+        # Per-upstream rate limits charge the upstream that answered, also when another request started the fetch
+        url = getattr(response, 'effective_url', None)
+        if isinstance(url, str) and '://' in url:
+            parts = urlsplit(url)
+            self._upstream_address = '{}://{}'.format(parts.scheme, parts.netloc)
+
+    def _prepare_upstream_curl(self, curl):
+        claim_transfer(curl, self)
+        self._upstream_curl = curl
+
+    def _pause_upstream(self):
+        if self._upstream_paused:
+            return
+        if self._stream is not None:
+            # A shared transfer is paused by its stream while any of the subscribers lags behind
+            self._upstream_paused = True
+            self._stream.pause(self)
+        else:
+            self._upstream_paused = pause_transfer(self._upstream_curl, self, True)
+
+    def _resume_upstream(self):
+        if not self._upstream_paused:
+            return
+        self._upstream_paused = False
+        if self._stream is not None:
+            self._stream.resume(self)
+        else:
+            pause_transfer(self._upstream_curl, self, False)
+
     @staticmethod
-    def _get_upstream_server_address(addresses):
+    def _get_upstream_server_address(addresses, key=None, exclude=()):
         # Override this method to insert custom logic for selecting upstream server
-        addresses_list = addresses.split(',')
-        return addresses_list[random.randint(0, len(addresses_list) - 1)] if addresses_list else None
-
-    def _set_error(self, code=500, message=''):
-        self.set_status(code)
-        self.set_header('Content-Type', 'application/json')
-        self.write(json.JSONEncoder().encode({
-            "error": message,
-        }))
+        return BALANCER.select(addresses, key, exclude)
 
 
-def run_proxy(port):
+def run_proxy(port, workers=1):
+    """
+        Starts the proxy on the given port. With workers other than 1 the listening socket is shared by
+        that many pre-forked processes (0 means one per CPU) and /stats reports totals for all of them.
+    """
     app = tornado.web.Application([
         (r"/stats", StatsHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/config", ConfigHandler),
         (r'.*', ProxyHandler),
     ])
-    app.listen(port)
-    ioloop = tornado.ioloop.IOLoop.instance()
-    ioloop.start()
+    if CONFIG is not None:
+        # A broken config file stops the proxy here, before workers are forked and load it themselves
+        parse_settings(read_file(CONFIG.path))
+    sockets = tornado.netutil.bind_sockets(port)
+    if workers != 1:
+        global SHARED_COUNTERS, CACHE_DIR, BLOCK_CACHE
+        SHARED_COUNTERS = SharedCounters(SHARED_COUNTER_NAMES, workers or tornado.process.cpu_count())
+        # The event loop, upstream client and timers must only be created after forking
+        SHARED_COUNTERS.use_slot(tornado.process.fork_processes(workers))
+        if CACHE_DIR:
+            # Spill files are named after the blocks they hold, so every worker needs a directory of its own
+            CACHE_DIR = os.path.join(CACHE_DIR, 'worker-{}'.format(SHARED_COUNTERS.slot))
+            if BLOCK_CACHE is not None:
+                BLOCK_CACHE = BlockCache(CACHE_SIZE, CACHE_BLOCK_SIZE, CACHE_DIR, CACHE_DISK_SIZE)
+
+    if UVLOOP and uvloop is None:
+        app_log.warning('RANGE_REQUESTS_PROXY_UVLOOP is set but uvloop is not installed, using asyncio')
+    run = uvloop.run if UVLOOP and uvloop is not None else asyncio.run
+    run(_serve(app, sockets))
+
+
+async def _serve(app, sockets):
+    if CONFIG is not None:
+        CONFIG.load()
+        CONFIG.start()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    if SHARED_COUNTERS is not None:
+        tornado.ioloop.PeriodicCallback(_publish_shared_counters, 1000).start()
+
+    UPSTREAM_POOL.configure()
+    if HEALTH_CHECK_PATH:
+        BALANCER.start_health_checks(lambda: PROXY_ADDRESS, HEALTH_CHECK_PATH, HEALTH_CHECK_INTERVAL)
+    await asyncio.Event().wait()
+
 
 if __name__ == '__main__':
-    port = 8000
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Asynchronous HTTP proxy for HTTP Range Requests')
+    parser.add_argument('port', type=int, nargs='?', default=8000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port, 0 starts one per CPU')
+    args = parser.parse_args()
 
-    print ("Starting Range Requests HTTP proxy on port %d" % port)
-    run_proxy(port)
+    print ("Starting Range Requests HTTP proxy on port %d" % args.port)
+    run_proxy(args.port, args.workers)
@@ -0,0 +1,204 @@
+import collections
+import time
+
+from rangerequestsproxy.httprange import parse_content_range
+from rangerequestsproxy.inflight import slice_response
+
+DEFAULT_MAX_WINDOW = 8 * 1024 * 1024
+DEFAULT_LOOKAHEAD_TIME = 2
+# Requests in a row that must each start where the previous one ended before prefetching starts
+MIN_SEQUENTIAL = 2
+IDLE_TIMEOUT = 30
+MAX_READERS = 10000
+# Weight of the newest sample in the consumption rate moving average
+RATE_ALPHA = 0.3
+
+
+class Buffer(object):
+    """Prefetched bytes start-end (inclusive) of one reader, served_until is the last byte handed out."""
+
+    __slots__ = ('start', 'end', 'response', 'size', 'served_until')
+
+    def __init__(self, start, end, response, served_until):
+        self.start = start
+        self.end = end
+        self.response = response
+        self.size = len(response.body or b'')
+        self.served_until = served_until
+
+
+class Reader(object):
+    """Access pattern of one client reading one url."""
+
+    def __init__(self, now):
+        self.next_offset = None
+        self.last_length = 0
+        self.last_seen = now
+        self.sequential = 0
+        self.rate = 0.0
+        self.size = None
+        self.prefetched_until = None
+        self.pending = []
+        self.buffers = []
+
+
+class Readahead(object):
+    """
+        Prefetches the next window of sequential readers.
+
+        A reader is a (client, url) pair. After MIN_SEQUENTIAL requests that each start where the previous one
+        ended, next_window() asks for the bytes the reader is expected to request within lookahead_time seconds,
+        judged by its consumption rate and bounded by max_window. Fetched windows are kept until they are read,
+        the reader seeks elsewhere or goes idle, and the buffers of least recently active readers are dropped
+        when max_memory would be exceeded. Bytes dropped before anybody read them are counted as wasted.
+    """
+
+    def __init__(self, max_memory, max_window=DEFAULT_MAX_WINDOW, lookahead_time=DEFAULT_LOOKAHEAD_TIME):
+        self.max_memory = max_memory
+        self.max_window = max_window
+        self.lookahead_time = lookahead_time
+        self._readers = collections.OrderedDict()
+        self._memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.prefetched_bytes = 0
+        self.wasted_bytes = 0
+
+    def lookup(self, key, start, end):
+        """Records a request for bytes start-end and returns it cut from a prefetched window, if there is one."""
+        now = time.time()
+        self._expire(now)
+        reader = self._readers.get(key)
+        if reader is None:
+            reader = self._readers[key] = Reader(now)
+            while len(self._readers) > MAX_READERS:
+                self._drop_reader(next(iter(self._readers)))
+        self._readers.move_to_end(key)
+
+        length = end - start + 1
+        if start == reader.next_offset:
+            reader.sequential += 1
+            elapsed = now - reader.last_seen
+            if elapsed > 0:
+                rate = length / elapsed
+                reader.rate = rate if not reader.rate else RATE_ALPHA * rate + (1 - RATE_ALPHA) * reader.rate
+        else:
+            reader.sequential = 0
+            reader.rate = 0.0
+            reader.prefetched_until = None
+        reader.next_offset = end + 1
+        reader.last_length = length
+        reader.last_seen = now
+
+        for buffer in list(reader.buffers):
+            if buffer.start <= start and end <= buffer.end:
+                self.hits += 1
+                buffer.served_until = max(buffer.served_until, end)
+                response = slice_response(buffer.response, start, end)
+                if buffer.served_until >= buffer.end:
+                    self._drop_buffer(reader, buffer)
+                return response
+            if buffer.end < start or buffer.start > end + self.max_window:
+                # Read past or seeked away from, the rest of it will not be asked for
+                self._drop_buffer(reader, buffer)
+
+        if any(pending_start <= start and end <= pending_end for pending_start, pending_end in reader.pending):
+            # The window is still being fetched, the request joins that upstream fetch
+            self.hits += 1
+        elif reader.sequential >= MIN_SEQUENTIAL:
+            self.misses += 1
+        return None
+
+    def next_window(self, key):
+        """Returns the (start, end) range to prefetch for the reader next, or None. store() must follow."""
+        reader = self._readers.get(key)
+        if reader is None or reader.sequential < MIN_SEQUENTIAL:
+            return None
+
+        window = int(min(max(reader.rate * self.lookahead_time, reader.last_length), self.max_window))
+        start = reader.next_offset
+        if reader.prefetched_until is not None:
+            start = max(start, reader.prefetched_until + 1)
+        if start - reader.next_offset >= window // 2:
+            # More than half a window is already buffered or on its way
+            return None
+        end = reader.next_offset + window - 1
+        if reader.size is not None:
+            end = min(end, reader.size - 1)
+        if start > end:
+            return None
+
+        length = end - start + 1
+        self._make_room(length, keep=reader)
+        if self._memory_bytes + length > self.max_memory:
+            return None
+        # Reserve the memory now so concurrent prefetches cannot overshoot the cap
+        self._memory_bytes += length
+        reader.prefetched_until = end
+        reader.pending.append((start, end))
+        self.prefetches += 1
+        return start, end
+
+    def store(self, key, start, end, response):
+        """Takes the upstream response for a range returned by next_window(), None if it could not be sent."""
+        self._memory_bytes -= end - start + 1
+        reader = self._readers.get(key)
+        if reader is None or (start, end) not in reader.pending:
+            return
+        reader.pending.remove((start, end))
+        if response is None or response.error or response.code != 206:
+            # Most likely past the end of the object, start over once the reader proves sequential again
+            reader.prefetched_until = None
+            return
+
+        content_range = parse_content_range(response.headers.get('Content-Range'))
+        if content_range is None:
+            return
+        fetched_start, fetched_end, reader.size = content_range
+        # Bytes the reader already got by joining the fetch while it was in flight are not waste
+        served_until = min(max(fetched_start - 1, reader.next_offset - 1), fetched_end)
+        buffer = Buffer(fetched_start, fetched_end, response, served_until)
+        self.prefetched_bytes += buffer.size
+        if served_until >= fetched_end:
+            return
+        self._make_room(buffer.size, keep=reader)
+        reader.buffers.append(buffer)
+        self._memory_bytes += buffer.size
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetches": self.prefetches,
+            "prefetched_bytes": self.prefetched_bytes,
+            "wasted_bytes": self.wasted_bytes,
+            "memory_bytes": self._memory_bytes,
+            "readers": len(self._readers),
+        }
+
+    def _make_room(self, nbytes, keep):
+        for key in list(self._readers):
+            if self._memory_bytes + nbytes <= self.max_memory:
+                return
+            reader = self._readers[key]
+            if reader is not keep:
+                for buffer in list(reader.buffers):
+                    self._drop_buffer(reader, buffer)
+
+    def _expire(self, now):
+        while self._readers:
+            key, reader = next(iter(self._readers.items()))
+            if now - reader.last_seen <= IDLE_TIMEOUT:
+                return
+            self._drop_reader(key)
+
+    def _drop_reader(self, key):
+        reader = self._readers.pop(key)
+        for buffer in list(reader.buffers):
+            self._drop_buffer(reader, buffer)
+
+    def _drop_buffer(self, reader, buffer):
+        reader.buffers.remove(buffer)
+        self._memory_bytes -= buffer.size
+        self.wasted_bytes += max(buffer.end - buffer.served_until, 0)
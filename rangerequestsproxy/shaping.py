@@ -0,0 +1,183 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+
+import tornado.ioloop
+from tornado.concurrent import Future
+
+DEFAULT_BURST = 256 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class TokenBucket(object):
+    """
+        Refills rate tokens, one per byte, every second up to burst. Taking more tokens than the bucket holds
+        leaves it in debt, which has to be paid back before the next take is granted, so chunks never have to be
+        cut to fit the burst.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until the bucket is out of debt."""
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def take(self, nbytes, now):
+        """Takes nbytes tokens and returns the seconds to wait before sending them."""
+        self.delay(now)
+        self.tokens -= nbytes
+        return self.delay(now)
+
+
+class Stream(object):
+    """Body bytes of one response on their way to client, served from upstream (None when not proxied)."""
+
+    __slots__ = ('client', 'upstream', 'finish_tag', 'held_bytes', 'closed')
+
+    def __init__(self, client, upstream):
+        self.client = client
+        self.upstream = upstream
+        self.finish_tag = 0.0
+        self.held_bytes = 0
+        self.closed = False
+
+
+class Shaper(object):
+    """
+        Paces response bodies with token buckets: one for all bytes sent to clients, one per client address and
+        one per upstream the bytes came from. A rate of 0 leaves that kind of bucket out.
+
+        Streams wait for their client and upstream buckets first and then queue for the global one, which is
+        handed out by self-clocked weighted fair queuing: every chunk is tagged with its stream's previous tag
+        (or the virtual time of the chunk last sent, whichever is later) plus its size divided by the stream's
+        weight, and the smallest tag goes next. The streams of one client share a weight of 1, so opening more
+        connections does not buy a client a larger share.
+
+        Held bytes are response bodies buffered in memory until they are sent. Once they reach
+        max_inflight_bytes, admit() turns new requests away instead of letting memory grow without bound.
+    """
+
+    def __init__(self, rate=0, client_rate=0, upstream_rate=0, burst=DEFAULT_BURST, max_inflight_bytes=0,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.upstream_rate = upstream_rate
+        self.burst = burst
+        self.max_inflight_bytes = max_inflight_bytes
+        self.chunk_size = chunk_size
+        self._bucket = TokenBucket(rate, burst, time.time()) if rate else None
+        self._client_buckets = {}
+        self._upstream_buckets = {}
+        self._client_streams = collections.Counter()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._timer = None
+        self.inflight_bytes = 0
+        self.streams = 0
+        self.bytes_sent = 0
+        self.rejected_requests = 0
+
+    def admit(self):
+        """False when buffered bodies used up the in-flight budget and a new request should be turned away."""
+        if self.max_inflight_bytes and self.inflight_bytes >= self.max_inflight_bytes:
+            self.rejected_requests += 1
+            return False
+        return True
+
+    def open_stream(self, client, upstream=None):
+        self.streams += 1
+        self._client_streams[client] += 1
+        if self.client_rate and client not in self._client_buckets:
+            self._client_buckets[client] = TokenBucket(self.client_rate, self.burst, time.time())
+        return Stream(client, upstream)
+
+    def close_stream(self, stream):
+        if stream.closed:
+            return
+        stream.closed = True
+        self.release(stream, stream.held_bytes)
+        self.streams -= 1
+        self._client_streams[stream.client] -= 1
+        if self._client_streams[stream.client] <= 0:
+            del self._client_streams[stream.client]
+            self._client_buckets.pop(stream.client, None)
+
+    def hold(self, stream, nbytes):
+        stream.held_bytes += nbytes
+        self.inflight_bytes += nbytes
+
+    def release(self, stream, nbytes):
+        stream.held_bytes -= nbytes
+        self.inflight_bytes -= nbytes
+
+    async def acquire(self, stream, nbytes):
+        """Waits until stream may send its next nbytes."""
+        now = time.time()
+        delay = 0
+        bucket = self._client_buckets.get(stream.client)
+        if bucket is not None:
+            delay = bucket.take(nbytes, now)
+        if self.upstream_rate and stream.upstream is not None:
+            bucket = self._upstream_buckets.get(stream.upstream)
+            if bucket is None:
+                bucket = self._upstream_buckets[stream.upstream] = TokenBucket(self.upstream_rate, self.burst, now)
+            delay = max(delay, bucket.take(nbytes, now))
+        if delay:
+            await asyncio.sleep(delay)
+        if self._bucket is not None:
+            await self._enqueue(stream, nbytes)
+        self.bytes_sent += nbytes
+
+    def _enqueue(self, stream, nbytes):
+        weight = 1.0 / max(self._client_streams[stream.client], 1)
+        stream.finish_tag = max(stream.finish_tag, self._virtual_time) + nbytes / weight
+        future = Future()
+        heapq.heappush(self._queue, (stream.finish_tag, next(self._sequence), nbytes, future))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        now = time.time()
+        while self._queue:
+            finish_tag, _, nbytes, future = self._queue[0]
+            if future.done():
+                # The waiter was cancelled, its client went away
+                heapq.heappop(self._queue)
+                continue
+            delay = self._bucket.delay(now)
+            if delay:
+                if self._timer is None:
+                    self._timer = tornado.ioloop.IOLoop.current().call_later(delay, self._on_timer)
+                return
+            heapq.heappop(self._queue)
+            self._bucket.take(nbytes, now)
+            self._virtual_time = finish_tag
+            future.set_result(None)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "client_rate": self.client_rate,
+            "upstream_rate": self.upstream_rate,
+            "max_inflight_bytes": self.max_inflight_bytes,
+            "inflight_bytes": self.inflight_bytes,
+            "streams": self.streams,
+            "queued_chunks": len(self._queue),
+            "bytes_sent": self.bytes_sent,
+            "rejected_requests": self.rejected_requests,
+        }
@@ -0,0 +1,51 @@
+import mmap
+import struct
+
+COUNTER = struct.Struct('q')
+
+
+class SharedCounters(object):
+    """
+        Block of 64-bit counters in anonymous shared memory, to be created before forking workers.
+
+        Every worker owns one slot and only ever writes to it, readers sum the slots of all workers,
+        so no locking is needed. Workers publish their running counts, which only ever add to the slot: a
+        worker restarted into the slot of a dead one carries on from there, so totals never go backwards.
+    """
+
+    def __init__(self, names, slots):
+        self.names = tuple(names)
+        self.slots = slots
+        self.slot = 0
+        self._offsets = dict((name, index * COUNTER.size) for index, name in enumerate(self.names))
+        self._slot_size = COUNTER.size * len(self.names)
+        self._memory = mmap.mmap(-1, self._slot_size * slots)
+        self._published = {}
+
+    def use_slot(self, slot):
+        if not 0 <= slot < self.slots:
+            raise ValueError('Slot {} out of range, only {} slots available'.format(slot, self.slots))
+        self.slot = slot
+        self._published = {}
+
+    def publish(self, name, value):
+        """Adds what a local counter grew since it was last published, a counter that started over counts anew."""
+        published = self._published.get(name, 0)
+        self._published[name] = value
+        self.add(name, value - published if value >= published else value)
+
+    def set(self, name, value):
+        COUNTER.pack_into(self._memory, self.slot * self._slot_size + self._offsets[name], int(value))
+
+    def get(self, name, slot=None):
+        slot = self.slot if slot is None else slot
+        return COUNTER.unpack_from(self._memory, slot * self._slot_size + self._offsets[name])[0]
+
+    def add(self, name, value):
+        self.set(name, self.get(name) + value)
+
+    def total(self, name):
+        return sum(self.get(name, slot) for slot in range(self.slots))
+
+    def totals(self):
+        return dict((name, self.total(name)) for name in self.names)
@@ -0,0 +1,198 @@
+import collections
+
+import tornado.httpclient
+
+from rangerequestsproxy.httprange import parse_content_range
+from rangerequestsproxy.upstream import CONNECTION_ERROR
+
+DEFAULT_PART_SIZE = 4 * 1024 * 1024
+DEFAULT_PARALLELISM = 4
+DEFAULT_PART_RETRIES = 2
+
+
+def split_range(start, end, part_size):
+    """Cuts bytes start-end (inclusive) into parts whose boundaries are multiples of part_size."""
+    parts = []
+    while start <= end:
+        part_end = min((start // part_size + 1) * part_size - 1, end)
+        parts.append((start, part_end))
+        start = part_end + 1
+    return parts
+
+
+def _validator(response):
+    return response.headers.get('ETag') or response.headers.get('Last-Modified') or ''
+
+
+class SplitPolicy(object):
+    """
+        Settings and counters for large ranges fetched as parallel sub-range requests.
+
+        Parts are aligned to part_size so concurrent clients of the same object ask for identical parts and
+        share them through the inflight registry, whatever ranges they requested themselves.
+    """
+
+    def __init__(self, part_size=DEFAULT_PART_SIZE, parallelism=DEFAULT_PARALLELISM, max_retries=DEFAULT_PART_RETRIES):
+        self.part_size = part_size
+        self.parallelism = parallelism
+        self.max_retries = max_retries
+        self.split_requests = 0
+        self.parts = 0
+        self.part_retries = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            "part_size": self.part_size,
+            "parallelism": self.parallelism,
+            "split_requests": self.split_requests,
+            "parts": self.parts,
+            "part_retries": self.part_retries,
+            "failures": self.failures,
+        }
+
+
+class SplitFetch(object):
+    """
+        Fetches bytes start-end (end None means up to the end of the object) as aligned parts, at most
+        parallelism of them at a time, and hands their bodies to chunk_callback in order.
+
+        Parts that arrive ahead of the next one to write wait in a reorder buffer. A part is only requested
+        once fewer than parallelism parts are in flight or buffered, so the buffer never holds more than
+        parallelism parts, and a chunk_callback returning a future (the client flush) holds the next parts
+        back until the client caught up. Failed parts are fetched again up to max_retries times.
+
+        Without a known size only the first part is requested, its Content-Range tells how many parts follow.
+        header_callback(response, start, end, size) runs right before the first body is handed over, with the
+        first part's response for its headers. callback(response) runs once at the end: with None when every
+        part was written, otherwise with the response that ended the transfer. When nothing was written yet
+        that is the answer for the client (an error or the first part that could not be split), None then
+        means the parts did not describe the same object and the range should be fetched as a whole.
+    """
+
+    def __init__(self, policy, fetch_part, start, end, size, header_callback, chunk_callback, callback):
+        self.policy = policy
+        self.fetch_part = fetch_part
+        self.header_callback = header_callback
+        self.chunk_callback = chunk_callback
+        self.callback = callback
+        self._start = start
+        self._end = end
+        self._size = size
+        self._validator = None
+        if size is not None:
+            self._parts = split_range(start, end, policy.part_size)
+        else:
+            first_end = (start // policy.part_size + 1) * policy.part_size - 1
+            self._parts = [(start, first_end if end is None else min(first_end, end))]
+        self._first_response = None
+        self._bodies = {}
+        self._retries = collections.Counter()
+        self._next_fetch = 0
+        self._next_write = 0
+        self._draining = False
+        self._flushing = False
+        self._header_sent = False
+        self._done = False
+
+    def start(self):
+        self.policy.split_requests += 1
+        self._fill()
+
+    def cancel(self):
+        self._done = True
+        self._bodies.clear()
+
+    def _fill(self):
+        while (not self._done and self._next_fetch < len(self._parts) and
+               self._next_fetch - self._next_write < self.policy.parallelism):
+            index = self._next_fetch
+            self._next_fetch += 1
+            self._fetch(index)
+
+    def _fetch(self, index):
+        start, end = self._parts[index]
+        self.policy.parts += 1
+        try:
+            self.fetch_part(start, end, lambda response: self._on_part(index, response))
+        except Exception as e:
+            # No upstream to ask, handled like a connection failure
+            self._on_part(index, tornado.httpclient.HTTPResponse(None, CONNECTION_ERROR, error=e))
+
+    def _on_part(self, index, response):
+        if self._done:
+            return
+        if (response.error and (response.code == CONNECTION_ERROR or response.code >= 500) and
+                self._retries[index] < self.policy.max_retries):
+            self._retries[index] += 1
+            self.policy.part_retries += 1
+            self._fetch(index)
+            return
+
+        content_range = None
+        if not response.error and response.code == 206:
+            content_range = parse_content_range(response.headers.get('Content-Range'))
+
+        if self._size is None:
+            # Only the first part is in flight, its answer decides whether there is anything to split
+            first_start, first_end = self._parts[0]
+            if content_range is None or content_range[2] is None or content_range[0] != first_start:
+                self._finish(response)
+                return
+            size = content_range[2]
+            end = size - 1 if self._end is None else min(self._end, size - 1)
+            if end <= content_range[1]:
+                self._finish(response)
+                return
+            self._size, self._end = size, end
+            self._parts.extend(split_range(first_end + 1, end, self.policy.part_size))
+
+        start, end = self._parts[index]
+        if content_range != (start, end, self._size) or self._validator not in (None, _validator(response)):
+            self.policy.failures += 1
+            if not self._header_sent and (content_range is not None or response.code in (200, 416)):
+                # The object is not the one the other parts came from, never stitch mismatched parts
+                response = None
+            self._finish(response)
+            return
+        self._validator = _validator(response)
+        if index == 0:
+            self._first_response = response
+        self._bodies[index] = response.body
+        self._fill()
+        self._drain()
+
+    def _drain(self):
+        if self._draining:
+            # Parts fetched synchronously from within the loop below are picked up by it
+            return
+        self._draining = True
+        try:
+            while not self._done and not self._flushing:
+                if self._next_write == len(self._parts):
+                    self._finish(None)
+                    break
+                body = self._bodies.pop(self._next_write, None)
+                if body is None:
+                    break
+                if not self._header_sent:
+                    self._header_sent = True
+                    self.header_callback(self._first_response, self._start, self._end, self._size)
+                self._next_write += 1
+                future = self.chunk_callback(body)
+                self._fill()
+                if future is not None and not future.done():
+                    self._flushing = True
+                    future.add_done_callback(self._on_flushed)
+        finally:
+            self._draining = False
+
+    def _on_flushed(self, future):
+        self._flushing = False
+        self._fill()
+        self._drain()
+
+    def _finish(self, response):
+        self._done = True
+        self._bodies.clear()
+        self.callback(response)
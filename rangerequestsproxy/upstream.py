@@ -0,0 +1,213 @@
+import asyncio
+import collections
+import functools
+import time
+
+import tornado.httpclient
+from tornado.concurrent import Future
+
+try:
+    import pycurl
+except ImportError:  # pragma: no cover - pycurl is only needed to tune curl handles
+    pycurl = None
+
+CURL_HTTP_CLIENT = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+DEFAULT_MAX_CLIENTS = 100
+DEFAULT_MAX_PER_UPSTREAM = 32
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_DNS_CACHE_TIMEOUT = 300
+DEFAULT_STALL_TIMEOUT = 10
+# Status code curl and tornado use for failures without an HTTP response
+CONNECTION_ERROR = 599
+
+
+def claim_transfer(curl, owner):
+    # Curl handles are pooled, remember who owns this one so a stale owner never pauses somebody else
+    curl.range_proxy_owner = owner
+
+
+def pause_transfer(curl, owner, paused):
+    """Pauses or resumes receiving on curl if owner still owns the handle, True when that worked."""
+    if pycurl is None or curl is None or getattr(curl, 'range_proxy_owner', None) is not owner:
+        return False
+    try:
+        curl.pause(pycurl.PAUSE_RECV if paused else pycurl.PAUSE_CONT)
+    except pycurl.error:
+        # Chunks are delivered through the IOLoop, the transfer may have ended in the meantime
+        return False
+    return True
+
+
+def reset_progress(curl):
+    """Turns off the progress function a previous request may have left on a reused curl handle."""
+    curl.setopt(pycurl.NOPROGRESS, 1)
+    curl.unsetopt(pycurl.XFERINFOFUNCTION)
+
+
+class UpstreamPool(object):
+    """
+        Shared upstream HTTP client with per-upstream connection limits.
+
+        The curl client is configured once (max_clients, keep-alive, idle timeout, shared DNS cache) and
+        transfers that received nothing for stall_timeout seconds are given up, paused ones excepted. Unlike a
+        deadline for the whole request this never cuts off a long body that keeps flowing.
+        every upstream gets at most max_per_upstream concurrent requests, the rest wait in a FIFO queue and a
+        finishing request hands its slot straight to the first of them.
+        Curl keeps finished connections open for reuse, the idle count estimates how many of those are
+        still warm: the peak concurrency seen within the idle timeout minus the active requests.
+        Upstreams taken out of the configuration are drained: requests already sent or queued to them run to
+        the end and their state is dropped once the last one finished.
+    """
+
+    def __init__(self, max_clients=DEFAULT_MAX_CLIENTS, max_per_upstream=DEFAULT_MAX_PER_UPSTREAM,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, dns_cache_timeout=DEFAULT_DNS_CACHE_TIMEOUT,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT):
+        self.max_clients = max_clients
+        self.max_per_upstream = max_per_upstream
+        self.idle_timeout = idle_timeout
+        self.dns_cache_timeout = dns_cache_timeout
+        self.stall_timeout = stall_timeout
+        self._configured = False
+        self._curl_share = None
+        self._active = collections.Counter()
+        self._requests = collections.Counter()
+        self._warm = {}
+        self._last_used = {}
+        self._queues = collections.defaultdict(collections.deque)
+        self._draining = {}
+
+    def configure(self):
+        tornado.httpclient.AsyncHTTPClient.configure(CURL_HTTP_CLIENT, max_clients=self.max_clients)
+        if pycurl is not None:
+            # One DNS cache for every curl handle instead of one per handle
+            self._curl_share = pycurl.CurlShare()
+            self._curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self._configured = True
+
+    async def fetch(self, upstream, request):
+        """Fetches request from upstream and returns the response, failures included, it never raises."""
+        if not self._configured:
+            self.configure()
+
+        if pycurl is not None:
+            request.prepare_curl_callback = functools.partial(self._prepare_curl, request.prepare_curl_callback)
+
+        if self._active[upstream] >= self.max_per_upstream:
+            waiter = Future()
+            self._queues[upstream].append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not waiter.cancelled():
+                    # The slot was handed over right before the cancellation arrived
+                    self._release(upstream)
+                elif waiter in self._queues.get(upstream, ()):
+                    self._queues[upstream].remove(waiter)
+                raise
+        else:
+            self._active[upstream] += 1
+
+        self._requests[upstream] += 1
+        expired = time.time() - self._last_used.get(upstream, 0) > self.idle_timeout
+        self._warm[upstream] = max(self._active[upstream], 0 if expired else self._warm.get(upstream, 0))
+        self._last_used[upstream] = time.time()
+        try:
+            return await tornado.httpclient.AsyncHTTPClient().fetch(request, raise_error=False)
+        except Exception as e:
+            # raise_error=False only covers HTTP errors, timeouts and connection failures still raise
+            return tornado.httpclient.HTTPResponse(request, CONNECTION_ERROR, error=e)
+        finally:
+            self._release(upstream)
+
+    def reconfigure(self, max_per_upstream, idle_timeout, dns_cache_timeout, stall_timeout=DEFAULT_STALL_TIMEOUT):
+        self.max_per_upstream = max_per_upstream
+        self.idle_timeout = idle_timeout
+        self.dns_cache_timeout = dns_cache_timeout
+        self.stall_timeout = stall_timeout
+        # A raised limit hands the new slots to waiting requests right away
+        for upstream, queue in list(self._queues.items()):
+            while queue and self._active[upstream] < self.max_per_upstream:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    self._active[upstream] += 1
+                    waiter.set_result(None)
+            if not queue:
+                del self._queues[upstream]
+
+    def drain(self, upstream):
+        """Returns a future resolved once upstream has no requests left, its state is dropped then."""
+        drained = self._draining.get(upstream)
+        if drained is None:
+            drained = self._draining[upstream] = Future()
+            self._forget_if_drained(upstream)
+        return drained
+
+    def undrain(self, upstream):
+        """Takes upstream back before it drained, its future is cancelled."""
+        drained = self._draining.pop(upstream, None)
+        if drained is not None:
+            drained.cancel()
+
+    def stats(self):
+        upstreams = {}
+        for upstream in sorted(set(self._requests) | set(self._queues)):
+            upstreams[upstream] = {
+                "active": self._active[upstream],
+                "idle": self._idle(upstream),
+                "queued": len(self._queues.get(upstream, ())),
+                "requests": self._requests[upstream],
+            }
+            if upstream in self._draining:
+                upstreams[upstream]["draining"] = True
+        return {
+            "active": sum(u["active"] for u in upstreams.values()),
+            "idle": sum(u["idle"] for u in upstreams.values()),
+            "queued": sum(u["queued"] for u in upstreams.values()),
+            "upstreams": upstreams,
+        }
+
+    def _release(self, upstream):
+        self._last_used[upstream] = time.time()
+        queue = self._queues.get(upstream)
+        while queue:
+            waiter = queue.popleft()
+            if not waiter.done():
+                # The slot goes to the waiter, the active count stays
+                waiter.set_result(None)
+                return
+        if queue is not None:
+            del self._queues[upstream]
+        self._active[upstream] -= 1
+        if upstream in self._draining:
+            self._forget_if_drained(upstream)
+
+    def _forget_if_drained(self, upstream):
+        if self._active[upstream] > 0 or self._queues.get(upstream):
+            return
+        for state in (self._active, self._requests, self._warm, self._last_used, self._queues):
+            state.pop(upstream, None)
+        self._draining.pop(upstream).set_result(None)
+
+    def _idle(self, upstream):
+        if time.time() - self._last_used.get(upstream, 0) > self.idle_timeout:
+            return 0
+        return max(self._warm.get(upstream, 0) - self._active[upstream], 0)
+
+    def _prepare_curl(self, prepare_curl_callback, curl):
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        curl.setopt(pycurl.DNS_CACHE_TIMEOUT, self.dns_cache_timeout)
+        if self._curl_share is not None and getattr(curl, 'range_proxy_share', None) is not self._curl_share:
+            # Curl handles are reused between requests and refuse to be attached to a share twice
+            curl.setopt(pycurl.SHARE, self._curl_share)
+            curl.range_proxy_share = self._curl_share
+        # Progress callbacks set by a previous request would otherwise stay on the reused handle
+        reset_progress(curl)
+        # Less than a byte per second over the last stall_timeout seconds fails the transfer (0 turns it off),
+        # curl averages over a few seconds and skips the check while the transfer is paused
+        curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+        curl.setopt(pycurl.LOW_SPEED_TIME, self.stall_timeout)
+        if hasattr(pycurl, 'MAXAGE_CONN'):
+            # libcurl >= 7.65 closes connections that sat idle in its cache for longer than this
+            curl.setopt(pycurl.MAXAGE_CONN, self.idle_timeout)
+        if prepare_curl_callback is not None:
+            prepare_curl_callback(curl)
@@ -32,7 +32,9 @@ setup(
     author_email='markostrajkov@gmail.com',
     cmdclass={'test': PyTest},
     tests_require=['pytest>=2.8.0', 'mock==2.0.0'],
-    install_requires=['tornado==4.4.1', 'pycurl==7.43.0'],
+    python_requires='>=3.8',
+    install_requires=['tornado==6.4.2', 'pycurl==7.45.3'],
+    extras_require={'uvloop': ['uvloop>=0.18'], 'brotli': ['brotli>=1.0']},
     packages=['rangerequestsproxy'],
     license='BSD',
     url='https://github.com/markostrajkov/range-requests-proxy',
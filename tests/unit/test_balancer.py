@@ -0,0 +1,199 @@
+import unittest
+from collections import Counter
+
+import tornado.httpclient
+import tornado.web
+from mock import patch, MagicMock
+from rangerequestsproxy.balancer import Balancer, parse_upstreams
+from rangerequestsproxy.hedging import Attempt
+from rangerequestsproxy.upstream import CURL_HTTP_CLIENT
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+
+ADDRESSES = 'http://a:9000,http://b:9000,http://c:9000'
+
+
+class TestBalancer(unittest.TestCase):
+
+    def test_parse_upstreams(self):
+        self.assertEqual(parse_upstreams('http://a:9000;weight=3, http://b:9000,'),
+                         [('http://a:9000', 3), ('http://b:9000', 1)])
+        self.assertEqual(parse_upstreams(''), [])
+
+    def test_no_upstreams(self):
+        self.assertIsNone(Balancer().select(''))
+        self.assertIsNone(Balancer().select('http://a:9000', exclude=('http://a:9000',)))
+
+    def test_weighted_random(self):
+        balancer = Balancer('random')
+        picks = Counter(balancer.select('http://a:9000;weight=9,http://b:9000') for _ in range(2000))
+
+        self.assertGreater(picks['http://a:9000'], picks['http://b:9000'] * 4)
+
+    def test_least_outstanding(self):
+        balancer = Balancer('least-outstanding')
+        balancer.on_start('http://a:9000')
+        balancer.on_start('http://b:9000')
+
+        self.assertEqual(balancer.select(ADDRESSES), 'http://c:9000')
+        balancer.on_start('http://c:9000')
+        balancer.on_complete('http://b:9000', failed=False)
+        self.assertEqual(balancer.select(ADDRESSES), 'http://b:9000')
+
+    @patch('rangerequestsproxy.balancer.time')
+    def test_ewma_prefers_fast_upstreams(self, time_mock):
+        balancer = Balancer('ewma')
+        for address, latency in (('http://a:9000', 0.5), ('http://b:9000', 0.05), ('http://c:9000', 0.2)):
+            time_mock.time.return_value = 100
+            started = balancer.on_start(address)
+            time_mock.time.return_value = 100 + latency
+            balancer.on_first_byte(address, started)
+            balancer.on_complete(address, failed=False)
+
+        self.assertEqual(balancer.select(ADDRESSES), 'http://b:9000')
+        self.assertAlmostEqual(balancer.stats()['upstreams']['http://b:9000']['ewma_ms'], 50.0)
+
+    def test_consistent_hash_is_stable_and_spreads_keys(self):
+        balancer = Balancer('consistent-hash')
+        keys = ['/video{}.mp4'.format(i) for i in range(300)]
+        assignment = dict((key, balancer.select(ADDRESSES, key)) for key in keys)
+
+        self.assertEqual(assignment, dict((key, balancer.select(ADDRESSES, key)) for key in keys))
+        self.assertEqual(set(assignment.values()), {'http://a:9000', 'http://b:9000', 'http://c:9000'})
+
+        # removing an upstream only moves the keys it owned
+        moved = [key for key in keys if assignment[key] != 'http://c:9000' and
+                 balancer.select('http://a:9000,http://b:9000', key) != assignment[key]]
+        self.assertEqual(moved, [])
+
+    @patch('rangerequestsproxy.balancer.time')
+    def test_consecutive_errors_eject_with_backoff(self, time_mock):
+        time_mock.time.return_value = 1000
+        balancer = Balancer('consistent-hash', max_errors=2, ejection_time=5, max_ejection_time=8)
+        key = next(k for k in ('/{}'.format(i) for i in range(100)) if balancer.select(ADDRESSES, k) == 'http://a:9000')
+
+        balancer.on_complete('http://a:9000', failed=True)
+        self.assertEqual(balancer.select(ADDRESSES, key), 'http://a:9000')
+        balancer.on_complete('http://a:9000', failed=True)
+        self.assertNotEqual(balancer.select(ADDRESSES, key), 'http://a:9000')
+        self.assertFalse(balancer.stats()['upstreams']['http://a:9000']['healthy'])
+
+        # re-admitted after 5 seconds, failing again doubles the ejection (capped at 8 seconds)
+        time_mock.time.return_value = 1005
+        self.assertEqual(balancer.select(ADDRESSES, key), 'http://a:9000')
+        balancer.mark_failure('http://a:9000')
+        balancer.mark_failure('http://a:9000')
+        time_mock.time.return_value = 1012
+        self.assertNotEqual(balancer.select(ADDRESSES, key), 'http://a:9000')
+        time_mock.time.return_value = 1013
+        self.assertEqual(balancer.select(ADDRESSES, key), 'http://a:9000')
+
+    @patch('rangerequestsproxy.balancer.time')
+    def test_fails_open_when_every_upstream_is_ejected(self, time_mock):
+        time_mock.time.return_value = 1000
+        balancer = Balancer(max_errors=1, ejection_time=5)
+        balancer.mark_failure('http://a:9000')
+        time_mock.time.return_value = 1001
+        balancer.mark_failure('http://b:9000')
+
+        self.assertEqual(balancer.select('http://a:9000,http://b:9000'), 'http://a:9000')
+
+    def test_forgotten_upstream_stays_forgotten(self):
+        balancer = Balancer()
+        started = balancer.on_start('http://a:9000')
+        balancer.forget('http://a:9000')
+
+        balancer.on_first_byte('http://a:9000', started)
+        balancer.on_complete('http://a:9000', failed=True)
+
+        self.assertEqual(balancer.stats()['upstreams'], {})
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Balancer('round-robin')
+
+
+class TestHealthChecks(AsyncTestCase):
+
+    @patch('rangerequestsproxy.balancer.tornado.ioloop.PeriodicCallback')
+    @patch('rangerequestsproxy.balancer.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_active_health_checks(self, http_client_mock, periodic_callback_mock):
+        balancer = Balancer(max_errors=3)
+        balancer.start_health_checks(lambda: 'http://a:9000,http://b:9000', '/health', 10)
+        probe = periodic_callback_mock.call_args[0][0]
+
+        responses = {'http://a:9000/health': MagicMock(code=200), 'http://b:9000/health': MagicMock(code=503)}
+
+        async def fetch(req, raise_error=False):
+            return responses[req.url]
+
+        http_client_mock.return_value.fetch = fetch
+        await probe()
+
+        self.assertTrue(balancer.stats()['upstreams']['http://a:9000']['healthy'])
+        self.assertFalse(balancer.stats()['upstreams']['http://b:9000']['healthy'])
+
+        responses['http://b:9000/health'] = MagicMock(code=200)
+        await probe()
+        self.assertTrue(balancer.stats()['upstreams']['http://b:9000']['healthy'])
+
+    @patch('rangerequestsproxy.balancer.tornado.ioloop.PeriodicCallback')
+    @patch('rangerequestsproxy.balancer.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_unreachable_upstream_is_ejected(self, http_client_mock, periodic_callback_mock):
+        balancer = Balancer(max_errors=3)
+        balancer.start_health_checks(lambda: 'http://a:9000', '/health', 10)
+        probe = periodic_callback_mock.call_args[0][0]
+
+        async def fetch(req, raise_error=False):
+            raise OSError('connection refused')
+
+        http_client_mock.return_value.fetch = fetch
+        await probe()
+
+        self.assertFalse(balancer.stats()['upstreams']['http://a:9000']['healthy'])
+
+
+class HealthHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.write('ok')
+
+
+class TestHealthChecksCurlHandles(AsyncHTTPTestCase):
+
+    def setUp(self):
+        # A single curl handle, so every request reuses the one the cancelled attempt ran on
+        tornado.httpclient.AsyncHTTPClient.configure(CURL_HTTP_CLIENT, max_clients=1)
+        self.addCleanup(tornado.httpclient.AsyncHTTPClient.configure, None)
+        super(TestHealthChecksCurlHandles, self).setUp()
+
+    def get_app(self):
+        return tornado.web.Application([(r'/health', HealthHandler)])
+
+    async def fetch_cancelled_attempt(self):
+        attempt = Attempt(MagicMock())
+        attempt.cancel()
+        request = tornado.httpclient.HTTPRequest(self.get_url('/health'), prepare_curl_callback=attempt.prepare_curl)
+        with self.assertRaises(tornado.httpclient.HTTPError) as raised:
+            await tornado.httpclient.AsyncHTTPClient().fetch(request)
+        self.assertEqual(raised.exception.code, 599)
+        return attempt, tornado.httpclient.HTTPResponse(request, 599, error=raised.exception)
+
+    @gen_test
+    async def test_probe_after_cancelled_attempt(self):
+        balancer = Balancer(max_errors=1)
+        address = self.get_url('')
+
+        await self.fetch_cancelled_attempt()
+        await balancer._probe(address, self.get_url('/health'), 5)
+
+        self.assertTrue(balancer.stats()['upstreams'][address]['healthy'])
+
+    @gen_test
+    async def test_finished_attempt_leaves_no_progress_function_behind(self):
+        attempt, response = await self.fetch_cancelled_attempt()
+        attempt.on_response(response)
+
+        response = await tornado.httpclient.AsyncHTTPClient().fetch(self.get_url('/health'), raise_error=False)
+        self.assertEqual(response.code, 200)
@@ -0,0 +1,101 @@
+import itertools
+import random
+import unittest
+
+import tornado.testing
+
+from benchmarks.origin import Origin, object_content
+from benchmarks.parsing import measure
+from benchmarks.run import percentile, plan
+from rangerequestsproxy import httprange
+
+
+class TestPlan(unittest.TestCase):
+
+    def test_sequential_reads_chunks_between_seeks(self):
+        requests = list(itertools.islice(plan('sequential', random.Random(1), 4, 100000, 100, 3), 6))
+        for group in (requests[:3], requests[3:]):
+            index, offset, _ = group[0]
+            self.assertEqual(offset % 100, 0)
+            self.assertEqual(group, [(index, start, start + 99) for start in range(offset, offset + 300, 100)])
+
+    def test_sequential_stops_at_the_end_of_the_object(self):
+        for _, start, end in itertools.islice(plan('sequential', random.Random(4), 4, 950, 100, 8), 200):
+            self.assertEqual(start % 100, 0)
+            self.assertEqual(end, min(start + 99, 949))
+
+    def test_random_ranges_stay_within_objects(self):
+        for index, start, end in itertools.islice(plan('random', random.Random(2), 4, 1000, 100, 3), 200):
+            self.assertTrue(0 <= index < 4)
+            self.assertEqual(end - start, 99)
+            self.assertTrue(0 <= start and end < 1000)
+
+    def test_full_requests_whole_objects(self):
+        for _, start, end in itertools.islice(plan('full', random.Random(3), 4, 1000, 100, 3), 10):
+            self.assertIsNone(start)
+            self.assertIsNone(end)
+
+    def test_hotkey_clients_request_the_same_ranges(self):
+        first = list(itertools.islice(plan('hotkey', random.Random(7), 4, 1000, 100, 3), 20))
+        second = list(itertools.islice(plan('hotkey', random.Random(7), 4, 1000, 100, 3), 20))
+        self.assertEqual(first, second)
+
+
+class TestPercentile(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([5], 99), 5)
+        self.assertIsNone(percentile([], 50))
+
+
+class TestParsingBenchmark(unittest.TestCase):
+
+    def test_memoized_and_uncached_parses_are_measured(self):
+        result = measure('bytes=0-1023', number=10, repeat=1)
+        self.assertEqual(sorted(result), ['memoized_ns', 'uncached_ns'])
+        self.assertTrue(all(value > 0 for value in result.values()))
+        self.assertEqual(httprange.MEMO_MAX_LENGTH, 256)
+
+
+class TestOrigin(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.origin = Origin(objects=2, object_size=1000)
+        return self.origin.application()
+
+    def test_objects_differ(self):
+        self.assertNotEqual(object_content(0, 1000), object_content(1, 1000))
+        self.assertEqual(len(object_content(1, 1000)), 1000)
+
+    def test_range(self):
+        response = self.fetch('/objects/1', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 10-19/1000')
+        self.assertEqual(response.body, self.origin.contents[1][10:20])
+        self.assertEqual(response.headers['ETag'], '"1"')
+        self.assertEqual(self.origin.requests, 1)
+        self.assertEqual(self.origin.bytes_sent, 10)
+
+    def test_unsatisfiable_range(self):
+        response = self.fetch('/objects/0', headers={'Range': 'bytes=1000-'})
+        self.assertEqual(response.code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */1000')
+
+    def test_whole_object(self):
+        response = self.fetch('/objects/0')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.origin.contents[0])
+
+    def test_head_is_counted_without_bytes(self):
+        response = self.fetch('/objects/0', method='HEAD')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Length'], '1000')
+        self.assertEqual(self.origin.requests, 1)
+        self.assertEqual(self.origin.bytes_sent, 0)
+
+    def test_unknown_object(self):
+        self.assertEqual(self.fetch('/objects/5').code, 404)
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rangerequestsproxy.cache import BlockCache, ObjectInfo
+
+KEY = ('/video.mp4', '"v1"')
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def test_memory_lru_eviction(self):
+        cache = BlockCache(memory_size=8, block_size=4)
+        cache.put_block(KEY, 0, b'aaaa')
+        cache.put_block(KEY, 1, b'bbbb')
+        # touch block 0 so block 1 becomes least recently used
+        self.assertEqual(cache.get_block(KEY, 0), b'aaaa')
+        cache.put_block(KEY, 2, b'cccc')
+
+        self.assertEqual(cache.get_block(KEY, 0), b'aaaa')
+        self.assertIsNone(cache.get_block(KEY, 1))
+        self.assertEqual(cache.get_block(KEY, 2), b'cccc')
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['memory_bytes'], 8)
+
+    def test_shrinking_evicts_least_recently_used_blocks(self):
+        cache = BlockCache(memory_size=12, block_size=4)
+        for index, data in enumerate((b'aaaa', b'bbbb', b'cccc')):
+            cache.put_block(KEY, index, data)
+
+        cache.resize(memory_size=4, disk_size=0)
+
+        self.assertEqual([cache.get_block(KEY, index) for index in range(3)], [None, None, b'cccc'])
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(cache.stats()['memory_bytes'], 4)
+
+    def test_blocks_are_keyed_by_validator(self):
+        cache = BlockCache(memory_size=16, block_size=4)
+        cache.put_block(KEY, 0, b'aaaa')
+
+        self.assertIsNone(cache.get_block(('/video.mp4', '"v2"'), 0))
+
+    def test_disk_spill_and_promotion(self):
+        disk_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, disk_path)
+        cache = BlockCache(memory_size=4, block_size=4, disk_path=disk_path, disk_size=8)
+
+        cache.put_block(KEY, 0, b'aaaa')
+        cache.put_block(KEY, 1, b'bbbb')
+        self.assertEqual(cache.stats()['disk_blocks'], 1)
+        self.assertEqual(len(os.listdir(disk_path)), 1)
+
+        # hit on disk promotes the block back to memory and spills the other one
+        self.assertEqual(cache.get_block(KEY, 0), b'aaaa')
+        self.assertEqual(cache.stats()['disk_blocks'], 1)
+        self.assertEqual(cache.get_block(KEY, 1), b'bbbb')
+
+        cache.put_block(KEY, 2, b'cccc')
+        cache.put_block(KEY, 3, b'dddd')
+        self.assertEqual(cache.stats()['disk_bytes'], 8)
+        self.assertEqual(len(os.listdir(disk_path)), 2)
+
+    def test_objects(self):
+        cache = BlockCache(memory_size=16, block_size=4)
+        info = ObjectInfo(validator='"v1"', size=10, content_type='video/mp4', etag='"v1"', last_modified=None)
+        cache.set_object('/video.mp4', info)
+
+        self.assertEqual(cache.get_object('/video.mp4'), info)
+        cache.forget_object('/video.mp4')
+        self.assertIsNone(cache.get_object('/video.mp4'))
@@ -0,0 +1,83 @@
+import gzip
+import unittest
+
+from rangerequestsproxy import compression
+from rangerequestsproxy.compression import CompressionPolicy, negotiate, variant_etag
+
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_highest_rated_encoding_wins_ties_go_to_the_preferred_one(self):
+        self.assertEqual(negotiate('gzip, deflate, br', ('br', 'gzip')), 'br')
+        self.assertEqual(negotiate('gzip;q=1.0, br;q=0.5', ('br', 'gzip')), 'gzip')
+        self.assertEqual(negotiate('x-gzip', ('gzip',)), 'gzip')
+        self.assertEqual(negotiate('*', ('br', 'gzip')), 'br')
+        self.assertEqual(negotiate('*;q=0.5, gzip;q=0', ('gzip',)), None)
+
+    def test_identity_only_clients_get_no_encoding(self):
+        self.assertEqual(negotiate(None, ('gzip',)), None)
+        self.assertEqual(negotiate('identity', ('gzip',)), None)
+        self.assertEqual(negotiate('deflate', ('gzip',)), None)
+        self.assertEqual(negotiate('gzip;q=oops', ('gzip',)), None)
+
+    def test_variant_etag(self):
+        self.assertEqual(variant_etag('"abc"', 'gzip'), '"abc-gzip"')
+        self.assertEqual(variant_etag('W/"abc"', 'br'), 'W/"abc-br"')
+        self.assertEqual(variant_etag(None, 'gzip'), None)
+
+
+class TestCompressionPolicy(unittest.TestCase):
+    body = b'{"line": "compressible text"}\n' * 100
+
+    def test_media_types_are_matched_without_parameters_and_by_wildcard(self):
+        policy = CompressionPolicy(types=['text/*', 'application/json'])
+        self.assertTrue(policy.compressible('text/csv'))
+        self.assertTrue(policy.compressible('Application/JSON; charset=utf-8'))
+        self.assertFalse(policy.compressible('image/jpeg'))
+        self.assertFalse(policy.compressible(None))
+
+    def test_streamed_body_is_stored_as_a_cached_variant(self):
+        policy = CompressionPolicy(level=9)
+        encoder = policy.encoder('gzip', '/log.json', '"v1"', len(self.body))
+        data = encoder.compress(self.body[:1000]) + encoder.compress(self.body[1000:]) + encoder.finish()
+        self.assertEqual(gzip.decompress(data), self.body)
+
+        cached = policy.encoder('gzip', '/log.json', '"v1"', len(self.body))
+        self.assertEqual(cached.compress(self.body) + cached.compress(b'') + cached.finish(), data)
+        # Another validator is another object
+        self.assertIsInstance(policy.encoder('gzip', '/log.json', '"v2"'), compression.Encoder)
+
+        stats = policy.stats()
+        self.assertEqual((stats["responses"], stats["cache_hits"], stats["cache_misses"]), (2, 1, 2))
+        self.assertEqual(stats["bytes_in"], 2 * len(self.body))
+        self.assertEqual(stats["cache_bytes"], len(data))
+
+    def test_truncated_or_unvalidated_bodies_are_not_cached(self):
+        policy = CompressionPolicy()
+        encoder = policy.encoder('gzip', '/log.json', '"v1"', len(self.body))
+        encoder.compress(self.body[:100])
+        encoder.finish()
+        encoder = policy.encoder('gzip', '/log.json', '"v1"', len(self.body))
+        encoder.compress(self.body)
+        encoder.finish(complete=False)
+        encoder = policy.encoder('gzip', '/log.json', None)
+        encoder.compress(self.body)
+        encoder.finish()
+
+        self.assertEqual(policy.stats()["cache_variants"], 0)
+
+    def test_least_recently_used_variants_are_evicted(self):
+        policy = CompressionPolicy(cache_size=100)
+        policy.store(('/a', '"1"', 'gzip'), b'a' * 60)
+        policy.store(('/b', '"1"', 'gzip'), b'b' * 60)
+        policy.store(('/c', '"1"', 'gzip'), b'c' * 101)
+
+        self.assertEqual(list(policy._cache), [('/b', '"1"', 'gzip')])
+        self.assertEqual(policy.stats()["cache_bytes"], 60)
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        policy = CompressionPolicy(level=5)
+        encoder = policy.encoder('br')
+        data = encoder.compress(memoryview(self.body)) + encoder.finish()
+        self.assertEqual(compression.brotli.decompress(data), self.body)
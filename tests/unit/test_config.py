@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock
+from rangerequestsproxy import proxy
+from rangerequestsproxy.config import SETTINGS, ConfigError, ConfigFile, parse_settings
+
+
+class TestParseSettings(unittest.TestCase):
+
+    def test_values_are_typed_from_json_and_environment_style_strings(self):
+        settings = parse_settings({'address': ['http://a:9000;weight=2', ' http://b:9000'], 'max_ranges': '10',
+                                   'connect_timeout': 2, 'hedge': 'true', 'compression_types': 'text/*, image/svg+xml'})
+
+        self.assertEqual(settings, {'address': 'http://a:9000;weight=2,http://b:9000', 'max_ranges': 10,
+                                    'connect_timeout': 2.0, 'hedge': True, 'compression_types': 'text/*,image/svg+xml'})
+
+    def test_invalid_settings_are_rejected(self):
+        for values in ({'port': 8001}, {'address': 'ftp://a'}, {'max_ranges': 0}, {'cache_size': -1},
+                       {'cache_size': True}, {'balancing_policy': 'round-robin'}, {'hedge': 'maybe'},
+                       {'compression_level': 10}, {'request_timeout': 'soon'}, ['address']):
+            with self.assertRaises(ConfigError):
+                parse_settings(values)
+
+    def test_every_setting_is_backed_by_a_proxy_global(self):
+        self.assertEqual(sorted(SETTINGS), sorted(proxy.SETTING_GLOBALS))
+        for name, value in proxy.current_settings().items():
+            self.assertEqual(parse_settings({name: value})[name], value)
+
+
+class TestConfigFile(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'proxy.json')
+        self.write({'address': 'http://a:9000'})
+        self.apply = MagicMock()
+        self.config = ConfigFile(self.path, self.apply)
+
+    def write(self, values, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(values if isinstance(values, str) else json.dumps(values))
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_changed_file_is_applied_again(self):
+        self.config.load()
+        self.assertFalse(self.config.check())
+
+        self.write({'address': 'http://b:9000', 'request_timeout': 30}, mtime=1)
+        self.assertTrue(self.config.check())
+
+        self.apply.assert_called_with({'address': 'http://b:9000', 'request_timeout': 30.0})
+        self.assertEqual(self.config.stats()['version'], 2)
+
+    def test_setting_removed_from_the_file_goes_back_to_its_default(self):
+        config = ConfigFile(self.path, self.apply, defaults={'address': 'http://a:9000', 'cache_size': 0})
+        self.write({'address': 'http://b:9000', 'cache_size': 1000000})
+        config.load()
+        self.apply.assert_called_with({'address': 'http://b:9000', 'cache_size': 1000000})
+
+        self.write({'address': 'http://b:9000'}, mtime=1)
+        config.check()
+
+        self.apply.assert_called_with({'address': 'http://b:9000', 'cache_size': 0})
+
+    def test_broken_file_keeps_the_running_configuration(self):
+        self.config.load()
+        self.write('{"address": ', mtime=1)
+
+        self.assertTrue(self.config.check())
+        self.assertEqual(self.apply.call_count, 1)
+        self.assertIn('Cannot parse', self.config.stats()['error'])
+        # Not read again until it changes
+        self.assertFalse(self.config.check())
+
+        self.apply.side_effect = ConfigError('Cannot create the cache')
+        self.write({'cache_size': 1024}, mtime=2)
+        self.config.check()
+        self.assertEqual(self.config.stats()['error'], 'Cannot create the cache')
+        self.assertEqual(self.config.stats()['version'], 1)
+
+    def test_update_merges_into_the_file(self):
+        self.config.update({'max_ranges': 5})
+
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {'address': 'http://a:9000', 'max_ranges': 5})
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['proxy.json'])
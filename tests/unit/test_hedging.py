@@ -0,0 +1,181 @@
+import unittest
+
+from mock import patch, MagicMock
+from rangerequestsproxy.balancer import Balancer
+from rangerequestsproxy.hedging import HedgedFetch, HedgingPolicy
+
+ADDRESSES = 'http://a:9000,http://b:9000'
+
+
+@patch('rangerequestsproxy.hedging.tornado.ioloop.IOLoop')
+class TestHedgedFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.balancer = Balancer('least-outstanding')
+        self.sent = []
+        self.responses = []
+
+    def make_fetch(self, policy, idempotent=True, header_callback=None):
+        def select_upstream(exclude):
+            return self.balancer.select(ADDRESSES, exclude=exclude)
+
+        return HedgedFetch(policy, self.balancer, select_upstream, self.sent.append, self.responses.append,
+                           header_callback=header_callback, idempotent=idempotent)
+
+    def timers(self, ioloop_mock):
+        return [c[0] for c in ioloop_mock.current.return_value.call_later.call_args_list]
+
+    def test_hedge_to_other_upstream_wins(self, ioloop_mock):
+        policy = HedgingPolicy(hedge=True, min_hedge_delay=0.05)
+        headers = []
+        fetch = self.make_fetch(policy, header_callback=headers.append)
+        fetch.start()
+
+        self.assertEqual(len(self.sent), 1)
+        hedge_timer = [t for t in self.timers(ioloop_mock) if t[0] == 0.05][0]
+        hedge_timer[1]()
+
+        self.assertEqual(len(self.sent), 2)
+        self.assertNotEqual(self.sent[0].upstream, self.sent[1].upstream)
+        self.assertEqual(policy.hedges_fired, 1)
+
+        # the hedge answers first, the primary is cancelled and whatever it sends later is ignored
+        self.sent[1].on_header('HTTP/1.1 206 Partial Content\r\n')
+        self.assertTrue(self.sent[0].cancelled)
+        self.assertEqual(self.sent[0]._progress(0, 0, 0, 0), 1)
+        self.sent[0].on_header('HTTP/1.1 206 Partial Content\r\n')
+        self.sent[0].on_response(MagicMock(code=599))
+        self.sent[1].on_response(MagicMock(code=206))
+
+        self.assertEqual(headers, ['HTTP/1.1 206 Partial Content\r\n'])
+        self.assertEqual([r.code for r in self.responses], [206])
+        self.assertEqual(policy.hedges_won, 1)
+        # the cancelled request is not held against its upstream
+        stats = self.balancer.stats()['upstreams']
+        self.assertEqual(sum(s['errors'] for s in stats.values()), 0)
+        self.assertEqual(sum(s['outstanding'] for s in stats.values()), 0)
+
+    def test_no_hedge_after_first_byte(self, ioloop_mock):
+        policy = HedgingPolicy(hedge=True)
+        fetch = self.make_fetch(policy)
+        fetch.start()
+        self.sent[0].on_header('HTTP/1.1 206 Partial Content\r\n')
+
+        fetch._hedge()
+
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(policy.hedges_fired, 0)
+
+    def test_connection_failure_is_retried_once(self, ioloop_mock):
+        policy = HedgingPolicy(max_retries=1)
+        fetch = self.make_fetch(policy)
+        fetch.start()
+
+        self.sent[0].on_response(MagicMock(code=599))
+        self.assertEqual(len(self.sent), 2)
+        self.assertNotEqual(self.sent[0].upstream, self.sent[1].upstream)
+        self.assertEqual(self.responses, [])
+
+        self.sent[1].on_response(MagicMock(code=599))
+        self.assertEqual([r.code for r in self.responses], [599])
+        self.assertEqual(policy.retries, 1)
+
+    def test_retries_are_limited_by_budget(self, ioloop_mock):
+        policy = HedgingPolicy(max_retries=1, budget_ratio=0.1, budget_max=1)
+        for _ in range(2):
+            self.make_fetch(policy).start()
+            self.sent[-1].on_response(MagicMock(code=599))
+            self.sent[-1].on_response(MagicMock(code=599))
+
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(policy.retries, 1)
+        self.assertEqual(policy.budget_exhausted, 1)
+
+    def test_hedge_without_another_upstream_keeps_the_budget(self, ioloop_mock):
+        policy = HedgingPolicy(hedge=True, max_retries=1, budget_max=1)
+
+        def select_upstream(exclude):
+            return self.balancer.select('http://a:9000', exclude=exclude)
+
+        fetch = HedgedFetch(policy, self.balancer, select_upstream, self.sent.append, self.responses.append)
+        fetch.start()
+
+        fetch._hedge()
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(policy.hedges_fired, 0)
+        self.assertEqual(policy.budget_exhausted, 0)
+
+        # the token the hedge did not use still pays for the retry
+        self.sent[0].on_response(MagicMock(code=599))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(policy.retries, 1)
+
+    def test_non_idempotent_requests_are_not_retried(self, ioloop_mock):
+        policy = HedgingPolicy(hedge=True)
+        self.make_fetch(policy, idempotent=False).start()
+
+        self.sent[0].on_response(MagicMock(code=599))
+
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual([r.code for r in self.responses], [599])
+        self.assertEqual(len(self.timers(ioloop_mock)), 1)
+
+    def test_first_byte_timeout_retries_elsewhere(self, ioloop_mock):
+        policy = HedgingPolicy(first_byte_timeout=2)
+        self.make_fetch(policy).start()
+
+        delay, on_timeout, attempt = self.timers(ioloop_mock)[0]
+        self.assertEqual(delay, 2)
+        on_timeout(attempt)
+
+        self.assertTrue(self.sent[0].cancelled)
+        self.assertEqual(policy.first_byte_timeouts, 1)
+        self.assertEqual(len(self.sent), 2)
+        self.sent[1].on_response(MagicMock(code=206))
+        self.assertEqual([r.code for r in self.responses], [206])
+        self.assertEqual(self.balancer.stats()['upstreams'][self.sent[0].upstream]['errors'], 1)
+
+    def test_first_byte_timeout_without_retry_answers_with_error(self, ioloop_mock):
+        policy = HedgingPolicy(first_byte_timeout=2, max_retries=0)
+        self.make_fetch(policy).start()
+
+        delay, on_timeout, attempt = self.timers(ioloop_mock)[0]
+        on_timeout(attempt)
+
+        self.assertEqual(self.responses[0].code, 599)
+        self.assertEqual(self.balancer.stats()['upstreams'][self.sent[0].upstream]['outstanding'], 0)
+
+    def test_no_upstream(self, ioloop_mock):
+        fetch = HedgedFetch(HedgingPolicy(), self.balancer, lambda exclude: None, self.sent.append,
+                            self.responses.append)
+
+        self.assertFalse(fetch.start())
+        self.assertEqual(self.sent, [])
+
+    def test_cancelled_fetch_stops_every_attempt(self, ioloop_mock):
+        policy = HedgingPolicy(hedge=True)
+        fetch = self.make_fetch(policy)
+        fetch.start()
+
+        fetch.cancel()
+        self.assertTrue(self.sent[0].cancelled)
+        ioloop_mock.current.return_value.remove_timeout.assert_called()
+
+        # the aborted transfer still ends, it is neither answered nor held against its upstream
+        self.sent[0].on_response(MagicMock(code=599))
+        self.assertEqual(self.responses, [])
+        upstream = self.balancer.stats()['upstreams'][self.sent[0].upstream]
+        self.assertEqual((upstream['outstanding'], upstream['errors']), (0, 0))
+
+
+class TestHedgingPolicy(unittest.TestCase):
+
+    def test_hedge_delay_follows_percentile(self):
+        policy = HedgingPolicy(hedge_percentile=95, min_hedge_delay=0.01)
+        self.assertEqual(policy.hedge_delay(), 0.01)
+
+        for i in range(100):
+            policy.record_first_byte(i / 1000.0)
+
+        self.assertEqual(policy.hedge_delay(), 0.095)
+        self.assertEqual(policy.stats()['hedge_delay_ms'], 95.0)
@@ -0,0 +1,217 @@
+import random
+import re
+import unittest
+
+from mock import patch
+from rangerequestsproxy import httprange
+from rangerequestsproxy.httprange import (ByteRangeSet, RangeNotSatisfiableException, coalesce_ranges,
+                                          format_range_set, merge_ranges, parse_content_range, parse_range_set,
+                                          resolve_ranges)
+
+# RFC 7233 byte-ranges-specifier with the RFC 7230 list rule, whitespace is allowed around every element
+RANGE_SPEC = r'(?:[0-9]+-[0-9]*|-[0-9]+)'
+REFERENCE_REGEX = re.compile(r'(?i:bytes)=[ \t]*(?:{0}[ \t]*)?(?:,[ \t]*(?:{0}[ \t]*)?)*'.format(RANGE_SPEC))
+MUTATIONS = '0123456789-=, \t;+abyBY\n\x00\u00b2\u0663'
+
+
+def reference_parse(range_str):
+    """Independent oracle: the ranges the grammar allows, or None for a header that has to be rejected."""
+    if not REFERENCE_REGEX.fullmatch(range_str):
+        return None
+    ranges = []
+    for first, last in re.findall(r'([0-9]*)-([0-9]*)', range_str.partition('=')[2]):
+        start, end = int(first) if first else None, int(last) if last else None
+        if (start is not None and end is not None and start > end) or (start is None and end == 0):
+            return None
+        ranges.append((start, end))
+    return merge_ranges(ranges) if ranges else None
+
+
+def random_header(rng):
+    specs = []
+    elements = []
+    for _ in range(rng.randint(1, 5)):
+        number = rng.choice((0, 1, 99, 1023, 2 ** 31, 2 ** 64, rng.randrange(10 ** 9)))
+        kind = rng.randrange(3)
+        if kind == 0:
+            end = number + rng.choice((0, 1, 100, 2 ** 40))
+            specs.append((number, end))
+            text = '{}-{}'.format(number, end)
+        elif kind == 1:
+            specs.append((number, None))
+            text = '{}-'.format(number)
+        else:
+            specs.append((None, number + 1))
+            text = '-{}'.format(number + 1)
+        if rng.random() < 0.1:
+            # leading zeros are allowed digits
+            text = text.replace('-', '-0', 1) if text.startswith('-') else '0' + text
+        elements.append(text)
+    if rng.random() < 0.3:
+        elements.insert(rng.randint(0, len(elements)), '')
+    separators = [rng.choice((',', ', ', ' ,', ',\t', ' , ')) for _ in elements[1:]]
+    range_set = elements[0] + ''.join(separator + element for separator, element in zip(separators, elements[1:]))
+    return rng.choice(('bytes', 'Bytes', 'BYTES')) + '=' + range_set, merge_ranges(specs)
+
+
+def mutate(rng, header):
+    for _ in range(rng.randint(1, 3)):
+        position = rng.randint(0, len(header))
+        if rng.random() < 0.5 and header:
+            header = header[:position] + header[position + 1:]
+        else:
+            header = header[:position] + rng.choice(MUTATIONS) + header[position:]
+    return header
+
+
+class TestParseRangeSet(unittest.TestCase):
+
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_set('bytes=0-50'), [(0, 50)])
+        self.assertEqual(parse_range_set('bytes=5-5'), [(5, 5)])
+        self.assertEqual(parse_range_set('bytes=100-'), [(100, None)])
+        self.assertEqual(parse_range_set('bytes=-500'), [(None, 500)])
+
+    def test_multiple_ranges_are_sorted_and_merged(self):
+        self.assertEqual(parse_range_set('bytes=0-99,200-299'), [(0, 99), (200, 299)])
+        self.assertEqual(parse_range_set('bytes=200-299, 0-99'), [(0, 99), (200, 299)])
+        self.assertEqual(parse_range_set('bytes=0-99,50-150,151-160'), [(0, 160)])
+        self.assertEqual(parse_range_set('bytes=0-99,90-'), [(0, None)])
+        self.assertEqual(parse_range_set('bytes=500-,0-10,600-700'), [(0, 10), (500, None)])
+        self.assertEqual(parse_range_set('bytes=-10,0-5,-20'), [(0, 5), (None, 20)])
+        self.assertEqual(parse_range_set('bytes=0-1,,4-5'), [(0, 1), (4, 5)])
+        self.assertEqual(parse_range_set('bytes=5-,5-10'), [(5, None)])
+
+    def test_invalid_ranges(self):
+        for range_str in ('bytes=a-50', 'bytes=0-5a', 'bytes=-', 'bytes=5', 'bytes=--5', 'bytes=-5-10',
+                          'bytes=+1-2'):
+            with self.assertRaises(RangeNotSatisfiableException) as cm:
+                parse_range_set(range_str)
+            self.assertEqual(cm.exception.message, 'Requested Range Not Satisfiable. Invalid start or end interval.')
+
+        for range_str in ('items=0-5', '0-5', 'bytes=', 'bytes=,'):
+            with self.assertRaises(RangeNotSatisfiableException):
+                parse_range_set(range_str)
+
+        with self.assertRaises(RangeNotSatisfiableException):
+            parse_range_set('bytes=10-5')
+        with self.assertRaises(RangeNotSatisfiableException):
+            parse_range_set('bytes=-0')
+
+    def test_range_count_is_capped_after_merging(self):
+        many = 'bytes=' + ','.join('{}-{}'.format(i * 10, i * 10 + 1) for i in range(5))
+        self.assertEqual(len(parse_range_set(many, max_ranges=5)), 5)
+        with self.assertRaises(RangeNotSatisfiableException):
+            parse_range_set(many, max_ranges=4)
+
+        overlapping = 'bytes=' + ','.join('0-{}'.format(i) for i in range(100))
+        self.assertEqual(parse_range_set(overlapping, max_ranges=1), [(0, 99)])
+
+    def test_format_range_set(self):
+        self.assertEqual(format_range_set([(0, 99), (200, None)]), 'bytes=0-99,200-')
+        self.assertEqual(format_range_set([(None, 500)]), 'bytes=-500')
+
+
+class TestRangeGrammarFuzz(unittest.TestCase):
+
+    def test_generated_range_sets_parse_to_their_ranges(self):
+        rng = random.Random(7233)
+        for _ in range(2000):
+            header, expected = random_header(rng)
+            ranges = parse_range_set(header, max_ranges=100)
+            self.assertEqual(ranges, expected, header)
+            self.assertEqual(parse_range_set(ranges.header, max_ranges=100), ranges, header)
+
+    def test_mutated_headers_are_parsed_like_the_grammar_says(self):
+        rng = random.Random(7230)
+        rejected = 0
+        for _ in range(5000):
+            header = mutate(rng, random_header(rng)[0])
+            expected = reference_parse(header)
+            if expected is None:
+                rejected += 1
+                with self.assertRaises(RangeNotSatisfiableException, msg=header):
+                    parse_range_set(header, max_ranges=100)
+            else:
+                self.assertEqual(parse_range_set(header, max_ranges=100), expected, header)
+        # both outcomes were exercised
+        self.assertTrue(1000 < rejected < 4000)
+
+    def test_non_ascii_digits_are_rejected(self):
+        for range_str in ('bytes=\u00b2-5', 'bytes=0-\u0663', 'bytes=0-1,\u0663-5', 'bytes=\uff10-1'):
+            with self.assertRaises(RangeNotSatisfiableException):
+                parse_range_set(range_str)
+
+
+class TestByteRangeSet(unittest.TestCase):
+
+    def test_behaves_like_an_immutable_sequence(self):
+        ranges = parse_range_set('bytes=200-299,0-99')
+        self.assertEqual(len(ranges), 2)
+        self.assertEqual(ranges[0], (0, 99))
+        self.assertEqual(list(ranges), [(0, 99), (200, 299)])
+        self.assertEqual(ranges, ByteRangeSet([(0, 99), (200, 299)]))
+        self.assertNotEqual(ranges, [(0, 99)])
+        self.assertEqual(hash(ranges), hash(ByteRangeSet(((0, 99), (200, 299)))))
+        with self.assertRaises(AttributeError):
+            ranges.ranges = ()
+        with self.assertRaises(AttributeError):
+            ranges.extra = 1
+
+    def test_header_is_canonical(self):
+        self.assertEqual(parse_range_set('bytes=0-99').header, 'bytes=0-99')
+        self.assertEqual(parse_range_set('bytes=007-9').header, 'bytes=7-9')
+        self.assertEqual(parse_range_set('Bytes= 200-299 , 0-99,-5').header, 'bytes=0-99,200-299,-5')
+
+
+class TestRangeSetMemo(unittest.TestCase):
+
+    def setUp(self):
+        httprange._memo.clear()
+
+    def tearDown(self):
+        httprange._memo.clear()
+
+    def test_repeated_headers_are_parsed_once(self):
+        self.assertIs(parse_range_set('bytes=0-99'), parse_range_set('bytes=0-99'))
+        # the range count limit is checked on every call
+        parse_range_set('bytes=0-1,5-6')
+        with self.assertRaises(RangeNotSatisfiableException):
+            parse_range_set('bytes=0-1,5-6', max_ranges=1)
+
+    @patch('rangerequestsproxy.httprange.MEMO_SIZE', 2)
+    def test_memo_is_bounded(self):
+        for range_str in ('bytes=0-1', 'bytes=0-2', 'bytes=0-3'):
+            parse_range_set(range_str)
+        self.assertEqual(list(httprange._memo), ['bytes=0-2', 'bytes=0-3'])
+
+        long_range_set = 'bytes=0-1' + ',' * httprange.MEMO_MAX_LENGTH
+        parse_range_set(long_range_set)
+        self.assertNotIn(long_range_set, httprange._memo)
+
+    def test_invalid_headers_are_not_remembered(self):
+        for _ in range(2):
+            with self.assertRaises(RangeNotSatisfiableException):
+                parse_range_set('bytes=5-1')
+        self.assertEqual(httprange._memo, {})
+
+
+class TestRangeHelpers(unittest.TestCase):
+
+    def test_resolve_ranges(self):
+        self.assertEqual(resolve_ranges([(0, 9), (None, 5)], 100), [(0, 9), (95, 99)])
+        self.assertEqual(resolve_ranges([(0, 9), (None, 95)], 100), [(0, 99)])
+        self.assertEqual(resolve_ranges([(90, None), (200, 300)], 100), [(90, 99)])
+        with self.assertRaises(RangeNotSatisfiableException):
+            resolve_ranges([(200, 300)], 100)
+
+    def test_coalesce_ranges(self):
+        ranges = [(0, 9), (15, 20), (100, 110), (None, 5)]
+        self.assertEqual(coalesce_ranges(ranges, 10), [[(0, 9), (15, 20)], [(100, 110)], [(None, 5)]])
+        self.assertEqual(coalesce_ranges(ranges, 0), [[(0, 9)], [(15, 20)], [(100, 110)], [(None, 5)]])
+
+    def test_parse_content_range(self):
+        self.assertEqual(parse_content_range('bytes 0-9/100'), (0, 9, 100))
+        self.assertEqual(parse_content_range('bytes 0-9/*'), (0, 9, None))
+        self.assertIsNone(parse_content_range('bytes */100'))
+        self.assertIsNone(parse_content_range(None))
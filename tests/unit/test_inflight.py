@@ -0,0 +1,108 @@
+import io
+import unittest
+
+from mock import MagicMock
+from rangerequestsproxy.inflight import InflightRegistry, slice_response
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPHeaders
+
+KEY = ('GET', '/video.mp4')
+
+
+def make_response(body, content_range):
+    headers = HTTPHeaders({'Content-Type': 'video/mp4', 'Content-Range': content_range,
+                           'Content-Length': str(len(body))})
+    return HTTPResponse(HTTPRequest('http://127.0.0.1:9000/video.mp4'), 206, headers=headers,
+                        buffer=io.BytesIO(body))
+
+
+class TestInflightRegistry(unittest.TestCase):
+
+    def test_identical_and_overlapping_requests_share_one_fetch(self):
+        registry = InflightRegistry()
+        leader, identical, overlapping, disjoint = MagicMock(), MagicMock(), MagicMock(), MagicMock()
+
+        fetch = registry.start(KEY, 0, 9, leader)
+        self.assertTrue(registry.join(KEY, 0, 9, identical))
+        self.assertTrue(registry.join(KEY, 2, 4, overlapping))
+        self.assertFalse(registry.join(KEY, 5, 20, disjoint))
+        self.assertFalse(registry.join(('GET', '/other.mp4'), 0, 9, disjoint))
+
+        response = make_response(b'0123456789', 'bytes 0-9/100')
+        registry.complete(fetch, response)
+
+        leader.assert_called_once_with(response)
+        identical.assert_called_once_with(response)
+        sliced = overlapping.call_args[0][0]
+        self.assertEqual(sliced.code, 206)
+        self.assertEqual(sliced.body, b'234')
+        self.assertEqual(sliced.headers['Content-Range'], 'bytes 2-4/100')
+        self.assertEqual(sliced.headers['Content-Length'], '3')
+        self.assertEqual(sliced.headers['Content-Type'], 'video/mp4')
+        self.assertEqual((registry.upstream_fetches, registry.coalesced_requests), (1, 2))
+
+        # completed fetches do not accept new waiters
+        self.assertFalse(registry.join(KEY, 0, 9, identical))
+
+    def test_open_ended_fetch_covers_everything_after_start(self):
+        registry = InflightRegistry()
+        fetch = registry.start(KEY, 10, None, MagicMock())
+
+        self.assertTrue(registry.join(KEY, 20, None, MagicMock()))
+        self.assertTrue(registry.join(KEY, 20, 30, MagicMock()))
+        self.assertFalse(registry.join(KEY, 5, 30, MagicMock()))
+        registry.discard(fetch)
+        self.assertFalse(registry.join(KEY, 20, 30, MagicMock()))
+
+    def test_upstream_is_cancelled_when_the_last_waiter_leaves(self):
+        registry = InflightRegistry()
+        leader, follower = MagicMock(), MagicMock()
+        fetch = registry.start(KEY, 0, 9, leader)
+        fetch.upstream = MagicMock()
+        self.assertIs(registry.join(KEY, 0, 9, follower), fetch)
+
+        registry.leave(fetch, leader)
+        self.assertFalse(fetch.upstream.cancel.called)
+        registry.leave(fetch, follower)
+        fetch.upstream.cancel.assert_called_once_with()
+
+        # a fetch nobody waits for is not joined anymore
+        self.assertIsNone(registry.join(KEY, 0, 9, MagicMock()))
+
+    def test_stream_subscribers_receive_headers_and_chunks(self):
+        registry = InflightRegistry()
+        leader, follower, late = [MagicMock(), MagicMock(), MagicMock()], [MagicMock() for _ in range(3)], \
+            [MagicMock() for _ in range(3)]
+
+        stream = registry.start_stream(KEY, *leader)
+        stream.on_header('HTTP/1.1 206 Partial Content\r\n')
+        self.assertTrue(registry.join_stream(KEY, *follower))
+        follower[0].assert_called_once_with('HTTP/1.1 206 Partial Content\r\n')
+
+        stream.on_chunk(b'0123')
+        self.assertFalse(registry.join_stream(KEY, *late))
+        registry.complete_stream(stream, 'response')
+
+        for header_callback, streaming_callback, callback in (leader, follower):
+            streaming_callback.assert_called_once_with(b'0123')
+            callback.assert_called_once_with('response')
+
+
+class TestSliceResponse(unittest.TestCase):
+
+    def test_range_past_end_of_fetched_bytes(self):
+        sliced = slice_response(make_response(b'6789', 'bytes 6-9/10'), 12, None)
+
+        self.assertEqual(sliced.code, 416)
+        self.assertEqual(sliced.headers['Content-Range'], 'bytes */10')
+
+    def test_open_range_is_clamped_to_fetched_bytes(self):
+        sliced = slice_response(make_response(b'6789', 'bytes 6-9/10'), 8, None)
+
+        self.assertEqual(sliced.body, b'89')
+        self.assertEqual(sliced.headers['Content-Range'], 'bytes 8-9/10')
+
+    def test_errors_are_shared_as_they_are(self):
+        response = MagicMock(error=Exception(), code=599)
+
+        self.assertIs(slice_response(response, 2, 4), response)
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rangerequestsproxy.localfile import LocalFiles, TruncatedFileError
+
+
+class TestLocalFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'videos'))
+        self.write('videos/a.mp4', b'0123456789')
+        self.write('b.txt', b'abc')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def test_resolve_stays_below_root(self):
+        files = LocalFiles(self.root)
+
+        self.assertEqual(files.resolve('/videos/a.mp4?range=bytes=0-1'), os.path.join(self.root, 'videos', 'a.mp4'))
+        self.assertEqual(files.resolve('/../../videos/%2E%2E/b.txt'), os.path.join(self.root, 'b.txt'))
+        self.assertIsNone(files.resolve('/'))
+        self.assertIsNone(files.resolve('/a%00.txt'))
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'requires os.symlink')
+    def test_symlinks_must_resolve_below_root(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        with open(os.path.join(outside, 'secret.txt'), 'wb') as f:
+            f.write(b'secret')
+        os.symlink(outside, os.path.join(self.root, 'escape'))
+        os.symlink(os.path.join(self.root, 'b.txt'), os.path.join(self.root, 'videos', 'b.txt'))
+        files = LocalFiles(self.root)
+
+        self.assertIsNone(files.resolve('/escape/secret.txt'))
+        self.assertIsNone(files.open('/escape/secret.txt'))
+        self.assertEqual(b''.join(files.open('/videos/b.txt').read(0, 2)), b'abc')
+
+    def test_open_reads_regular_files(self):
+        files = LocalFiles(self.root)
+
+        local_file = files.open('/videos/a.mp4')
+        self.assertEqual(local_file.size, 10)
+        self.assertEqual(local_file.content_type, 'video/mp4')
+        self.assertEqual(b''.join(local_file.read(2, 4)), b'234')
+        self.assertTrue(local_file.etag.startswith('"') and local_file.etag.endswith('-a"'))
+        self.assertIs(files.open('/videos/a.mp4'), local_file)
+        self.assertIsNone(files.open('/videos'))
+        self.assertIsNone(files.open('/missing.mp4'))
+        self.assertEqual(files.stats(), {"open_files": 1, "hits": 1, "misses": 1})
+
+    def test_changed_file_is_opened_again(self):
+        files = LocalFiles(self.root)
+        old = files.open('/b.txt')
+        reader = old.read(0, 2)
+        self.assertEqual(next(reader), b'abc')
+
+        self.write('b.txt', b'abcdef')
+        new = files.open('/b.txt')
+
+        self.assertIsNot(new, old)
+        self.assertEqual(b''.join(new.read(3, 5)), b'def')
+        # reads started before keep the old descriptor open until they are done
+        self.assertIsNotNone(old._fd)
+        self.assertEqual(list(reader), [])
+        self.assertIsNone(old._fd)
+
+    def test_truncated_file_ends_the_read(self):
+        files = LocalFiles(self.root)
+        local_file = files.open('/videos/a.mp4')
+
+        with open(os.path.join(self.root, 'videos', 'a.mp4'), 'r+b') as f:
+            f.truncate(4)
+
+        with self.assertRaises(TruncatedFileError):
+            b''.join(local_file.read(2, 9))
+
+    def test_least_recently_used_files_are_closed(self):
+        files = LocalFiles(self.root, max_open=1)
+        files.open('/b.txt')
+        files.open('/videos/a.mp4')
+        files.open('/videos/a.mp4')
+
+        self.assertEqual(files.stats(), {"open_files": 1, "hits": 1, "misses": 2})
@@ -0,0 +1,108 @@
+import unittest
+
+from mock import patch
+from rangerequestsproxy.metadata import MetadataCache, if_range_matches, is_not_modified, object_info
+from tornado.httputil import HTTPHeaders
+
+LAST_MODIFIED = 'Tue, 15 Nov 1994 12:45:26 GMT'
+
+
+def make_info(etag='"v1"', last_modified=LAST_MODIFIED):
+    headers = HTTPHeaders({'Content-Range': 'bytes 0-9/100', 'Content-Type': 'video/mp4'})
+    if etag:
+        headers['ETag'] = etag
+    if last_modified:
+        headers['Last-Modified'] = last_modified
+    return object_info(206, headers)
+
+
+class TestObjectInfo(unittest.TestCase):
+
+    def test_size_from_responses(self):
+        self.assertEqual(make_info().size, 100)
+        self.assertEqual(make_info().content_type, 'video/mp4')
+        self.assertEqual(object_info(200, HTTPHeaders({'Content-Length': '42'}), body_length=0).size, 42)
+        self.assertEqual(object_info(200, HTTPHeaders(), body_length=7).size, 7)
+        self.assertEqual(object_info(416, HTTPHeaders({'Content-Range': 'bytes */100'})).size, 100)
+
+    def test_unknown_size(self):
+        self.assertIsNone(object_info(206, HTTPHeaders({'Content-Range': 'bytes 0-9/*'})))
+        self.assertIsNone(object_info(404, HTTPHeaders({'Content-Length': '10'})))
+        self.assertIsNone(object_info(200, HTTPHeaders({'Content-Length': '10', 'Content-Encoding': 'gzip'})))
+
+
+class TestConditionals(unittest.TestCase):
+
+    def test_if_none_match(self):
+        info = make_info()
+
+        self.assertTrue(is_not_modified({'If-None-Match': '"v0", "v1"'}, info))
+        self.assertTrue(is_not_modified({'If-None-Match': 'W/"v1"'}, info))
+        self.assertTrue(is_not_modified({'If-None-Match': '*'}, info))
+        self.assertFalse(is_not_modified({'If-None-Match': '"v0"'}, info))
+        # If-Modified-Since is ignored next to If-None-Match
+        self.assertFalse(is_not_modified({'If-None-Match': '"v0"', 'If-Modified-Since': LAST_MODIFIED}, info))
+        self.assertFalse(is_not_modified({'If-None-Match': '"v1"'}, make_info(etag=None)))
+
+    def test_if_modified_since(self):
+        info = make_info()
+
+        self.assertTrue(is_not_modified({'If-Modified-Since': LAST_MODIFIED}, info))
+        self.assertTrue(is_not_modified({'If-Modified-Since': 'Wed, 16 Nov 1994 00:00:00 GMT'}, info))
+        self.assertFalse(is_not_modified({'If-Modified-Since': 'Mon, 14 Nov 1994 00:00:00 GMT'}, info))
+        self.assertFalse(is_not_modified({'If-Modified-Since': 'yesterday'}, info))
+        self.assertFalse(is_not_modified({}, info))
+
+    def test_if_range(self):
+        info = make_info()
+
+        self.assertTrue(if_range_matches('"v1"', info))
+        self.assertFalse(if_range_matches('"v0"', info))
+        self.assertFalse(if_range_matches('W/"v1"', info))
+        self.assertFalse(if_range_matches('"v1"', make_info(etag='W/"v1"')))
+        self.assertTrue(if_range_matches(LAST_MODIFIED, info))
+        self.assertFalse(if_range_matches('Wed, 16 Nov 1994 00:00:00 GMT', info))
+        self.assertFalse(if_range_matches(LAST_MODIFIED, make_info(last_modified=None)))
+
+
+@patch('rangerequestsproxy.metadata.time')
+class TestMetadataCache(unittest.TestCase):
+
+    def test_entries_expire(self, time_mock):
+        cache = MetadataCache(ttl=30)
+        time_mock.time.return_value = 1000
+        cache.update('/a.mp4', 206, HTTPHeaders({'Content-Range': 'bytes 0-9/100', 'ETag': '"v1"'}))
+
+        time_mock.time.return_value = 1030
+        self.assertEqual(cache.get('/a.mp4').size, 100)
+        time_mock.time.return_value = 1031
+        self.assertIsNone(cache.get('/a.mp4'))
+        self.assertEqual(cache.stats(), {"objects": 0, "hits": 1, "misses": 1})
+
+    def test_not_modified_refreshes_entry(self, time_mock):
+        cache = MetadataCache(ttl=30)
+        time_mock.time.return_value = 1000
+        cache.update('/a.mp4', 206, HTTPHeaders({'Content-Range': 'bytes 0-9/100', 'ETag': '"v1"'}))
+
+        time_mock.time.return_value = 1020
+        cache.update('/a.mp4', 304, HTTPHeaders({'ETag': '"v1"'}))
+        time_mock.time.return_value = 1040
+
+        self.assertEqual(cache.get('/a.mp4').etag, '"v1"')
+
+    def test_unsatisfiable_range_keeps_validators(self, time_mock):
+        cache = MetadataCache(ttl=30)
+        time_mock.time.return_value = 1000
+        cache.update('/a.mp4', 206, HTTPHeaders({'Content-Range': 'bytes 0-9/100', 'ETag': '"v1"'}))
+        cache.update('/a.mp4', 416, HTTPHeaders({'Content-Range': 'bytes */100'}))
+
+        self.assertEqual(cache.get('/a.mp4').etag, '"v1"')
+
+    def test_size_limit(self, time_mock):
+        cache = MetadataCache(max_objects=1)
+        time_mock.time.return_value = 1000
+        cache.update('/a.mp4', 200, HTTPHeaders({'Content-Length': '1'}))
+        cache.update('/b.mp4', 200, HTTPHeaders({'Content-Length': '2'}))
+
+        self.assertIsNone(cache.get('/a.mp4'))
+        self.assertEqual(cache.get('/b.mp4').size, 2)
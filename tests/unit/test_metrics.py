@@ -0,0 +1,44 @@
+import unittest
+
+from rangerequestsproxy.metrics import CallbackMetric, Counter, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter_by_label(self):
+        counter = Counter('responses_total', 'Responses.', 'code')
+        counter.inc(206)
+        counter.inc(206)
+        counter.inc(404, amount=3)
+
+        self.assertEqual(counter.value(206), 2)
+        self.assertEqual(list(counter.samples()), [('responses_total', (('code', 206),), 2),
+                                                   ('responses_total', (('code', 404),), 3)])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('latency_seconds', 'Latency.', (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        self.assertEqual(list(histogram.samples()), [
+            ('latency_seconds_bucket', (('le', '0.1'),), 2),
+            ('latency_seconds_bucket', (('le', '1'),), 3),
+            ('latency_seconds_bucket', (('le', '+Inf'),), 4),
+            ('latency_seconds_sum', (), 3.65),
+            ('latency_seconds_count', (), 4),
+        ])
+
+    def test_render_text_format(self):
+        registry = Registry()
+        registry.register(Counter('requests_total', 'Requests.')).inc()
+        registry.register(CallbackMetric('in_flight', 'In flight.', lambda: {'http://a:9000': 2, 'http://"b"': 0},
+                                         label_name='upstream'))
+
+        self.assertEqual(registry.render(), (
+            '# HELP requests_total Requests.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total 1\n'
+            '# HELP in_flight In flight.\n'
+            '# TYPE in_flight gauge\n'
+            'in_flight{upstream="http://\\"b\\""} 0\n'
+            'in_flight{upstream="http://a:9000"} 2\n'))
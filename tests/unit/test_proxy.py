@@ -1,13 +1,44 @@
+import asyncio
+import gzip
 import json
+import os
+import shutil
+import tempfile
 import unittest
+from concurrent.futures import Future
 
+import pycurl
 from mock import patch, MagicMock
-from rangerequestsproxy.proxy import ProxyHandler, StatsHandler
+from rangerequestsproxy import proxy
+from rangerequestsproxy.balancer import Balancer
+from rangerequestsproxy.cache import BlockCache
+from rangerequestsproxy.compression import CompressionPolicy
+from rangerequestsproxy.config import ConfigError, ConfigFile
+from rangerequestsproxy.hedging import HedgedFetch, HedgingPolicy
+from rangerequestsproxy.inflight import InflightRegistry
+from rangerequestsproxy.localfile import LocalFiles
+from rangerequestsproxy.metadata import MetadataCache
+from rangerequestsproxy.split import SplitPolicy
+from rangerequestsproxy.metrics import Counter, Histogram, Registry
+from rangerequestsproxy.sharedstats import SharedCounters
+from rangerequestsproxy.upstream import UpstreamPool
+from rangerequestsproxy.readahead import Readahead
+from rangerequestsproxy.shaping import Shaper
+from rangerequestsproxy.proxy import ConfigHandler, MetricsHandler, ProxyHandler, StatsHandler
+from tornado.curl_httpclient import CurlError
 from tornado.httpclient import HTTPError
+from tornado.httputil import HTTPHeaders
+from tornado.tcpclient import TCPClient
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from tornado.web import Application
 
 
-class TestStatsHandler(unittest.TestCase):
+class TestStatsHandler(AsyncTestCase):
     @patch('rangerequestsproxy.proxy.START_TIME', 1000)
+    @patch('rangerequestsproxy.proxy.UPSTREAM_POOL', UpstreamPool())
+    @patch('rangerequestsproxy.proxy.BALANCER', Balancer())
+    @patch('rangerequestsproxy.proxy.HEDGING', HedgingPolicy())
+    @patch('rangerequestsproxy.proxy.METADATA', None)
     @patch('rangerequestsproxy.proxy.time')
     def test_stats(self, time_mock):
         """
@@ -24,19 +55,30 @@ class TestStatsHandler(unittest.TestCase):
         result = stats_handler._write_buffer[0].decode("utf-8")
         result = json.JSONDecoder().decode(result)
 
-        self.assertEqual(result, {"uptime_seconds": 1050 - 1000, "total_bytes_transferred": 0})
+        self.assertEqual(result, {"uptime_seconds": 1050 - 1000, "total_bytes_transferred": 0,
+                                  "upstream_pool": {"active": 0, "idle": 0, "queued": 0, "upstreams": {}},
+                                  "balancer": {"policy": "random", "upstreams": {}},
+                                  "hedging": {"hedges_fired": 0, "hedges_won": 0, "retries": 0, "budget_exhausted": 0,
+                                              "first_byte_timeouts": 0, "hedge_delay_ms": 50.0}})
 
     @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
     @patch('rangerequestsproxy.proxy.START_TIME', 1000)
     @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @patch('rangerequestsproxy.proxy.UPSTREAM_POOL', UpstreamPool())
+    @patch('rangerequestsproxy.proxy.BALANCER', Balancer())
+    @patch('rangerequestsproxy.proxy.HEDGING', HedgingPolicy())
+    @patch('rangerequestsproxy.proxy.METADATA', None)
+    @patch('rangerequestsproxy.balancer.time')
     @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
     @patch('rangerequestsproxy.proxy.time')
-    def test_stats_total_bytes_transferred(self, time_mock, http_client_mock):
+    @gen_test
+    async def test_stats_total_bytes_transferred(self, time_mock, http_client_mock, balancer_time_mock):
         """
             Simulates following request:
             curl -i http://localhost:8000/stats
         """
-        self.make_some_valid_request(http_client_mock)
+        balancer_time_mock.time.return_value = 1000
+        await self.make_some_valid_request(http_client_mock)
 
         stats_handler = StatsHandler(application=MagicMock(), request=MagicMock(uri='/stats'))
         stats_handler.finish = MagicMock()
@@ -47,9 +89,18 @@ class TestStatsHandler(unittest.TestCase):
         result = stats_handler._write_buffer[0].decode("utf-8")
         result = json.JSONDecoder().decode(result)
 
-        self.assertEqual(result, {"uptime_seconds": 1050 - 1000, "total_bytes_transferred": 10})
+        # the finished upstream connection stays open for reuse
+        upstream = {"active": 0, "idle": 1, "queued": 0, "requests": 1}
+        self.assertEqual(result, {"uptime_seconds": 1050 - 1000, "total_bytes_transferred": 10,
+                                  "upstream_pool": {"active": 0, "idle": 1, "queued": 0,
+                                                    "upstreams": {"http://127.0.0.1:9000": upstream}},
+                                  "balancer": {"policy": "random", "upstreams": {"http://127.0.0.1:9000": {
+                                      "weight": 1, "outstanding": 0, "ewma_ms": 0.0, "requests": 1, "errors": 0,
+                                      "consecutive_errors": 0, "healthy": True}}},
+                                  "hedging": {"hedges_fired": 0, "hedges_won": 0, "retries": 0, "budget_exhausted": 0,
+                                              "first_byte_timeouts": 0, "hedge_delay_ms": 50.0}})
 
-    def make_some_valid_request(self, http_client_mock):
+    async def make_some_valid_request(self, http_client_mock):
         """
             Simulates following request:
             curl -i --header "Range: bytes=0-50" http://localhost:8000/img.jpg?range=bytes=0-50
@@ -62,27 +113,65 @@ class TestStatsHandler(unittest.TestCase):
         get_argument_mock.return_value = 'bytes=0-50'
         proxy_handler.get_argument = get_argument_mock
 
-        def fetch_mock(req, callback, raise_error=False):
+        async def fetch_mock(req, raise_error=False):
             all_headers = MagicMock()
             all_headers.get_all.return_value = [('Content-Type', 'image/jpeg'),
                                                 ('Content-Range', 'bytes 50-100/1000'),
                                                 ('X-Http-Reason', 'Partial Content')]
             response_mock = MagicMock(error=None, code=206, body=b'0123456789', headers=all_headers)
-            callback(response_mock)
+            return response_mock
 
         http_client_mock.return_value.fetch = fetch_mock
 
-        proxy_handler.get()
+        await proxy_handler.get()
 
         self.assertEqual(proxy_handler._write_buffer[0], b'0123456789')
 
 
-class TestProxyHandler(unittest.TestCase):
+class TestMetricsHandler(unittest.TestCase):
+    responses = Counter('responses_total', 'Responses.', 'code')
+    duration = Histogram('request_duration_seconds', 'Duration.', (0.01, 0.1))
+    size = Histogram('response_size_bytes', 'Size.', (1024,))
+    metrics = Registry()
+    for metric in (responses, duration, size):
+        metrics.register(metric)
+
+    @patch('rangerequestsproxy.proxy.METRICS', metrics)
+    @patch('rangerequestsproxy.proxy.RESPONSES', responses)
+    @patch('rangerequestsproxy.proxy.REQUEST_DURATION', duration)
+    @patch('rangerequestsproxy.proxy.RESPONSE_SIZE', size)
+    def test_finished_requests_are_recorded(self):
+        """
+            Simulates following request:
+            curl -i http://localhost:8000/metrics
+        """
+        proxy_handler = ProxyHandler(application=MagicMock(), request=MagicMock(uri='/img.jpg'))
+        proxy_handler.request.request_time.return_value = 0.05
+        proxy_handler.set_status(206)
+        proxy_handler.write(b'0123456789')
+        proxy_handler._transforms = []
+        proxy_handler.request.connection.write_headers.return_value = Future()
+        proxy_handler.flush()
+        proxy_handler.on_finish()
+
+        metrics_handler = MetricsHandler(application=MagicMock(), request=MagicMock(uri='/metrics'))
+        metrics_handler.get()
+
+        self.assertTrue(metrics_handler._headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = metrics_handler._write_buffer[0].decode('utf-8').splitlines()
+        self.assertIn('responses_total{code="206"} 1', lines)
+        self.assertIn('request_duration_seconds_bucket{le="0.01"} 0', lines)
+        self.assertIn('request_duration_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('response_size_bytes_sum 10', lines)
+
+
+class TestProxyHandler(AsyncTestCase):
 
     @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
     @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
     @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
-    def test_successful_206_request_with_valid_ranges(self, http_client_mock):
+    @gen_test
+    async def test_successful_206_request_with_valid_ranges(self, http_client_mock):
         """
             Simulates following request:
             curl -i --header "Range: bytes=0-50" http://localhost:8000/img.jpg?range=bytes=0-50
@@ -95,17 +184,17 @@ class TestProxyHandler(unittest.TestCase):
         get_argument_mock.return_value = 'bytes=0-50'
         proxy_handler.get_argument = get_argument_mock
 
-        def fetch_mock(req, callback, raise_error=False):
+        async def fetch_mock(req, raise_error=False):
             all_headers = MagicMock()
             all_headers.get_all.return_value = [('Content-Type', 'image/jpeg'),
                                                 ('Content-Range', 'bytes 0-50/1000'),
                                                 ('X-Http-Reason', 'Partial Content')]
             response_mock = MagicMock(error=None, code=206, body=b'0123456789', headers=all_headers)
-            callback(response_mock)
+            return response_mock
 
         http_client_mock.return_value.fetch = fetch_mock
 
-        proxy_handler.get()
+        await proxy_handler.get()
 
         self.assertEqual(proxy_handler._write_buffer[0], b'0123456789')
         self.assertEqual(proxy_handler._status_code, 206)
@@ -117,7 +206,8 @@ class TestProxyHandler(unittest.TestCase):
 
     @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
     @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
-    def test_requesterange_not_satisfiable_intervals_do_not_match(self):
+    @gen_test
+    async def test_requesterange_not_satisfiable_intervals_do_not_match(self):
         """
             Simulates following request:
             curl -i --header "Range: bytes=0-50" http://localhost:8000/img.jpg?range=bytes=50-100
@@ -130,7 +220,7 @@ class TestProxyHandler(unittest.TestCase):
         get_argument_mock.return_value = 'bytes=50-100'
         proxy_handler.get_argument = get_argument_mock
 
-        proxy_handler.get()
+        await proxy_handler.get()
 
         result = proxy_handler._write_buffer[0].decode("utf-8")
         result = json.JSONDecoder().decode(result)
@@ -140,7 +230,8 @@ class TestProxyHandler(unittest.TestCase):
 
     @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
     @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
-    def test_requested_range_not_satisfiable_invalid_range(self):
+    @gen_test
+    async def test_requested_range_not_satisfiable_invalid_range(self):
         """
             Simulates following request:
             curl -i --header "Range: bytes=a-50" http://localhost:8000/img.jpg?range=bytes=50-100
@@ -150,7 +241,7 @@ class TestProxyHandler(unittest.TestCase):
                                                        uri='/img.jpg'))
         proxy_handler.finish = MagicMock()
 
-        proxy_handler.get()
+        await proxy_handler.get()
 
         result = proxy_handler._write_buffer[0].decode("utf-8")
         result = json.JSONDecoder().decode(result)
@@ -161,7 +252,8 @@ class TestProxyHandler(unittest.TestCase):
     @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
     @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
     @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
-    def test_upstream_server_not_available(self, http_client_mock):
+    @gen_test
+    async def test_upstream_server_not_available(self, http_client_mock):
         """
             Simulates following request:
             curl -i --header "Range: bytes=0-50" http://localhost:8000/img.jpg
@@ -171,13 +263,13 @@ class TestProxyHandler(unittest.TestCase):
                                                        uri='/img.jpg'))
         proxy_handler.finish = MagicMock()
 
-        def fetch_mock(req, callback, raise_error=False):
+        async def fetch_mock(req, raise_error=False):
             response_mock = MagicMock(error=HTTPError(code=500), body=None, code=500)
-            callback(response_mock)
+            return response_mock
 
         http_client_mock.return_value.fetch = fetch_mock
 
-        proxy_handler.get()
+        await proxy_handler.get()
 
         result = proxy_handler._write_buffer[0].decode("utf-8")
         result = json.JSONDecoder().decode(result)
@@ -188,7 +280,8 @@ class TestProxyHandler(unittest.TestCase):
     @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
     @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
     @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
-    def test_file_not_found(self, http_client_mock):
+    @gen_test
+    async def test_file_not_found(self, http_client_mock):
         """
             Simulates following request:
             curl -i --header "Range: bytes=0-50" http://localhost:8000/img.jpg
@@ -198,15 +291,15 @@ class TestProxyHandler(unittest.TestCase):
                                                        uri='/img_do_not_exists.jpg'))
         proxy_handler.finish = MagicMock()
 
-        def fetch_mock(req, callback, raise_error=False):
+        async def fetch_mock(req, raise_error=False):
             response_mock = MagicMock(error=HTTPError(code=404),
                                       body=b'{"error": "There is no such file"}',
                                       code=404)
-            callback(response_mock)
+            return response_mock
 
         http_client_mock.return_value.fetch = fetch_mock
 
-        proxy_handler.get()
+        await proxy_handler.get()
 
         result = proxy_handler._write_buffer[0].decode("utf-8")
         result = json.JSONDecoder().decode(result)
@@ -217,7 +310,8 @@ class TestProxyHandler(unittest.TestCase):
     @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
     @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
     @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
-    def test_successful_206_request_with_valid_ranges_and_ifrange(self, http_client_mock):
+    @gen_test
+    async def test_successful_206_request_with_valid_ranges_and_ifrange(self, http_client_mock):
         """
             Simulates following request:
             curl -i --header "Range: bytes=0-50" \
@@ -235,17 +329,17 @@ class TestProxyHandler(unittest.TestCase):
         get_argument_mock.return_value = 'bytes=0-50'
         proxy_handler.get_argument = get_argument_mock
 
-        def fetch_mock(req, callback, raise_error=False):
+        async def fetch_mock(req, raise_error=False):
             all_headers = MagicMock()
             all_headers.get_all.return_value = [('Content-Type', 'image/jpeg'),
                                                 ('Content-Range', 'bytes 0-50/1000'),
                                                 ('X-Http-Reason', 'Partial Content')]
             response_mock = MagicMock(error=None, code=206, body=b'0123456789', headers=all_headers)
-            callback(response_mock)
+            return response_mock
 
         http_client_mock.return_value.fetch = fetch_mock
 
-        proxy_handler.get()
+        await proxy_handler.get()
 
         self.assertEqual(proxy_handler._write_buffer[0], b'0123456789')
         self.assertEqual(proxy_handler._status_code, 206)
@@ -254,3 +348,1043 @@ class TestProxyHandler(unittest.TestCase):
         self.assertEqual(proxy_handler._headers._dict['Content-Type'], 'image/jpeg')
         self.assertEqual(proxy_handler._headers._dict['Content-Range'], 'bytes 0-50/1000')
         self.assertEqual(proxy_handler._headers._dict['X-Http-Reason'], 'Partial Content')
+
+
+class TestProxyHandlerStreaming(AsyncTestCase):
+
+    def make_streaming_handler(self):
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(headers={'Range': 'bytes=0-'}, uri='/video.mp4'))
+        proxy_handler.finish = MagicMock()
+        # normally set by RequestHandler._execute, needed once headers are flushed
+        proxy_handler._transforms = []
+        return proxy_handler
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.STREAMING', True)
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_streaming_206_request_forwards_headers_and_chunks(self, http_client_mock):
+        """
+            Simulates following request with RANGE_REQUESTS_PROXY_STREAMING=1:
+            curl -i --header "Range: bytes=0-" http://localhost:8000/video.mp4
+        """
+        proxy_handler = self.make_streaming_handler()
+
+        async def fetch_mock(req, raise_error=False):
+            req.header_callback('HTTP/1.1 206 Partial Content\r\n')
+            req.header_callback('Content-Type: video/mp4\r\n')
+            req.header_callback('Content-Range: bytes 0-9/10\r\n')
+            req.header_callback('Content-Length: 10\r\n')
+            req.header_callback('Transfer-Encoding: identity\r\n')
+            req.header_callback('\r\n')
+            req.streaming_callback(b'01234')
+            req.streaming_callback(b'56789')
+            return MagicMock(error=None, code=206, body=b'')
+
+        http_client_mock.return_value.fetch = fetch_mock
+
+        await proxy_handler.get()
+
+        connection = proxy_handler.request.connection
+        start_line, headers, _ = connection.write_headers.call_args[0]
+        self.assertEqual(start_line.code, 206)
+        self.assertEqual(headers['Content-Type'], 'video/mp4')
+        self.assertEqual(headers['Content-Range'], 'bytes 0-9/10')
+        self.assertEqual(headers['Content-Length'], '10')
+        self.assertEqual(headers['Accept-Ranges'], 'bytes')
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertEqual([c[0][0] for c in connection.write.call_args_list], [b'01234', b'56789'])
+        self.assertEqual(proxy.TOTAL_BYTES_TRANSFERRED, 10)
+        proxy_handler.finish.assert_called_once_with()
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.STREAMING', True)
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_streaming_upstream_not_available(self, http_client_mock):
+        proxy_handler = self.make_streaming_handler()
+
+        async def fetch_mock(req, raise_error=False):
+            return MagicMock(error=HTTPError(code=599), body=None, code=599)
+
+        http_client_mock.return_value.fetch = fetch_mock
+
+        await proxy_handler.get()
+
+        result = json.JSONDecoder().decode(proxy_handler._write_buffer[0].decode("utf-8"))
+        self.assertEqual(result, {"error": "Service temporary unavailable: Please try again later."})
+        self.assertEqual(proxy_handler._status_code, 500)
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.STREAMING', True)
+    @patch('rangerequestsproxy.proxy.HEDGING', HedgingPolicy(max_retries=0))
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_upstream_failing_mid_body_drops_the_connection(self, http_client_mock):
+        # Curl reports the origin closing the connection as CurlError, an HTTPError with code 599. An upstream
+        # that just ends early leaves fewer bytes than its Content-Length promised
+        for result in (MagicMock(error=CurlError(18, 'transfer closed'), body=b'', code=599),
+                       MagicMock(error=None, body=b'', code=206)):
+            proxy_handler = self.make_streaming_handler()
+
+            async def fetch_mock(req, raise_error=False):
+                req.header_callback('HTTP/1.1 206 Partial Content\r\n')
+                req.header_callback('Content-Range: bytes 0-9/10\r\n')
+                req.header_callback('Content-Length: 10\r\n')
+                req.header_callback('\r\n')
+                req.streaming_callback(b'01234')
+                return result
+
+            http_client_mock.return_value.fetch = fetch_mock
+
+            await proxy_handler.get()
+
+            proxy_handler.request.connection.close.assert_called_once_with()
+            self.assertFalse(proxy_handler.finish.called)
+
+    @patch('rangerequestsproxy.proxy.STREAM_HIGH_WATER_MARK', 8)
+    @patch('rangerequestsproxy.upstream.pycurl')
+    def test_streaming_pauses_upstream_until_client_catches_up(self, pycurl_mock):
+        proxy_handler = self.make_streaming_handler()
+        flush_future = Future()
+        proxy_handler.flush = MagicMock(return_value=flush_future)
+        curl = MagicMock()
+        proxy_handler._prepare_upstream_curl(curl)
+
+        proxy_handler._handle_upstream_chunk(b'0123')
+        self.assertFalse(curl.pause.called)
+
+        proxy_handler._handle_upstream_chunk(b'4567')
+        curl.pause.assert_called_once_with(pycurl_mock.PAUSE_RECV)
+
+        flush_future.set_result(None)
+        curl.pause.assert_called_with(pycurl_mock.PAUSE_CONT)
+        self.assertFalse(proxy_handler._upstream_paused)
+
+    @patch('rangerequestsproxy.proxy.STREAM_HIGH_WATER_MARK', 4)
+    def test_finished_transfer_is_not_paused(self):
+        proxy_handler = self.make_streaming_handler()
+        proxy_handler.flush = MagicMock(return_value=Future())
+        curl = MagicMock()
+        curl.pause.side_effect = pycurl.error(43, 'pause/unpause failed')
+        proxy_handler._prepare_upstream_curl(curl)
+
+        proxy_handler._handle_upstream_chunk(b'0123')
+
+        curl.pause.assert_called_once_with(pycurl.PAUSE_RECV)
+        self.assertFalse(proxy_handler._upstream_paused)
+
+    @patch('rangerequestsproxy.proxy.STREAM_HIGH_WATER_MARK', 8)
+    def test_shared_stream_is_paused_while_any_subscriber_lags(self):
+        registry = InflightRegistry()
+        slow_flush, fast_flush = Future(), Future()
+        starter, joiner = self.make_streaming_handler(), self.make_streaming_handler()
+        starter.flush = MagicMock(return_value=slow_flush)
+        joiner.flush = MagicMock(side_effect=[fast_flush, Future()])
+        stream = registry.start_stream('key', starter._handle_upstream_header, starter._handle_upstream_chunk,
+                                       MagicMock())
+        registry.join_stream('key', joiner._handle_upstream_header, joiner._handle_upstream_chunk, MagicMock())
+        starter._stream = joiner._stream = stream
+        curl = MagicMock()
+        stream.prepare_curl(curl)
+
+        stream.on_chunk(b'01234567')
+        curl.pause.assert_called_once_with(pycurl.PAUSE_RECV)
+
+        # The fast joiner catching up does not resume the transfer the slow starter still waits for
+        fast_flush.set_result(None)
+        self.assertEqual(curl.pause.call_count, 1)
+        self.assertTrue(stream.paused)
+
+        slow_flush.set_result(None)
+        curl.pause.assert_called_with(pycurl.PAUSE_CONT)
+        self.assertFalse(stream.paused)
+
+        # Now the joiner lags behind, and the starter going away does not resume it either
+        stream.on_chunk(b'89abcdef')
+        curl.pause.assert_called_with(pycurl.PAUSE_RECV)
+        starter.on_connection_close()
+        self.assertTrue(stream.paused)
+        joiner.on_connection_close()
+        curl.pause.assert_called_with(pycurl.PAUSE_CONT)
+        self.assertEqual(curl.pause.call_count, 4)
+
+
+class TestProxyHandlerCache(AsyncTestCase):
+
+    async def make_cached_request(self, range_str, uri='/video.mp4', range_from_query=None):
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(headers={'Range': range_str}, uri=uri))
+        proxy_handler.finish = MagicMock()
+        proxy_handler.get_argument = MagicMock(return_value=range_from_query)
+        await proxy_handler.get()
+        return proxy_handler
+
+    def upstream_fetch_mock(self, content, fetched_ranges):
+        async def fetch_mock(req, raise_error=False):
+            fetched_ranges.append(req.headers['Range'])
+            start, end = req.headers['Range'][len('bytes='):].split('-')
+            start, end = int(start), min(int(end), len(content) - 1)
+            all_headers = HTTPHeaders({'Content-Type': 'video/mp4',
+                                       'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content)),
+                                       'ETag': '"v1"'})
+            return MagicMock(error=None, code=206, body=content[start:end + 1], headers=all_headers)
+        return fetch_mock
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.BLOCK_CACHE', BlockCache(memory_size=64, block_size=4))
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_ranges_are_served_from_cached_blocks(self, http_client_mock):
+        fetched_ranges = []
+        http_client_mock.return_value.fetch = self.upstream_fetch_mock(b'0123456789', fetched_ranges)
+
+        proxy_handler = await self.make_cached_request('bytes=1-5', uri='/video.mp4?range=bytes=1-5',
+                                                       range_from_query='bytes=1-5')
+        self.assertEqual(fetched_ranges, ['bytes=0-7'])
+        self.assertEqual(proxy_handler._write_buffer[0], b'12345')
+        self.assertEqual(proxy_handler._status_code, 206)
+        self.assertEqual(proxy_handler._headers['Content-Range'], 'bytes 1-5/10')
+        self.assertEqual(proxy_handler._headers['ETag'], '"v1"')
+
+        # blocks 0 and 1 are cached, only block 2 has to come from the upstream
+        proxy_handler = await self.make_cached_request('bytes=6-')
+        self.assertEqual(fetched_ranges, ['bytes=0-7', 'bytes=8-11'])
+        self.assertEqual(proxy_handler._write_buffer[0], b'6789')
+        self.assertEqual(proxy_handler._headers['Content-Range'], 'bytes 6-9/10')
+
+        proxy_handler = await self.make_cached_request('bytes=2-9')
+        self.assertEqual(len(fetched_ranges), 2)
+        self.assertEqual(proxy_handler._write_buffer[0], b'23456789')
+        self.assertEqual(proxy_handler._headers['Content-Length'], '8')
+        self.assertEqual(proxy.BLOCK_CACHE.stats()['misses'], 3)
+        self.assertEqual(proxy.BLOCK_CACHE.stats()['hits'], 4)
+        self.assertEqual(proxy.TOTAL_BYTES_TRANSFERRED, 17)
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.BLOCK_CACHE', BlockCache(memory_size=64, block_size=4))
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_changed_object_is_not_stitched_from_stale_blocks(self, http_client_mock):
+        fetched_ranges = []
+        http_client_mock.return_value.fetch = self.upstream_fetch_mock(b'0123456789', fetched_ranges)
+        await self.make_cached_request('bytes=0-3')
+
+        fetch_v2 = self.upstream_fetch_mock(b'abcdefghij', fetched_ranges)
+
+        async def fetch_mock(req, raise_error=False):
+            response = await fetch_v2(req)
+            response.headers['ETag'] = '"v2"'
+            return response
+
+        http_client_mock.return_value.fetch = fetch_mock
+
+        proxy_handler = await self.make_cached_request('bytes=2-5')
+        self.assertEqual(fetched_ranges, ['bytes=0-3', 'bytes=4-7', 'bytes=2-5'])
+        self.assertEqual(proxy_handler._write_buffer[0], b'cdef')
+        self.assertEqual(proxy.BLOCK_CACHE.get_object('/video.mp4').validator, '"v2"')
+
+    @patch('rangerequestsproxy.proxy.START_TIME', 1000)
+    @patch('rangerequestsproxy.proxy.BLOCK_CACHE', BlockCache(memory_size=64, block_size=4))
+    @patch('rangerequestsproxy.proxy.time')
+    def test_stats_include_cache_counters(self, time_mock):
+        stats_handler = StatsHandler(application=MagicMock(), request=MagicMock(uri='/stats'))
+        stats_handler.finish = MagicMock()
+        time_mock.time.return_value = 1050
+
+        stats_handler.get()
+
+        result = json.JSONDecoder().decode(stats_handler._write_buffer[0].decode("utf-8"))
+        self.assertEqual(result['cache']['hits'], 0)
+        self.assertEqual(result['cache']['misses'], 0)
+
+
+class TestProxyHandlerCoalescing(AsyncTestCase):
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.INFLIGHT', InflightRegistry())
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_concurrent_overlapping_requests_share_upstream_fetch(self, http_client_mock):
+        pending = []
+
+        def fetch_mock(req, raise_error=False):
+            pending.append(asyncio.Future())
+            return pending[-1]
+
+        http_client_mock.return_value.fetch = fetch_mock
+
+        handlers = []
+        for range_str in ('bytes=0-9', 'bytes=0-9', 'bytes=3-5'):
+            proxy_handler = ProxyHandler(application=MagicMock(),
+                                         request=MagicMock(method='GET', headers={'Range': range_str},
+                                                           uri='/video.mp4'))
+            proxy_handler.finish = MagicMock()
+            handlers.append(proxy_handler)
+        requests = asyncio.gather(*[h.get() for h in handlers])
+        # let every request reach the upstream
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+        self.assertEqual(len(pending), 1)
+        all_headers = HTTPHeaders({'Content-Type': 'video/mp4', 'Content-Range': 'bytes 0-9/100'})
+        pending[0].set_result(MagicMock(error=None, code=206, body=b'0123456789', headers=all_headers))
+        await requests
+
+        self.assertEqual([h._write_buffer[0] for h in handlers], [b'0123456789', b'0123456789', b'345'])
+        self.assertEqual(handlers[2]._headers['Content-Range'], 'bytes 3-5/100')
+        self.assertEqual(handlers[2]._headers['Content-Length'], '3')
+        self.assertEqual(proxy.TOTAL_BYTES_TRANSFERRED, 23)
+
+
+class TestProxyHandlerCancellation(AsyncTestCase):
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.INFLIGHT', InflightRegistry())
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_client_disconnect_aborts_upstream_fetch(self, http_client_mock):
+        fetched = []
+
+        def fetch_mock(req, raise_error=False):
+            fetched.append(req)
+            return asyncio.Future()
+
+        http_client_mock.return_value.fetch = fetch_mock
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(method='GET', headers={'Range': 'bytes=0-9'},
+                                                       uri='/video.mp4'))
+        proxy_handler.finish = MagicMock()
+        request = asyncio.ensure_future(proxy_handler.get())
+        for _ in range(2):
+            await asyncio.sleep(0)
+        self.assertEqual(len(fetched), 1)
+
+        proxy_handler.on_connection_close()
+        await request
+
+        self.assertFalse(proxy_handler.finish.called)
+        self.assertEqual(proxy.INFLIGHT._fetches, {})
+        # curl aborts the transfer once its progress function returns non-zero
+        curl = MagicMock()
+        fetched[0].prepare_curl_callback(curl)
+        progress = [c[0][1] for c in curl.setopt.call_args_list if c[0][0] == pycurl.XFERINFOFUNCTION][0]
+        self.assertEqual(progress(0, 0, 0, 0), 1)
+
+
+class TestProxyHandlerReadahead(AsyncTestCase):
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.INFLIGHT', InflightRegistry())
+    @patch('rangerequestsproxy.proxy.READAHEAD', Readahead(max_memory=1024, max_window=20))
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_sequential_reads_are_prefetched(self, http_client_mock):
+        content = bytes(bytearray(range(100)))
+        fetched_ranges = []
+
+        async def fetch_mock(req, raise_error=False):
+            fetched_ranges.append(req.headers['Range'])
+            start, end = [int(i) for i in req.headers['Range'][len('bytes='):].split('-')]
+            all_headers = HTTPHeaders({'Content-Type': 'video/mp4',
+                                       'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content))})
+            return MagicMock(error=None, code=206, body=content[start:end + 1], headers=all_headers)
+
+        http_client_mock.return_value.fetch = fetch_mock
+        handlers = []
+        for start in range(0, 50, 10):
+            proxy_handler = ProxyHandler(application=MagicMock(),
+                                         request=MagicMock(method='GET', remote_ip='127.0.0.1', uri='/video.mp4',
+                                                           headers={'Range': 'bytes={}-{}'.format(start, start + 9)}))
+            proxy_handler.finish = MagicMock()
+            await proxy_handler.get()
+            handlers.append(proxy_handler)
+        # the last prefetch is still on its way to the upstream
+        await asyncio.sleep(0)
+
+        # the third request proves the reader sequential, from then on the next window is fetched ahead
+        self.assertEqual(fetched_ranges, ['bytes=0-9', 'bytes=10-19', 'bytes=30-49', 'bytes=20-29', 'bytes=50-69'])
+        self.assertEqual([h._write_buffer[0] for h in handlers], [content[i:i + 10] for i in range(0, 50, 10)])
+        self.assertEqual(handlers[4]._headers['Content-Range'], 'bytes 40-49/100')
+        self.assertEqual(proxy.READAHEAD.stats()['hits'], 2)
+
+
+@patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+@patch('rangerequestsproxy.proxy.INFLIGHT', InflightRegistry())
+@patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+class TestProxyHandlerMetadata(AsyncTestCase):
+    content = bytes(bytearray(range(100)))
+
+    def setUp(self):
+        super(TestProxyHandlerMetadata, self).setUp()
+        self.fetched = []
+
+    async def fetch_mock(self, req, raise_error=False):
+        self.fetched.append(req)
+        all_headers = HTTPHeaders({'Content-Type': 'video/mp4', 'ETag': '"v1"'})
+        if req.headers.get('If-None-Match') == '"v1"':
+            return MagicMock(error=HTTPError(304), code=304, body=b'', headers=all_headers)
+        if 'Range' not in req.headers or req.headers.get('If-Range', '"v1"') != '"v1"':
+            all_headers['Content-Length'] = str(len(self.content))
+            return MagicMock(error=None, code=200, body=self.content, headers=all_headers)
+        start, end = [int(i) for i in req.headers['Range'][len('bytes='):].split('-')]
+        all_headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(self.content))
+        return MagicMock(error=None, code=206, body=self.content[start:end + 1], headers=all_headers)
+
+    async def request(self, headers, method='GET'):
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(method=method, headers=headers, uri='/video.mp4'))
+        proxy_handler.finish = MagicMock()
+        await proxy_handler.get()
+        return proxy_handler
+
+    @patch('rangerequestsproxy.proxy.METADATA', MetadataCache())
+    @gen_test
+    async def test_head_304_and_416_are_answered_locally(self, http_client_mock):
+        http_client_mock.return_value.fetch = self.fetch_mock
+        await self.request({'Range': 'bytes=0-9'})
+        self.assertEqual(len(self.fetched), 1)
+
+        head = await self.request({}, method='HEAD')
+        self.assertEqual(head._status_code, 200)
+        self.assertEqual(head._headers['Content-Length'], '100')
+        self.assertEqual(head._headers['ETag'], '"v1"')
+
+        not_modified = await self.request({'Range': 'bytes=0-9', 'If-None-Match': '"v1"'})
+        self.assertEqual(not_modified._status_code, 304)
+
+        unsatisfiable = await self.request({'Range': 'bytes=200-'})
+        self.assertEqual(unsatisfiable._status_code, 416)
+        self.assertEqual(unsatisfiable._headers['Content-Range'], 'bytes */100')
+
+        self.assertEqual(len(self.fetched), 1)
+
+    @patch('rangerequestsproxy.proxy.METADATA', MetadataCache())
+    @gen_test
+    async def test_outdated_if_range_gets_whole_object(self, http_client_mock):
+        http_client_mock.return_value.fetch = self.fetch_mock
+        await self.request({'Range': 'bytes=0-9'})
+
+        # the range would not be satisfiable, but the client's copy is outdated so the range does not apply
+        proxy_handler = await self.request({'Range': 'bytes=200-', 'If-Range': '"v0"'})
+
+        self.assertEqual(self.fetched[1].headers['If-Range'], '"v0"')
+        self.assertEqual(proxy_handler._status_code, 200)
+        self.assertEqual(proxy_handler._write_buffer[0], self.content)
+
+    @patch('rangerequestsproxy.proxy.METADATA', None)
+    @gen_test
+    async def test_conditional_requests_are_forwarded(self, http_client_mock):
+        http_client_mock.return_value.fetch = self.fetch_mock
+
+        proxy_handler = await self.request({'If-None-Match': '"v1"'})
+
+        self.assertNotIn('Range', self.fetched[0].headers)
+        self.assertEqual(self.fetched[0].headers['If-None-Match'], '"v1"')
+        self.assertEqual(proxy_handler._status_code, 304)
+        self.assertEqual(proxy_handler._headers['ETag'], '"v1"')
+
+
+@patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000,http://127.0.0.1:9001')
+@patch('rangerequestsproxy.proxy.INFLIGHT', InflightRegistry())
+@patch('rangerequestsproxy.proxy.METADATA', None)
+@patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+class TestProxyHandlerSplit(AsyncTestCase):
+    content = bytes(bytearray(range(256))) * 4
+
+    def setUp(self):
+        super(TestProxyHandlerSplit, self).setUp()
+        self.fetched = []
+
+    async def fetch_mock(self, req, raise_error=False):
+        self.fetched.append(req)
+        start, end = [int(i) for i in req.headers['Range'][len('bytes='):].split('-')]
+        headers = HTTPHeaders({'Content-Type': 'video/mp4', 'ETag': '"v1"',
+                               'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(self.content))})
+        return MagicMock(error=None, code=206, body=self.content[start:end + 1], headers=headers)
+
+    def make_handler(self, range_str):
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(method='GET', headers={'Range': range_str},
+                                                       uri='/video.mp4'))
+        proxy_handler._transforms = []
+        done = Future()
+        done.set_result(None)
+        proxy_handler.request.connection.write_headers.return_value = done
+        proxy_handler.request.connection.write.return_value = done
+        proxy_handler.finish = MagicMock()
+        return proxy_handler
+
+    @patch('rangerequestsproxy.proxy.SPLIT', SplitPolicy(part_size=300, parallelism=2))
+    @gen_test
+    async def test_large_range_is_fetched_in_parts(self, http_client_mock):
+        """
+            Simulates following request with RANGE_REQUESTS_PROXY_SPLIT_SIZE=300:
+            curl -i --header "Range: bytes=100-" http://localhost:8000/video.mp4
+        """
+        http_client_mock.return_value.fetch = self.fetch_mock
+        proxy_handler = self.make_handler('bytes=100-')
+
+        await proxy_handler.get()
+
+        self.assertEqual([req.headers['Range'] for req in self.fetched],
+                         ['bytes=100-299', 'bytes=300-599', 'bytes=600-899', 'bytes=900-1023'])
+        connection = proxy_handler.request.connection
+        start_line, headers, first_chunk = connection.write_headers.call_args[0]
+        self.assertEqual(start_line.code, 206)
+        self.assertEqual(headers['Content-Range'], 'bytes 100-1023/1024')
+        self.assertEqual(headers['Content-Length'], '924')
+        self.assertEqual(headers['ETag'], '"v1"')
+        body = first_chunk + b''.join(c[0][0] for c in connection.write.call_args_list)
+        self.assertEqual(body, self.content[100:])
+        proxy_handler.finish.assert_called_once_with()
+
+    @patch('rangerequestsproxy.proxy.SPLIT', SplitPolicy(part_size=300, parallelism=2))
+    @gen_test
+    async def test_small_range_is_not_split(self, http_client_mock):
+        http_client_mock.return_value.fetch = self.fetch_mock
+        proxy_handler = self.make_handler('bytes=0-299')
+
+        await proxy_handler.get()
+
+        self.assertEqual([req.headers['Range'] for req in self.fetched], ['bytes=0-299'])
+        self.assertEqual(proxy_handler._write_buffer[0], self.content[:300])
+
+
+class TestProxyHandlerLocalFiles(AsyncTestCase):
+
+    def setUp(self):
+        super(TestProxyHandlerLocalFiles, self).setUp()
+        self.root = tempfile.mkdtemp()
+        with open(os.path.join(self.root, 'video.mp4'), 'wb') as f:
+            f.write(b'0123456789')
+        self.local_files = LocalFiles(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(TestProxyHandlerLocalFiles, self).tearDown()
+
+    def make_handler(self, range_str, path='/video.mp4'):
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(headers={'Range': range_str}, uri=path, path=path))
+        proxy_handler._transforms = []
+        written = asyncio.Future()
+        written.set_result(None)
+        proxy_handler.request.connection.write_headers.return_value = written
+        proxy_handler.request.connection.write.return_value = written
+        proxy_handler.finish = MagicMock()
+        return proxy_handler
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', '')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_range_is_read_from_file(self):
+        """
+            Simulates following request:
+            curl -i --header "Range: bytes=2-4" http://localhost:8000/video.mp4
+        """
+        proxy_handler = self.make_handler('bytes=2-4')
+
+        with patch('rangerequestsproxy.proxy.LOCAL_FILES', self.local_files):
+            await proxy_handler.get()
+
+        self.assertEqual(proxy_handler._status_code, 206)
+        headers = proxy_handler.request.connection.write_headers.call_args[0][1]
+        self.assertEqual(headers['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(headers['Content-Length'], '3')
+        self.assertEqual(headers['Content-Type'], 'video/mp4')
+        self.assertEqual(headers['ETag'], self.local_files.open('/video.mp4').etag)
+        self.assertIn('Last-Modified', headers)
+        self.assertEqual(proxy_handler.request.connection.write.call_args[0][0], b'234')
+        self.assertEqual(proxy.TOTAL_BYTES_TRANSFERRED, 3)
+        proxy_handler.finish.assert_called_once_with()
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', '')
+    @patch('rangerequestsproxy.localfile.READ_SIZE', 4)
+    @gen_test
+    async def test_file_truncated_while_sent_drops_the_connection(self):
+        proxy_handler = self.make_handler('bytes=0-')
+        written = []
+
+        def write(chunk):
+            written.append(chunk)
+            # the file shrinks after the first chunk was sent
+            with open(os.path.join(self.root, 'video.mp4'), 'r+b') as f:
+                f.truncate(6)
+            return proxy_handler.request.connection.write_headers.return_value
+
+        proxy_handler.request.connection.write.side_effect = write
+        with patch('rangerequestsproxy.proxy.LOCAL_FILES', self.local_files):
+            await proxy_handler.get()
+
+        self.assertEqual(written, [b'0123', b'45'])
+        proxy_handler.request.connection.close.assert_called_once_with()
+        self.assertFalse(proxy_handler.finish.called)
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', '')
+    @gen_test
+    async def test_unsatisfiable_range_reports_size(self):
+        proxy_handler = self.make_handler('bytes=20-')
+
+        with patch('rangerequestsproxy.proxy.LOCAL_FILES', self.local_files):
+            await proxy_handler.get()
+
+        self.assertEqual(proxy_handler._status_code, 416)
+        self.assertEqual(proxy_handler._headers['Content-Range'], 'bytes */10')
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', '')
+    @gen_test
+    async def test_missing_file(self):
+        proxy_handler = self.make_handler('bytes=0-1', path='/missing.mp4')
+
+        with patch('rangerequestsproxy.proxy.LOCAL_FILES', self.local_files):
+            await proxy_handler.get()
+
+        self.assertEqual(proxy_handler._status_code, 404)
+
+
+class TestProxyHandlerMultipart(AsyncTestCase):
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.MULTIPART_MAX_GAP', 10)
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @gen_test
+    async def test_multiple_ranges_are_answered_with_multipart_byteranges(self, http_client_mock):
+        """
+            Simulates following request:
+            curl -i --header "Range: bytes=0-1,5-6,50-52" http://localhost:8000/img.jpg
+        """
+        content = bytes(bytearray(range(ord('a'), ord('a') + 26))) * 4
+        fetched_ranges = []
+
+        async def fetch_mock(req, raise_error=False):
+            fetched_ranges.append(req.headers['Range'])
+            start, end = [int(i) for i in req.headers['Range'][len('bytes='):].split('-')]
+            all_headers = HTTPHeaders({'Content-Type': 'image/jpeg', 'ETag': '"v1"',
+                                       'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content))})
+            return MagicMock(error=None, code=206, body=content[start:end + 1], headers=all_headers)
+
+        http_client_mock.return_value.fetch = fetch_mock
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(headers={'Range': 'bytes=50-52,0-1,5-6'}, uri='/img.jpg'))
+        proxy_handler.finish = MagicMock()
+
+        await proxy_handler.get()
+
+        # 0-1 and 5-6 are close enough to share one upstream request
+        self.assertEqual(fetched_ranges, ['bytes=0-6', 'bytes=50-52'])
+        self.assertEqual(proxy_handler._status_code, 206)
+        content_type = proxy_handler._headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        boundary = content_type.split('boundary=')[1]
+        body = proxy_handler._write_buffer[0]
+        self.assertEqual(body, (
+            '--{0}\r\nContent-Type: image/jpeg\r\nContent-Range: bytes 0-1/104\r\n\r\nab\r\n'
+            '--{0}\r\nContent-Type: image/jpeg\r\nContent-Range: bytes 5-6/104\r\n\r\nfg\r\n'
+            '--{0}\r\nContent-Type: image/jpeg\r\nContent-Range: bytes 50-52/104\r\n\r\nyza\r\n'
+            '--{0}--\r\n').format(boundary).encode('latin1'))
+        self.assertEqual(proxy_handler._headers['Content-Length'], str(len(body)))
+        self.assertEqual(proxy_handler._headers['ETag'], '"v1"')
+        self.assertEqual(proxy.TOTAL_BYTES_TRANSFERRED, len(body))
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.MULTIPART_MAX_GAP', 10)
+    @patch('rangerequestsproxy.proxy.METADATA', MetadataCache())
+    @patch('rangerequestsproxy.proxy.BLOCK_CACHE', None)
+    @patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_suffix_ranges_are_coalesced_when_metadata_knows_the_size(self, http_client_mock):
+        content = bytes(bytearray(range(ord('a'), ord('a') + 26))) * 4
+        proxy.METADATA.update('/img.jpg', 206, HTTPHeaders(
+            {'Content-Type': 'image/jpeg', 'ETag': '"v1"', 'Content-Range': 'bytes 0-0/104'}))
+        fetched_ranges = []
+
+        async def fetch_mock(req, raise_error=False):
+            fetched_ranges.append(req.headers['Range'])
+            start, end = [int(i) for i in req.headers['Range'][len('bytes='):].split('-')]
+            all_headers = HTTPHeaders({'Content-Type': 'image/jpeg', 'ETag': '"v1"',
+                                       'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content))})
+            return MagicMock(error=None, code=206, body=content[start:end + 1], headers=all_headers)
+
+        http_client_mock.return_value.fetch = fetch_mock
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(headers={'Range': 'bytes=95-96,-3'}, uri='/img.jpg'))
+        proxy_handler.finish = MagicMock()
+
+        await proxy_handler.get()
+
+        # The suffix resolves to 101-103, close enough to 95-96 to share one upstream request
+        self.assertEqual(fetched_ranges, ['bytes=95-103'])
+        self.assertEqual(proxy_handler._status_code, 206)
+        self.assertIn(b'Content-Range: bytes 101-103/104\r\n\r\nxyz', proxy_handler._write_buffer[0])
+
+    @patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000')
+    @patch('rangerequestsproxy.proxy.MAX_RANGE', 2)
+    @gen_test
+    async def test_too_many_ranges(self):
+        proxy_handler = ProxyHandler(application=MagicMock(),
+                                     request=MagicMock(headers={'Range': 'bytes=0-1,5-6,50-52'}, uri='/img.jpg'))
+        proxy_handler.finish = MagicMock()
+
+        await proxy_handler.get()
+
+        self.assertEqual(proxy_handler._status_code, 416)
+
+
+class TestProxyHandlerShaping(AsyncHTTPTestCase):
+    content = bytes(bytearray(range(256))) * 4
+
+    def get_app(self):
+        return Application([(r'.*', ProxyHandler)])
+
+    def setUp(self):
+        super(TestProxyHandlerShaping, self).setUp()
+        for patcher in (patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000'),
+                        patch('rangerequestsproxy.proxy.INFLIGHT', InflightRegistry()),
+                        patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        http_client_patcher = patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+        http_client_mock = http_client_patcher.start()
+        self.addCleanup(http_client_patcher.stop)
+
+        async def fetch_mock(req, raise_error=False):
+            start, end = [int(i) for i in req.headers['Range'][len('bytes='):].split('-')]
+            headers = HTTPHeaders({'Content-Type': 'video/mp4',
+                                   'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(self.content))})
+            return MagicMock(error=None, code=206, body=self.content[start:end + 1], headers=headers,
+                             effective_url=req.url)
+
+        http_client_mock.return_value.fetch = fetch_mock
+
+    @gen_test
+    async def test_body_is_sent_through_the_shaper(self):
+        """
+            Simulates following request:
+            curl -i --header "Range: bytes=0-99" http://localhost:8000/video.mp4
+        """
+        shaper = Shaper(rate=10 ** 6, upstream_rate=10 ** 6, chunk_size=16)
+        with patch('rangerequestsproxy.proxy.SHAPER', shaper):
+            response = await self.http_client.fetch(self.get_url('/video.mp4'), headers={'Range': 'bytes=0-99'})
+
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.content[:100])
+        self.assertEqual(list(shaper._upstream_buckets), ['http://127.0.0.1:9000'])
+        stats = shaper.stats()
+        self.assertEqual((stats["bytes_sent"], stats["inflight_bytes"], stats["streams"]), (100, 0, 0))
+
+    @gen_test
+    async def test_requests_are_turned_away_while_the_inflight_budget_is_used_up(self):
+        shaper = Shaper(max_inflight_bytes=100)
+        shaper.hold(shaper.open_stream('10.0.0.1'), 100)
+        with patch('rangerequestsproxy.proxy.SHAPER', shaper):
+            response = await self.http_client.fetch(self.get_url('/video.mp4'), headers={'Range': 'bytes=0-99'},
+                                                    raise_error=False)
+
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(shaper.stats()["rejected_requests"], 1)
+
+    @gen_test
+    async def test_disconnected_client_releases_its_queued_body(self):
+        shaper = Shaper(rate=2000, burst=0, chunk_size=100)
+        with patch('rangerequestsproxy.proxy.SHAPER', shaper):
+            stream = await TCPClient().connect('127.0.0.1', self.get_http_port())
+            await stream.write(b'GET /video.mp4 HTTP/1.1\r\nHost: localhost\r\nRange: bytes=0-999\r\n\r\n')
+            await stream.read_until(b'\r\n\r\n')
+            self.assertGreater(shaper.inflight_bytes, 0)
+            stream.close()
+            for _ in range(100):
+                if not shaper.streams:
+                    break
+                await asyncio.sleep(0.01)
+
+        self.assertEqual(shaper.streams, 0)
+        self.assertEqual(shaper.inflight_bytes, 0)
+        self.assertLess(shaper.bytes_sent, 1000)
+
+
+class TestProxyHandlerCompression(AsyncHTTPTestCase):
+    content = b'{"event": "download", "bytes": 1024}\n' * 200
+
+    def get_app(self):
+        return Application([(r'.*', ProxyHandler)])
+
+    def setUp(self):
+        super(TestProxyHandlerCompression, self).setUp()
+        self.compression = CompressionPolicy(types=['application/json'])
+        self.upstream_headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+        self.requests = []
+        for patcher in (patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://127.0.0.1:9000'),
+                        patch('rangerequestsproxy.proxy.INFLIGHT', InflightRegistry()),
+                        patch('rangerequestsproxy.proxy.COMPRESSION', self.compression),
+                        patch('rangerequestsproxy.proxy.METADATA', MetadataCache()),
+                        patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        http_client_patcher = patch('rangerequestsproxy.proxy.tornado.httpclient.AsyncHTTPClient')
+        http_client_mock = http_client_patcher.start()
+        self.addCleanup(http_client_patcher.stop)
+
+        async def fetch_mock(req, raise_error=False):
+            self.requests.append(req)
+            headers = HTTPHeaders(self.upstream_headers)
+            if req.method == 'HEAD':
+                headers['Content-Length'] = str(len(self.content))
+                return MagicMock(error=None, code=200, body=b'', headers=headers, effective_url=req.url)
+            if 'Range' not in req.headers:
+                return MagicMock(error=None, code=200, body=self.content, headers=headers, effective_url=req.url)
+            start, end = req.headers['Range'][len('bytes='):].split('-')
+            start, end = int(start), int(end) if end else len(self.content) - 1
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(self.content))
+            body = self.content[start:end + 1]
+            if req.streaming_callback is not None:
+                req.header_callback('HTTP/1.1 206 Partial Content\r\n')
+                for header, value in headers.get_all():
+                    req.header_callback('{}: {}\r\n'.format(header, value))
+                req.header_callback('\r\n')
+                req.streaming_callback(body[:1000])
+                req.streaming_callback(body[1000:])
+                body = b''
+            return MagicMock(error=None, code=206, body=body, headers=headers, effective_url=req.url)
+
+        http_client_mock.return_value.fetch = fetch_mock
+
+    async def fetch(self, headers):
+        return await self.http_client.fetch(self.get_url('/events.json'), headers=headers, decompress_response=False)
+
+    @gen_test
+    async def test_whole_object_is_compressed_and_the_variant_cached(self):
+        """
+            Simulates following request with RANGE_REQUESTS_PROXY_COMPRESSION=1:
+            curl -i --compressed http://localhost:8000/events.json
+        """
+        response = await self.fetch({'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.headers['ETag'], '"v1-gzip"')
+        self.assertNotIn('Content-Range', response.headers)
+        self.assertEqual(gzip.decompress(response.body), self.content)
+        self.assertFalse(self.requests[0].decompress_response)
+
+        again = await self.fetch({'Accept-Encoding': 'gzip'})
+        self.assertEqual(again.body, response.body)
+        self.assertEqual(again.headers['ETag'], '"v1-gzip"')
+        self.assertEqual(again.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(self.compression.stats()["cache_hits"], 1)
+        # The cached variant is answered without fetching the identity body again
+        self.assertEqual(len(self.requests), 1)
+
+    @gen_test
+    async def test_variant_etag_is_revalidated_locally(self):
+        response = await self.fetch({'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['ETag'], '"v1-gzip"')
+
+        again = await self.http_client.fetch(self.get_url('/events.json'), raise_error=False,
+                                             headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"v1-gzip"'})
+        self.assertEqual(again.code, 304)
+        self.assertEqual(again.headers['ETag'], '"v1-gzip"')
+        self.assertEqual(again.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(len(self.requests), 1)
+
+        # the variant tag does not validate the identity bytes
+        identity = await self.fetch({'Accept-Encoding': 'identity', 'If-None-Match': '"v1-gzip"'})
+        self.assertEqual(identity.code, 200)
+        self.assertEqual(identity.body, self.content)
+
+    @gen_test
+    async def test_head_gets_the_headers_of_the_get(self):
+        response = await self.http_client.fetch(self.get_url('/events.json'), method='HEAD',
+                                                headers={'Accept-Encoding': 'gzip'}, decompress_response=False)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], '"v1-gzip"')
+        self.assertNotIn('Content-Length', response.headers)
+
+        response = await self.http_client.fetch(self.get_url('/events.json'), method='HEAD',
+                                                decompress_response=False)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Content-Length'], str(len(self.content)))
+        self.assertEqual(self.compression.stats()["responses"], 0)
+
+    @gen_test
+    async def test_streamed_whole_object_is_compressed(self):
+        with patch('rangerequestsproxy.proxy.STREAMING', True):
+            response = await self.fetch({'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.body), self.content)
+        self.assertEqual(self.compression.stats()["cache_variants"], 1)
+
+    @gen_test
+    async def test_ranges_and_identity_clients_get_identity_bytes(self):
+        response = await self.fetch({'Accept-Encoding': 'gzip', 'Range': 'bytes=0-1999'})
+        self.assertEqual(response.code, 206)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, self.content[:2000])
+
+        response = await self.fetch({})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, self.content)
+        self.assertEqual(self.compression.stats()["responses"], 0)
+
+    @gen_test
+    async def test_encoded_upstream_body_and_other_media_types_pass_through(self):
+        self.upstream_headers['Content-Encoding'] = 'gzip'
+        response = await self.fetch({'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.body, self.content)
+
+        self.upstream_headers = {'Content-Type': 'image/jpeg'}
+        response = await self.fetch({'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, self.content)
+        self.assertEqual(self.compression.stats()["responses"], 0)
+
+
+class TestConfigHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Application([(r'/config', ConfigHandler)])
+
+    def setUp(self):
+        super(TestConfigHandler, self).setUp()
+        # Everything apply_settings swaps is put back after every test
+        names = list(proxy.SETTING_GLOBALS.values()) + ['SHAPER', 'SPLIT', 'COMPRESSION', 'BLOCK_CACHE', 'METADATA',
+                                                        'READAHEAD', 'CONFIG', 'ADMIN_TOKEN']
+        for name in names:
+            patcher = patch.object(proxy, name, getattr(proxy, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pool = MagicMock()
+        self.drained = Future()
+        self.pool.drain.return_value = self.drained
+        for patcher in (patch('rangerequestsproxy.proxy.PROXY_ADDRESS', 'http://a:9000,http://b:9000'),
+                        patch('rangerequestsproxy.proxy.BALANCER', Balancer()),
+                        patch('rangerequestsproxy.proxy.HEDGING', HedgingPolicy()),
+                        patch('rangerequestsproxy.proxy.UPSTREAM_POOL', self.pool)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_settings_are_swapped_and_removed_upstreams_drained(self):
+        attempts, responses = [], []
+        fetch = HedgedFetch(proxy.HEDGING, proxy.BALANCER, lambda exclude: 'http://a:9000', attempts.append,
+                            responses.append)
+        fetch.start()
+
+        changed = proxy.apply_settings({'address': 'http://b:9000,http://c:9000', 'max_ranges': '5',
+                                        'request_timeout': proxy.REQUEST_TIMEOUT, 'rate_limit': 1000,
+                                        'first_byte_timeout': 3})
+
+        self.assertEqual(sorted(changed), ['address', 'first_byte_timeout', 'max_ranges', 'rate_limit'])
+        self.assertEqual(proxy.PROXY_ADDRESS, 'http://b:9000,http://c:9000')
+        self.assertEqual(proxy.MAX_RANGE, 5)
+        self.assertEqual(proxy.SHAPER.rate, 1000)
+        self.assertEqual(proxy.HEDGING.first_byte_timeout, 3)
+        self.pool.drain.assert_called_once_with('http://a:9000')
+        self.assertEqual(sorted(c[0][0] for c in self.pool.undrain.call_args_list), ['http://b:9000', 'http://c:9000'])
+
+        # The upstream keeps its state until its running requests finished
+        self.assertIn('http://a:9000', proxy.BALANCER.stats()["upstreams"])
+        self.drained.set_result(None)
+        self.assertNotIn('http://a:9000', proxy.BALANCER.stats()["upstreams"])
+        # The pool lets go of the upstream before the request's own callbacks ran, they must not bring it back
+        attempts[0].on_header('HTTP/1.1 200 OK\r\n')
+        attempts[0].on_response(MagicMock(code=200))
+        self.assertEqual([r.code for r in responses], [200])
+        self.assertNotIn('http://a:9000', proxy.BALANCER.stats()["upstreams"])
+        self.assertNotIn('upstream="http://a:9000"', proxy.METRICS.render())
+
+    def test_invalid_settings_change_nothing(self):
+        max_range = proxy.MAX_RANGE
+        with self.assertRaises(ConfigError):
+            proxy.apply_settings({'max_ranges': 5, 'cache_size': -1})
+        self.assertEqual(proxy.MAX_RANGE, max_range)
+
+    def test_put_changes_settings_and_get_shows_them(self):
+        response = self.fetch('/config', method='PUT', body=json.dumps({'max_ranges': 7, 'streaming': True}))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(proxy.MAX_RANGE, 7)
+
+        result = json.loads(self.fetch('/config').body.decode('utf-8'))
+        self.assertEqual(result["settings"]["max_ranges"], 7)
+        self.assertTrue(result["settings"]["streaming"])
+        self.assertIsNone(result["file"])
+
+    def test_bad_requests(self):
+        response = self.fetch('/config', method='PUT', body='{"max_ranges": ')
+        self.assertEqual(response.code, 400)
+        response = self.fetch('/config', method='PUT', body=json.dumps({'port': 8001}))
+        self.assertEqual(json.loads(response.body.decode('utf-8')),
+                         {"error": "Unknown or not reloadable setting port"})
+        response = self.fetch('/config', method='POST', body='')
+        self.assertEqual(response.code, 409)
+
+    def test_changes_need_the_admin_token(self):
+        proxy.ADMIN_TOKEN = 'secret'
+        body = json.dumps({'max_ranges': 7})
+
+        self.assertEqual(self.fetch('/config', method='PUT', body=body).code, 403)
+        response = self.fetch('/config', method='PUT', body=body, headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(proxy.MAX_RANGE, 7)
+
+    def test_put_goes_through_the_config_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'proxy.json')
+        with open(path, 'w') as f:
+            json.dump({'max_ranges': 3}, f)
+        proxy.CONFIG = ConfigFile(path, proxy.apply_settings)
+
+        response = self.fetch('/config', method='PUT', body=json.dumps({'multipart_max_gap': 0}))
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual((proxy.MAX_RANGE, proxy.MULTIPART_MAX_GAP), (3, 0))
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'max_ranges': 3, 'multipart_max_gap': 0})
+        self.assertEqual(json.loads(response.body.decode('utf-8'))["file"]["version"], 1)
+
+
+class TestStatsHandlerWorkers(unittest.TestCase):
+
+    @patch('rangerequestsproxy.proxy.START_TIME', 1000)
+    @patch('rangerequestsproxy.proxy.TOTAL_BYTES_TRANSFERRED', 0)
+    @patch('rangerequestsproxy.proxy.BLOCK_CACHE', BlockCache(memory_size=64, block_size=4))
+    @patch('rangerequestsproxy.proxy.SHARED_COUNTERS', SharedCounters(proxy.SHARED_COUNTER_NAMES, slots=2))
+    @patch('rangerequestsproxy.proxy.time')
+    def test_stats_are_summed_over_workers(self, time_mock):
+        # another worker already published its counters
+        proxy.SHARED_COUNTERS.use_slot(1)
+        proxy.SHARED_COUNTERS.set('total_bytes_transferred', 100)
+        proxy.SHARED_COUNTERS.set('cache_hits', 3)
+        proxy.SHARED_COUNTERS.use_slot(0)
+
+        proxy._count_bytes_transferred(20)
+        proxy.BLOCK_CACHE.record_hit(4)
+        stats_handler = StatsHandler(application=MagicMock(), request=MagicMock(uri='/stats'))
+        stats_handler.finish = MagicMock()
+        time_mock.time.return_value = 1050
+
+        stats_handler.get()
+
+        result = json.JSONDecoder().decode(stats_handler._write_buffer[0].decode("utf-8"))
+        self.assertEqual(result['total_bytes_transferred'], 120)
+        self.assertEqual(result['cache']['hits'], 4)
+        self.assertEqual((result['workers'], result['worker_id']), (2, 0))
+        self.assertEqual(result['uptime_seconds'], 50)
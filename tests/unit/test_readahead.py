@@ -0,0 +1,103 @@
+import io
+import unittest
+
+from mock import patch, MagicMock
+from rangerequestsproxy.readahead import Readahead
+from tornado.httpclient import HTTPResponse
+from tornado.httputil import HTTPHeaders
+
+CONTENT = bytes(bytearray(range(256))) * 4
+KEY = ('127.0.0.1', '/video.mp4')
+
+
+def make_response(start, end):
+    headers = HTTPHeaders({'Content-Type': 'video/mp4',
+                           'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(CONTENT))})
+    return HTTPResponse(MagicMock(), 206, headers=headers, buffer=io.BytesIO(CONTENT[start:end + 1]))
+
+
+@patch('rangerequestsproxy.readahead.time')
+class TestReadahead(unittest.TestCase):
+
+    def read(self, readahead, time_mock, now, start, end):
+        time_mock.time.return_value = now
+        return readahead.lookup(KEY, start, end)
+
+    def test_sequential_reader_is_served_from_prefetched_window(self, time_mock):
+        readahead = Readahead(max_memory=1024, max_window=512, lookahead_time=1)
+        self.assertIsNone(self.read(readahead, time_mock, 100, 0, 99))
+        self.assertIsNone(readahead.next_window(KEY))
+        self.assertIsNone(self.read(readahead, time_mock, 101, 100, 199))
+        self.assertIsNone(readahead.next_window(KEY))
+        self.assertIsNone(self.read(readahead, time_mock, 102, 200, 299))
+
+        # 100 bytes per second for one second, but at least one request
+        self.assertEqual(readahead.next_window(KEY), (300, 399))
+        readahead.store(KEY, 300, 399, make_response(300, 399))
+
+        response = self.read(readahead, time_mock, 103, 300, 349)
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, CONTENT[300:350])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 300-349/1024')
+        self.assertEqual(readahead.stats(), {"hits": 1, "misses": 1, "prefetches": 1, "prefetched_bytes": 100,
+                                             "wasted_bytes": 0, "memory_bytes": 100, "readers": 1})
+
+    def test_window_grows_with_consumption_rate(self, time_mock):
+        readahead = Readahead(max_memory=4096, max_window=300, lookahead_time=2)
+        for i, now in enumerate((100, 100.5, 101)):
+            self.read(readahead, time_mock, now, i * 100, i * 100 + 99)
+
+        # 200 bytes per second for two seconds, capped by max_window
+        self.assertEqual(readahead.next_window(KEY), (300, 599))
+        # more than half a window is on its way
+        self.assertIsNone(readahead.next_window(KEY))
+
+    def test_requests_for_pending_window_count_as_hits(self, time_mock):
+        readahead = Readahead(max_memory=1024, max_window=100, lookahead_time=1)
+        for i in range(3):
+            self.read(readahead, time_mock, 100 + i, i * 100, i * 100 + 99)
+        window = readahead.next_window(KEY)
+
+        self.assertIsNone(self.read(readahead, time_mock, 103, 300, 399))
+        readahead.store(KEY, window[0], window[1], make_response(*window))
+
+        # already delivered through the shared upstream fetch, nothing is kept or wasted
+        self.assertEqual(readahead.stats()['hits'], 1)
+        self.assertEqual(readahead.stats()['memory_bytes'], 0)
+        self.assertEqual(readahead.stats()['wasted_bytes'], 0)
+
+    def test_seek_drops_window_as_wasted(self, time_mock):
+        readahead = Readahead(max_memory=1024, max_window=100, lookahead_time=1)
+        for i in range(3):
+            self.read(readahead, time_mock, 100 + i, i * 100, i * 100 + 99)
+        readahead.store(KEY, 300, 399, make_response(*readahead.next_window(KEY)))
+
+        self.assertIsNone(self.read(readahead, time_mock, 103, 0, 99))
+
+        self.assertEqual(readahead.stats()['wasted_bytes'], 100)
+        self.assertEqual(readahead.stats()['memory_bytes'], 0)
+        self.assertIsNone(readahead.next_window(KEY))
+
+    def test_memory_cap(self, time_mock):
+        readahead = Readahead(max_memory=150, max_window=100, lookahead_time=1)
+        other = ('127.0.0.2', '/video.mp4')
+        for i in range(3):
+            self.read(readahead, time_mock, 100 + i, i * 100, i * 100 + 99)
+            time_mock.time.return_value = 100 + i
+            readahead.lookup(other, i * 100, i * 100 + 99)
+        readahead.store(KEY, 300, 399, make_response(*readahead.next_window(KEY)))
+
+        # the other reader's window does not fit next to the first one, which is dropped for it
+        self.assertEqual(readahead.next_window(other), (300, 399))
+        self.assertEqual(readahead.stats()['wasted_bytes'], 100)
+        self.assertEqual(readahead.stats()['memory_bytes'], 100)
+
+    def test_window_stops_at_end_of_object(self, time_mock):
+        readahead = Readahead(max_memory=4096, max_window=4096, lookahead_time=1)
+        for i in range(3):
+            self.read(readahead, time_mock, 100 + i, i * 300, i * 300 + 299)
+        window = readahead.next_window(KEY)
+        readahead.store(KEY, window[0], window[1], make_response(900, 1023))
+        self.read(readahead, time_mock, 103, 900, 1023)
+
+        self.assertIsNone(readahead.next_window(KEY))
@@ -0,0 +1,87 @@
+import asyncio
+import unittest
+
+from mock import patch
+from rangerequestsproxy.shaping import Shaper, TokenBucket
+from tornado.testing import AsyncTestCase, gen_test
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_is_sent_right_away_and_debt_is_waited_out(self):
+        bucket = TokenBucket(rate=100, burst=50, now=0)
+        self.assertEqual(bucket.take(50, 0), 0)
+        self.assertEqual(bucket.take(100, 0), 1.0)
+        self.assertEqual(bucket.delay(0.5), 0.5)
+        self.assertEqual(bucket.delay(1), 0)
+
+    def test_tokens_never_exceed_burst(self):
+        bucket = TokenBucket(rate=100, burst=50, now=0)
+        bucket.delay(60)
+        self.assertEqual(bucket.tokens, 50)
+        self.assertEqual(bucket.take(70, 60), 0.2)
+
+
+class TestShaperAdmission(unittest.TestCase):
+
+    def test_requests_are_rejected_while_the_budget_is_used_up(self):
+        shaper = Shaper(max_inflight_bytes=100)
+        stream = shaper.open_stream('10.0.0.1')
+        shaper.hold(stream, 60)
+        self.assertTrue(shaper.admit())
+        shaper.hold(stream, 40)
+        self.assertFalse(shaper.admit())
+
+        shaper.release(stream, 30)
+        self.assertTrue(shaper.admit())
+        self.assertEqual(shaper.stats()["rejected_requests"], 1)
+
+    def test_closed_stream_releases_what_it_still_held(self):
+        shaper = Shaper(max_inflight_bytes=100, client_rate=10)
+        stream = shaper.open_stream('10.0.0.1')
+        shaper.hold(stream, 100)
+        shaper.close_stream(stream)
+        shaper.close_stream(stream)
+
+        self.assertEqual(shaper.inflight_bytes, 0)
+        self.assertEqual(shaper.streams, 0)
+        self.assertEqual(shaper._client_buckets, {})
+
+
+class TestShaperPacing(AsyncTestCase):
+
+    @gen_test
+    async def test_client_and_upstream_buckets_delay_chunks(self):
+        sleeps = []
+
+        async def sleep(delay):
+            sleeps.append(delay)
+
+        with patch('rangerequestsproxy.shaping.time') as time_mock, \
+                patch('rangerequestsproxy.shaping.asyncio.sleep', sleep):
+            time_mock.time.return_value = 0
+            shaper = Shaper(client_rate=100, upstream_rate=50, burst=100)
+            stream = shaper.open_stream('10.0.0.1', 'http://127.0.0.1:9000')
+            await shaper.acquire(stream, 100)
+            await shaper.acquire(stream, 100)
+
+        # the upstream bucket is the slower one
+        self.assertEqual(sleeps, [2.0])
+        self.assertEqual(shaper.bytes_sent, 200)
+
+    @gen_test
+    async def test_clients_get_equal_shares_whatever_their_number_of_streams(self):
+        shaper = Shaper(rate=20000, burst=0)
+        sent = []
+
+        async def download(client, stream):
+            for _ in range(4):
+                await shaper.acquire(stream, 100)
+                sent.append(client)
+
+        streams = [('a', shaper.open_stream('a')), ('a', shaper.open_stream('a')), ('b', shaper.open_stream('b'))]
+        await asyncio.gather(*[download(client, stream) for client, stream in streams])
+
+        # Round robin over the streams would finish b's download last, fair queuing splits the rate per client
+        self.assertEqual(sent[:9].count('b'), 4)
+        self.assertEqual(shaper.stats()["queued_chunks"], 0)
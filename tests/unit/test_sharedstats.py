@@ -0,0 +1,50 @@
+import os
+import unittest
+
+from rangerequestsproxy.sharedstats import SharedCounters
+
+
+class TestSharedCounters(unittest.TestCase):
+
+    def test_slots_are_summed(self):
+        counters = SharedCounters(('bytes', 'hits'), slots=3)
+        counters.set('bytes', 10)
+        counters.use_slot(2)
+        counters.set('bytes', 5)
+        counters.add('hits', 2)
+        counters.add('hits', 1)
+
+        self.assertEqual(counters.get('bytes'), 5)
+        self.assertEqual(counters.get('bytes', slot=0), 10)
+        self.assertEqual(counters.totals(), {'bytes': 15, 'hits': 3})
+
+    def test_published_counts_never_go_backwards(self):
+        counters = SharedCounters(('bytes',), slots=2)
+        counters.use_slot(1)
+        counters.publish('bytes', 30)
+        counters.publish('bytes', 40)
+        # A worker restarted into the slot counts from 0 again
+        counters.use_slot(1)
+        counters.publish('bytes', 5)
+        self.assertEqual(counters.get('bytes'), 45)
+        # So does a counter of an object that was replaced
+        counters.publish('bytes', 2)
+        self.assertEqual(counters.total('bytes'), 47)
+
+    def test_invalid_slot(self):
+        with self.assertRaises(ValueError):
+            SharedCounters(('bytes',), slots=2).use_slot(2)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_counters_are_shared_with_forked_workers(self):
+        counters = SharedCounters(('bytes',), slots=2)
+        counters.set('bytes', 7)
+
+        pid = os.fork()
+        if pid == 0:
+            counters.use_slot(1)
+            counters.set('bytes', 35)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(counters.total('bytes'), 42)
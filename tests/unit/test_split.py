@@ -0,0 +1,157 @@
+import io
+import unittest
+
+from concurrent.futures import Future
+from mock import MagicMock
+from rangerequestsproxy.split import SplitFetch, SplitPolicy, split_range
+from tornado.httpclient import HTTPError, HTTPResponse
+from tornado.httputil import HTTPHeaders
+
+CONTENT = bytes(bytearray(range(256))) * 4
+
+
+def make_response(start, end, etag='"v1"', content=CONTENT):
+    headers = HTTPHeaders({'Content-Type': 'video/mp4', 'ETag': etag,
+                           'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content))})
+    return HTTPResponse(MagicMock(), 206, headers=headers, buffer=io.BytesIO(content[start:end + 1]))
+
+
+class TestSplitRange(unittest.TestCase):
+
+    def test_parts_are_aligned(self):
+        self.assertEqual(split_range(0, 299, 100), [(0, 99), (100, 199), (200, 299)])
+        self.assertEqual(split_range(150, 320, 100), [(150, 199), (200, 299), (300, 320)])
+        self.assertEqual(split_range(5, 5, 100), [(5, 5)])
+
+
+class TestSplitFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.requested = []
+        self.headers = []
+        self.chunks = []
+        self.results = []
+        self.flushes = []
+
+    def fetch_part(self, start, end, callback):
+        self.requested.append((start, end, callback))
+
+    def chunk_callback(self, chunk):
+        self.chunks.append(chunk)
+        if self.flushes is not None:
+            self.flushes.append(Future())
+            return self.flushes[-1]
+        return None
+
+    def make_fetch(self, policy, start, end, size=None):
+        return SplitFetch(policy, self.fetch_part, start, end, size,
+                          lambda response, start, end, size: self.headers.append((start, end, size)),
+                          self.chunk_callback, self.results.append)
+
+    def answer(self, index, response=None):
+        start, end, callback = self.requested[index]
+        callback(response if response is not None else make_response(start, end))
+
+    def test_parts_are_written_in_order(self):
+        self.flushes = None
+        policy = SplitPolicy(part_size=256, parallelism=2)
+        fetch = self.make_fetch(policy, 100, None)
+        fetch.start()
+
+        # the object size is unknown, only the first part is requested
+        self.assertEqual([r[:2] for r in self.requested], [(100, 255)])
+        self.answer(0)
+        self.assertEqual([r[:2] for r in self.requested], [(100, 255), (256, 511), (512, 767)])
+        self.assertEqual(self.headers, [(100, 1023, 1024)])
+
+        # a part that arrives early waits until its predecessor was written
+        self.answer(2)
+        self.assertEqual(len(self.chunks), 1)
+        self.answer(1)
+        self.answer(3)
+
+        self.assertEqual(b''.join(self.chunks), CONTENT[100:])
+        self.assertEqual(self.results, [None])
+        self.assertEqual(policy.stats()['parts'], 4)
+
+    def test_slow_client_holds_parts_back(self):
+        policy = SplitPolicy(part_size=256, parallelism=2)
+        fetch = self.make_fetch(policy, 0, 1023, size=1024)
+        fetch.start()
+        self.assertEqual(len(self.requested), 2)
+
+        self.answer(0)
+        self.assertEqual(len(self.requested), 3)
+        self.answer(1)
+        self.answer(2)
+        # the first flush did not complete, nothing else is written or requested
+        self.assertEqual(len(self.chunks), 1)
+        self.assertEqual(len(self.requested), 3)
+
+        self.flushes[0].set_result(None)
+        self.assertEqual(len(self.chunks), 2)
+        self.assertEqual(len(self.requested), 4)
+        self.flushes[1].set_result(None)
+        self.flushes[2].set_result(None)
+        self.answer(3)
+        self.flushes[3].set_result(None)
+
+        self.assertEqual(b''.join(self.chunks), CONTENT)
+        self.assertEqual(self.results, [None])
+
+    def test_failed_part_is_retried(self):
+        self.flushes = None
+        policy = SplitPolicy(part_size=512, parallelism=2, max_retries=1)
+        fetch = self.make_fetch(policy, 0, 1023, size=1024)
+        fetch.start()
+
+        self.answer(1, HTTPResponse(MagicMock(), 599, error=HTTPError(599)))
+        self.assertEqual(self.requested[2][:2], (512, 1023))
+        self.answer(0)
+        self.answer(2)
+
+        self.assertEqual(b''.join(self.chunks), CONTENT)
+        self.assertEqual(policy.stats()['part_retries'], 1)
+
+        # out of retries
+        self.requested = []
+        self.results = []
+        self.make_fetch(policy, 0, 1023, size=1024).start()
+        self.answer(0, HTTPResponse(MagicMock(), 503, error=HTTPError(503)))
+        self.answer(2, HTTPResponse(MagicMock(), 503, error=HTTPError(503)))
+        self.assertEqual([r.code for r in self.results], [503])
+
+    def test_changed_object_is_never_stitched(self):
+        self.flushes = None
+        policy = SplitPolicy(part_size=512, parallelism=2)
+        fetch = self.make_fetch(policy, 0, 1023, size=1024)
+        fetch.start()
+
+        self.answer(1)
+        self.answer(0, make_response(0, 511, etag='"v2"'))
+
+        # nothing was written, the range is fetched as a whole instead
+        self.assertEqual(self.chunks, [])
+        self.assertEqual(self.results, [None])
+        self.assertEqual(policy.stats()['failures'], 1)
+
+    def test_small_object_is_not_split(self):
+        policy = SplitPolicy(part_size=4096)
+        fetch = self.make_fetch(policy, 0, None)
+        fetch.start()
+        response = make_response(0, 1023)
+        self.answer(0, response)
+
+        self.assertEqual(self.results, [response])
+        self.assertEqual(self.headers, [])
+
+    def test_cancel_stops_fetching(self):
+        policy = SplitPolicy(part_size=256, parallelism=1)
+        fetch = self.make_fetch(policy, 0, 1023, size=1024)
+        fetch.start()
+        fetch.cancel()
+        self.answer(0)
+
+        self.assertEqual(len(self.requested), 1)
+        self.assertEqual(self.chunks, [])
+        self.assertEqual(self.results, [])
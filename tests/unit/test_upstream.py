@@ -0,0 +1,195 @@
+import asyncio
+
+from mock import patch, MagicMock
+from rangerequestsproxy.upstream import UpstreamPool
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+UPSTREAM = 'http://127.0.0.1:9000'
+
+
+async def respond(req, raise_error=False):
+    return MagicMock()
+
+
+class TestUpstreamPool(AsyncTestCase):
+
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_client_is_configured_once(self, http_client_mock):
+        http_client_mock.return_value.fetch = respond
+        pool = UpstreamPool(max_clients=50)
+
+        await pool.fetch(UPSTREAM, MagicMock())
+        await pool.fetch(UPSTREAM, MagicMock())
+
+        http_client_mock.configure.assert_called_once_with('tornado.curl_httpclient.CurlAsyncHTTPClient',
+                                                           max_clients=50)
+
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_requests_over_the_per_upstream_limit_are_queued(self, http_client_mock):
+        pending = []
+
+        def fetch(req, raise_error=False):
+            pending.append(Future())
+            return pending[-1]
+
+        http_client_mock.return_value.fetch = fetch
+        pool = UpstreamPool(max_per_upstream=2)
+
+        fetches = [asyncio.ensure_future(pool.fetch(UPSTREAM, MagicMock())) for _ in range(3)]
+        fetches.append(asyncio.ensure_future(pool.fetch('http://127.0.0.1:9001', MagicMock())))
+        await asyncio.sleep(0)
+
+        self.assertEqual(len(pending), 3)
+        stats = pool.stats()
+        self.assertEqual(stats['upstreams'][UPSTREAM], {"active": 2, "idle": 0, "queued": 1, "requests": 2})
+        self.assertEqual((stats['active'], stats['queued']), (3, 1))
+
+        response = MagicMock()
+        pending[0].set_result(response)
+        self.assertIs(await fetches[0], response)
+        await asyncio.sleep(0)
+        # the queued request took over the freed slot
+        self.assertEqual(len(pending), 4)
+        self.assertEqual(pool.stats()['upstreams'][UPSTREAM], {"active": 2, "idle": 0, "queued": 0, "requests": 3})
+
+        pending[1].set_result(response)
+        pending[3].set_result(response)
+        await fetches[1]
+        await fetches[2]
+        self.assertEqual(pool.stats()['upstreams'][UPSTREAM], {"active": 0, "idle": 2, "queued": 0, "requests": 3})
+
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_raised_limit_releases_queued_requests(self, http_client_mock):
+        pending = []
+
+        def fetch(req, raise_error=False):
+            pending.append(Future())
+            return pending[-1]
+
+        http_client_mock.return_value.fetch = fetch
+        pool = UpstreamPool(max_per_upstream=1)
+        fetches = [asyncio.ensure_future(pool.fetch(UPSTREAM, MagicMock())) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertEqual(len(pending), 1)
+
+        pool.reconfigure(max_per_upstream=3, idle_timeout=30, dns_cache_timeout=60)
+        await asyncio.sleep(0)
+
+        self.assertEqual(len(pending), 3)
+        self.assertEqual(pool.stats()['upstreams'][UPSTREAM]['active'], 3)
+        for future in pending:
+            future.set_result(MagicMock())
+        await asyncio.gather(*fetches)
+
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_drained_upstream_is_forgotten_after_its_last_request(self, http_client_mock):
+        pending = []
+
+        def fetch(req, raise_error=False):
+            pending.append(Future())
+            return pending[-1]
+
+        http_client_mock.return_value.fetch = fetch
+        pool = UpstreamPool(max_per_upstream=1)
+        fetches = [asyncio.ensure_future(pool.fetch(UPSTREAM, MagicMock())) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        drained = pool.drain(UPSTREAM)
+        self.assertTrue(pool.stats()['upstreams'][UPSTREAM]['draining'])
+        pending[0].set_result(MagicMock())
+        await fetches[0]
+        await asyncio.sleep(0)
+        # the queued request still goes out
+        self.assertFalse(drained.done())
+        pending[1].set_result(MagicMock())
+        await fetches[1]
+
+        self.assertTrue(drained.done())
+        self.assertEqual(pool.stats()['upstreams'], {})
+        self.assertTrue(pool.drain('http://127.0.0.1:9001').done())
+
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_cancelled_waiter_leaves_the_queue(self, http_client_mock):
+        pending = []
+
+        def fetch(req, raise_error=False):
+            pending.append(Future())
+            return pending[-1]
+
+        http_client_mock.return_value.fetch = fetch
+        pool = UpstreamPool(max_per_upstream=1)
+        first = asyncio.ensure_future(pool.fetch(UPSTREAM, MagicMock()))
+        queued = asyncio.ensure_future(pool.fetch(UPSTREAM, MagicMock()))
+        await asyncio.sleep(0)
+
+        queued.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(pool.stats()['queued'], 0)
+
+        pending[0].set_result(MagicMock())
+        await first
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pool.stats()['active'], 0)
+
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_connection_failures_become_responses(self, http_client_mock):
+        async def fail(req, raise_error=False):
+            raise OSError('connection refused')
+
+        http_client_mock.return_value.fetch = fail
+        pool = UpstreamPool()
+
+        response = await pool.fetch(UPSTREAM, MagicMock())
+
+        self.assertEqual(response.code, 599)
+        self.assertIsInstance(response.error, OSError)
+        self.assertEqual(pool.stats()['active'], 0)
+
+    @patch('rangerequestsproxy.upstream.time')
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_idle_connections_expire(self, http_client_mock, time_mock):
+        time_mock.time.return_value = 1000
+        http_client_mock.return_value.fetch = respond
+        pool = UpstreamPool(idle_timeout=60)
+
+        await pool.fetch(UPSTREAM, MagicMock())
+        self.assertEqual(pool.stats()['idle'], 1)
+
+        time_mock.time.return_value = 1061
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    @patch('rangerequestsproxy.upstream.pycurl')
+    @patch('rangerequestsproxy.upstream.tornado.httpclient.AsyncHTTPClient')
+    @gen_test
+    async def test_curl_handles_are_tuned_before_request_specific_callback(self, http_client_mock, pycurl_mock):
+        http_client_mock.return_value.fetch = respond
+        pool = UpstreamPool(idle_timeout=30, dns_cache_timeout=120, stall_timeout=15)
+        request = MagicMock()
+        original_prepare = request.prepare_curl_callback
+        curl = MagicMock()
+
+        await pool.fetch(UPSTREAM, request)
+        request.prepare_curl_callback(curl)
+
+        curl.setopt.assert_any_call(pycurl_mock.TCP_KEEPALIVE, 1)
+        curl.setopt.assert_any_call(pycurl_mock.DNS_CACHE_TIMEOUT, 120)
+        curl.setopt.assert_any_call(pycurl_mock.SHARE, pycurl_mock.CurlShare.return_value)
+        curl.setopt.assert_any_call(pycurl_mock.MAXAGE_CONN, 30)
+        # bodies have no overall deadline, only transfers that stopped moving are given up
+        curl.setopt.assert_any_call(pycurl_mock.LOW_SPEED_LIMIT, 1)
+        curl.setopt.assert_any_call(pycurl_mock.LOW_SPEED_TIME, 15)
+        original_prepare.assert_called_once_with(curl)
+
+        # reused handles stay attached to the share
+        curl.setopt.reset_mock()
+        await pool.fetch(UPSTREAM, request)
+        request.prepare_curl_callback(curl)
+        self.assertNotIn(((pycurl_mock.SHARE, pycurl_mock.CurlShare.return_value),), curl.setopt.call_args_list)